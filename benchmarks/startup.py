@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+
+import os.path
+import subprocess
+import sys
+import time
+
+
+# Make program-related paths globally accessible to script
+program_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+local_driver_path = os.path.join(program_dir, 'swb', 'local.py')
+
+
+# Measure the wall-clock time (in seconds) taken to run the local driver
+# with the given arguments
+def time_local_driver(args):
+
+    started = time.time()
+    subprocess.check_call(
+        [sys.executable, local_driver_path] + args,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.time() - started
+
+
+def main():
+
+    num_runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    durations = sorted(time_local_driver(['--help']) for _ in range(num_runs))
+    print('cold start (--help) over {} runs: p50 {:.1f}ms, min {:.1f}ms'
+          .format(num_runs, durations[num_runs // 2] * 1000,
+                  durations[0] * 1000))
+
+
+if __name__ == '__main__':
+    main()
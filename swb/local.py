@@ -1,14 +1,8 @@
 #!/usr/bin/env python3
 
 import argparse
-import configparser
-import glob
 import os
 import os.path
-import pipes
-import re
-import shlex
-import subprocess
 import sys
 import time
 
@@ -16,6 +10,53 @@ import time
 # Make program-related paths globally accessible to script
 program_dir = os.path.dirname(os.path.realpath(__file__))
 remote_driver_path = os.path.join(program_dir, 'remote.py')
+default_history_path = '~/.ssh-wp-backup/history.sqlite3'
+# The remote directory in which the remote script is cached between runs
+remote_cache_dir = '~/.cache/ssh-wp-backup'
+# The prefix of the lines on the remote's stderr which report progress
+progress_prefix = b'swb-progress: '
+# The width (in characters) of the bar showing the progress of a backup
+progress_bar_width = 30
+# The exit status signaling that the remote script is not yet cached
+cache_miss_status = 75
+# The local directory in which trained compression dictionaries are stored
+default_dictionary_dir = '~/.ssh-wp-backup/dictionaries'
+# The remote directory in which compression dictionaries are cached (relative
+# to the remote home directory, since remote commands are not run through a
+# shell which would expand ~)
+remote_dictionary_dir = '.cache/ssh-wp-backup/dictionaries'
+# The number of the latest backups of each site sampled to train a dictionary,
+# and the number of bytes sampled from the start of each
+dictionary_training_backups = 3
+dictionary_sample_size = 8 * 1024 * 1024
+
+# The size of the chunks in which backups are copied
+copy_buffer_size = 1024 * 1024
+# The number of threads used to scan and purge backup directories
+retention_workers = 8
+# The age (in seconds) after which temporary files are considered stale
+stale_temp_file_age = 24 * 60 * 60
+# Regular expressions matching the values of date format sequences
+date_format_regexes = {
+    'Y': r'\d{4}', 'y': r'\d{2}', 'm': r'\d{2}', 'd': r'\d{2}',
+    'H': r'\d{2}', 'I': r'\d{2}', 'M': r'\d{2}', 'S': r'\d{2}',
+    'j': r'\d{3}', 'U': r'\d{2}', 'W': r'\d{2}', 'w': r'\d'
+}
+# The default interval (in seconds) between backups of a site in daemon mode
+default_backup_interval = 24 * 60 * 60
+# The default number of times a transiently failed backup is retried, and
+# the delay (in seconds) before the first retry (doubled for each retry)
+default_retry_attempts = 3
+default_retry_delay = 60
+# The exit statuses of failed backups worth retrying (SSH exits with 255 if
+# the connection could not be established or was dropped, and the remote
+# script with 75 if the dump gave up waiting for a database lock)
+transient_exit_statuses = (255, 75)
+# The interval (in seconds) at which the daemon checks for due backups
+daemon_poll_interval = 1
+
+# Modules only needed by some actions are imported where they are used, so
+# as to keep startup (e.g. for --help) fast
 
 
 # Create intermediate directories in local backup path if necessary
@@ -30,65 +71,227 @@ def create_dir_structure(local_backup_path):
 # Unquote ~ at beginning of path so it can be evaluated to home directory path
 def unquote_home_dir(path):
 
+    import re
+
     return re.sub('^\'~/', '~/\'', path)
 
 
-# Quote shell arguments in a backwards-compatible manner
+# Quote shell arguments
 def quote_arg(arg):
 
-    if hasattr(shlex, 'quote'):
-        # shlex.quote was introduced in v3.3
-        quoted_arg = shlex.quote(str(arg))
-    else:
-        # pipes.quote is deprecated, but use it if shlex.quote is unavailable
-        quoted_arg = pipes.quote(str(arg))
+    import shlex
 
+    quoted_arg = shlex.quote(str(arg))
     quoted_arg = unquote_home_dir(quoted_arg)
     return quoted_arg
 
 
-# Connect to remote via SSH and execute remote script
-def exec_on_remote(ssh_user, ssh_hostname, ssh_port, *,
-                   action, action_args, stdout, stderr):
+# Read the remote script, returning its contents and the path under which
+# it is cached on the remote (keyed by the hash of its contents)
+def read_remote_script():
+
+    import hashlib
+
+    with open(remote_driver_path, 'rb') as remote_script:
+        remote_script_contents = remote_script.read()
+
+    remote_script_hash = hashlib.sha256(remote_script_contents).hexdigest()
+    remote_script_path = '{}/remote-{}.py'.format(
+        remote_cache_dir, remote_script_hash[:16])
+
+    return remote_script_contents, remote_script_path
+
+
+# Upload the remote script to the remote cache (if it is not already cached)
+def install_remote_script(ssh_user, ssh_hostname, ssh_port, *,
+                          remote_script_contents, remote_script_path,
+                          stderr, transport='ssh'):
+
+    install_remote_file(
+        ssh_user, ssh_hostname, ssh_port,
+        contents=remote_script_contents, remote_path=remote_script_path,
+        stderr=stderr, transport=transport)
+
+
+# Upload the given contents to the given remote path (if no file exists
+# there yet); the path is assumed to be unique to the contents, and the file
+# is written under a temporary name unique to the remote shell (since other
+# runs may be installing the same file at the same time)
+def install_remote_file(ssh_user, ssh_hostname, ssh_port, *,
+                        contents, remote_path, stderr, transport='ssh'):
+
+    import subprocess
+
+    ssh = subprocess.Popen(get_remote_args(
+        ssh_user, ssh_hostname, ssh_port,
+        'test -f {path} || {{ mkdir -p {dir} && cat > {path}.$$.tmp'
+        ' && mv {path}.$$.tmp {path}; }}'.format(
+            path=remote_path, dir=os.path.dirname(remote_path)),
+        transport=transport), stdin=subprocess.PIPE, stderr=stderr)
+
+    ssh.communicate(contents)
+
+    if ssh.returncode != 0:
+        sys.exit(ssh.returncode)
+
+
+# Retrieve the transport used to reach the remote: ssh (the default), or
+# local if the site is hosted on this machine (e.g. in a container whose
+# files and database are reachable from it)
+def get_transport(config):
+
+    if config.has_option('ssh', 'transport'):
+        transport = config.get('ssh', 'transport')
+    else:
+        transport = 'ssh'
+
+    if transport not in ('ssh', 'local'):
+        raise OSError('Unknown transport {}. Aborting.'.format(transport))
+
+    return transport
+
+
+# Construct the arguments which run the given command (whose arguments are
+# joined by spaces and interpreted by a shell) on the remote, either via
+# SSH or via a local shell run from the home directory
+def get_remote_args(ssh_user, ssh_hostname, ssh_port, *command_args,
+                    transport='ssh'):
+
+    if transport == 'local':
+        return ['sh', '-c', ' '.join(('cd &&',) + command_args)]
 
-    # Read remote script so as to pass contents to SSH session
-    with open(remote_driver_path, 'r') as remote_script:
+    return [
+        'ssh',
+        '-p {}'.format(ssh_port),
+        '{}@{}'.format(ssh_user, ssh_hostname)
+    ] + list(command_args)
 
-        action_args = [quote_arg(arg) for arg in action_args]
 
-        # Construct Popen args by combining both lists of command arguments
-        ssh_args = [
-            'ssh',
-            '-p {}'.format(ssh_port),
-            '{}@{}'.format(ssh_user, ssh_hostname),
-            'python3',
-            '-',
-            action  # The action to run on remote
-        ] + action_args
+# Pass the given lines of the remote's stderr through to the given file,
+# except for progress reports, which are passed to the given function
+def relay_stderr(input_stream, output_file, *, read_progress):
 
+    import json
+
+    if output_file is None:
+        output_file = sys.stderr
+
+    for line in iter(input_stream.readline, b''):
+        if line.startswith(progress_prefix):
+            read_progress(json.loads(
+                line[len(progress_prefix):].decode('utf-8')))
+        else:
+            output_file.write(line.decode('utf-8', 'replace'))
+            output_file.flush()
+
+
+# Run the given SSH command, returning its exit status and its output (if
+# it was requested)
+def run_ssh(ssh_args, *, stdin, stdout, stderr, read_output=None,
+            read_progress=None):
+
+    import subprocess
+    import threading
+
+    # Separate the progress reported by the remote (if it was requested)
+    # from the rest of its output
+    if read_progress:
         ssh = subprocess.Popen(
-            ssh_args, stdin=remote_script, stdout=stdout, stderr=stderr)
+            ssh_args, stdin=stdin, stdout=stdout, stderr=subprocess.PIPE)
+        relay_thread = threading.Thread(
+            target=relay_stderr, args=(ssh.stderr, stderr),
+            kwargs={'read_progress': read_progress})
+        relay_thread.start()
+    else:
+        ssh = subprocess.Popen(
+            ssh_args, stdin=stdin, stdout=stdout, stderr=stderr)
+
+    # Collect the command's output if it was requested (or else pass the
+    # output stream to the given function as the command runs)
+    if stdout == subprocess.PIPE and read_output:
+        output = read_output(ssh.stdout)
+    elif stdout == subprocess.PIPE:
+        output = ssh.stdout.read()
+    else:
+        output = None
 
-        # Wait for command to finish execution
-        ssh.wait()
+    # Wait for command to finish execution
+    ssh.wait()
+    if read_progress:
+        relay_thread.join()
 
-        if ssh.returncode != 0:
-            sys.exit(ssh.returncode)
+    return ssh.returncode, output
 
 
-# Transfer a file from remote to local (or vice-versa) using SCP
+# Connect to remote via SSH and execute remote script
+def exec_on_remote(ssh_user, ssh_hostname, ssh_port, *,
+                   action, action_args, stdout, stderr, stdin=None,
+                   read_output=None, read_progress=None, transport='ssh'):
+
+    remote_script_contents, remote_script_path = read_remote_script()
+
+    # If the action needs its own input stream (e.g. a backup being
+    # restored), make sure the remote script is cached beforehand, since a
+    # cache miss cannot be retried once the stream has been consumed
+    if stdin is not None:
+        install_remote_script(
+            ssh_user, ssh_hostname, ssh_port,
+            remote_script_contents=remote_script_contents,
+            remote_script_path=remote_script_path,
+            stderr=stderr, transport=transport)
+
+    action_args = [quote_arg(arg) for arg in action_args]
+
+    # Run the cached remote script, or signal that it is not yet cached
+    ssh_args = get_remote_args(
+        ssh_user, ssh_hostname, ssh_port,
+        'test -f {path} || exit {status}; exec python3 {path}'.format(
+            path=remote_script_path, status=cache_miss_status),
+        action,  # The action to run on remote
+        *action_args, transport=transport)
+
+    returncode, output = run_ssh(
+        ssh_args, stdin=stdin, stdout=stdout, stderr=stderr,
+        read_output=read_output, read_progress=read_progress)
+
+    # Upload the remote script only if it is not yet cached, then try again
+    if returncode == cache_miss_status and stdin is None:
+        install_remote_script(
+            ssh_user, ssh_hostname, ssh_port,
+            remote_script_contents=remote_script_contents,
+            remote_script_path=remote_script_path,
+            stderr=stderr, transport=transport)
+        returncode, output = run_ssh(
+            ssh_args, stdin=stdin, stdout=stdout, stderr=stderr,
+            read_output=read_output, read_progress=read_progress)
+
+    if returncode != 0:
+        sys.exit(returncode)
+
+    return output
+
+
+# Transfer a file from remote to local (or vice-versa) using SCP (or, with
+# the local transport, upload it by copying it)
 def transfer_file(ssh_user, ssh_hostname, ssh_port, *,
-                  src_path, dest_path, action, stdout, stderr):
+                  src_path, dest_path, action, stdout, stderr,
+                  transport='ssh'):
 
-    scp_args = ['scp', '-P {}'.format(ssh_port)]
+    import subprocess
 
-    if action == 'upload':
+    # Remote paths are relative to the home directory
+    if transport == 'local' and action == 'upload':
+        scp_args = ['cp', src_path, os.path.join(
+            os.path.expanduser('~'), os.path.expanduser(dest_path))]
+    elif action == 'upload':
+        scp_args = ['scp', '-P {}'.format(ssh_port)]
         scp_args += [
             src_path,
             '{}@{}:{}'.format(ssh_user, ssh_hostname, quote_arg(dest_path))
         ]
     else:
         # Default action is to download file
+        scp_args = ['scp', '-P {}'.format(ssh_port)]
         scp_args += [
             '{}@{}:{}'.format(ssh_user, ssh_hostname, quote_arg(src_path)),
             dest_path
@@ -98,44 +301,366 @@ def transfer_file(ssh_user, ssh_hostname, ssh_port, *,
 
     scp.wait()
 
+    if scp.returncode != 0:
+        sys.exit(scp.returncode)
 
-# Execute remote backup script to create remote backup
+
+# Execute remote backup script to create remote backup, returning the backup
+# statistics reported by the remote
 def create_remote_backup(ssh_user, ssh_hostname, ssh_port, *,
                          wordpress_path, remote_backup_path,
-                         backup_compressor, stdout, stderr):
+                         backup_compressor, backup_options, stdout, stderr,
+                         basis_checksum=None, read_progress=None,
+                         transport='ssh'):
+
+    import json
+    import subprocess
+
+    # Request a delta against the given basis (which may be empty) instead
+    # of a full backup if delta transfers are enabled
+    if basis_checksum is None:
+        action = 'back-up'
+        action_args = [wordpress_path, backup_compressor, remote_backup_path]
+    else:
+        action = 'back-up-delta'
+        action_args = [wordpress_path, backup_compressor, remote_backup_path,
+                       basis_checksum]
 
-    exec_on_remote(
+    # stdout is reserved for the backup statistics reported by the remote
+    output = exec_on_remote(
         ssh_user=ssh_user,
         ssh_hostname=ssh_hostname,
         ssh_port=ssh_port,
-        action='back-up',
-        action_args=[
-            wordpress_path,
-            backup_compressor,
-            remote_backup_path
-        ],
-        stdout=stdout, stderr=stderr)
+        action=action,
+        action_args=action_args + [json.dumps(backup_options)],
+        stdout=subprocess.PIPE, stderr=stderr, read_progress=read_progress,
+        transport=transport)
+
+    return json.loads(output.decode('utf-8'))
+
+
+# Write chunks from the given queue to the given file until the end of the
+# stream is reached, recording (rather than raising) any error
+def write_chunks(chunk_queue, output_file, errors):
+
+    for chunk in iter(chunk_queue.get, None):
+        # Keep draining the queue after an error so the reader never blocks
+        if errors:
+            continue
+        try:
+            output_file.write(chunk)
+        except (IOError, OSError) as error:
+            errors.append(error)
+
+
+# Copy the given input stream to every given output file, returning the
+# number of bytes copied and their SHA-256 checksum; a single output is
+# written from one fixed-size buffer as it is hashed, while several outputs
+# are written concurrently (the slowest setting the pace, since each has a
+# bounded queue of chunks); if a dictionary is given, the errors of the
+# outputs are recorded in it (by index) rather than raised, and the copy
+# carries on to the other outputs
+def tee_stream(input_stream, output_files, *, output_errors=None):
+
+    import hashlib
+
+    if len(output_files) != 1:
+        return tee_stream_concurrently(
+            input_stream, output_files, output_errors=output_errors)
+
+    checksum = hashlib.sha256()
+    num_bytes = 0
+    buffer = bytearray(copy_buffer_size)
+    buffer_view = memoryview(buffer)
+    try:
+        for num_read in iter(lambda: input_stream.readinto(buffer), 0):
+            checksum.update(buffer_view[:num_read])
+            output_files[0].write(buffer_view[:num_read])
+            num_bytes += num_read
+    except (IOError, OSError) as error:
+        if output_errors is None:
+            raise
+        output_errors[0] = error
+
+    return num_bytes, checksum.hexdigest()
+
+
+# Start a thread writing the chunks put on its own (bounded) queue to each of
+# the given output files, returning the queues, the threads, and the lists
+# recording the errors of each output
+def start_chunk_writers(output_files):
+
+    import queue
+    import threading
+
+    errors = [[] for output_file in output_files]
+    chunk_queues = [queue.Queue(maxsize=16) for output_file in output_files]
+    writers = [
+        threading.Thread(
+            target=write_chunks, args=(chunk_queue, output_file, file_errors))
+        for chunk_queue, output_file, file_errors
+        in zip(chunk_queues, output_files, errors)]
+    for writer in writers:
+        writer.start()
+
+    return chunk_queues, writers, errors
+
+
+# Raise the first error of any output, or else record the errors of the
+# outputs in the given dictionary (by index) if one is given
+def raise_output_errors(errors, output_errors):
+
+    for index, file_errors in enumerate(errors):
+        if file_errors and output_errors is None:
+            raise file_errors[0]
+        if file_errors:
+            output_errors[index] = file_errors[0]
+
+
+# Copy the given input stream to the given output files concurrently (see
+# tee_stream), until every output has failed if their errors are recorded,
+# or else until any output fails
+def tee_stream_concurrently(input_stream, output_files, *,
+                            output_errors=None):
+
+    import hashlib
+
+    checksum = hashlib.sha256()
+    num_bytes = 0
+    chunk_queues, writers, errors = start_chunk_writers(output_files)
+
+    stop_copy = all if output_errors is not None else any
+    for chunk in iter(lambda: input_stream.read(copy_buffer_size), b''):
+        if errors and stop_copy(errors):
+            break
+        checksum.update(chunk)
+        num_bytes += len(chunk)
+        for chunk_queue in chunk_queues:
+            chunk_queue.put(chunk)
+
+    for chunk_queue in chunk_queues:
+        chunk_queue.put(None)
+    for writer in writers:
+        writer.join()
+
+    raise_output_errors(errors, output_errors)
+
+    return num_bytes, checksum.hexdigest()
+
+
+# Retrieve the path of the temporary file to which the file at the given
+# path is written before being moved into place
+def get_temp_path(path):
+
+    return os.path.join(os.path.dirname(path), '.{}.{}.part'.format(
+        os.path.basename(path), os.getpid()))
+
+
+# Retrieve the path of the file which the given temporary file is written
+# for (or None if the given path is not that of a temporary file)
+def get_temp_target_path(temp_path):
+
+    import re
+
+    match = re.search(r'^\.(.+)\.\d+\.part$', os.path.basename(temp_path))
+    if match:
+        return os.path.join(os.path.dirname(temp_path), match.group(1))
+    else:
+        return None
+
+
+# Open a temporary file alongside the given path for writing; the file is
+# buffered, since an unbuffered file may write less than it is given (e.g.
+# when the disk is full) whereas a buffered one writes everything or raises
+# an error (large chunks are still written without being copied)
+def open_temp_file(path):
+
+    return open(get_temp_path(path), 'wb')
+
+
+# Flush the given temporary file to disk, then atomically move it into place
+# at the given path (so the file there is never partially written)
+def commit_temp_file(temp_file, path):
+
+    temp_file.flush()
+    os.fsync(temp_file.fileno())
+    temp_file.close()
+    os.replace(temp_file.name, path)
+
+
+# Remove the given temporary file (if it was not moved into place)
+def discard_temp_file(temp_file):
+
+    # Writing out what is left in the buffer may fail (e.g. if the disk is
+    # full), which makes no difference to a file being removed
+    try:
+        temp_file.close()
+    except OSError:
+        pass
+    try:
+        os.remove(temp_file.name)
+    except OSError:
+        pass
+
+
+# Open the given replica for writing, returning the file to write to and the
+# process receiving the backup (if the replica is a command)
+def open_replica(replica, *, stdout, stderr):
+
+    import subprocess
+
+    if 'command' in replica:
+        process = subprocess.Popen(
+            replica['command'], shell=True,
+            stdin=subprocess.PIPE, stdout=stdout, stderr=stderr)
+        return process.stdin, process
+    else:
+        create_dir_structure(replica['path'])
+        return open_temp_file(replica['path']), None
+
+
+# Open the given replicas for writing, returning the replica, the file to
+# write to and the process receiving the backup (if any) of each, along with
+# the names of the replicas which could not be opened (since replicas are
+# secondary to the local backup, they never stop it from being made)
+def open_replicas(replicas, *, stdout, stderr):
+
+    replica_outputs = []
+    failed_replicas = []
+    for replica in replicas:
+        try:
+            output_file, process = open_replica(
+                replica, stdout=stdout, stderr=stderr)
+        except (IOError, OSError):
+            failed_replicas.append(replica['name'])
+            continue
+        replica_outputs.append((replica, output_file, process))
+
+    return replica_outputs, failed_replicas
+
+
+# Finish writing the backup to the given replicas (as opened by
+# open_replicas), keeping only the complete copies: those of a successful
+# copy, except the ones at the given failed indexes; returns the names of
+# the replicas which failed (if the copy itself succeeded)
+def close_replicas(replica_outputs, failed_indexes, *, succeeded):
+
+    failed_replicas = []
+    for index, (replica, output_file, process) in enumerate(replica_outputs):
+        completed = succeeded and index not in failed_indexes
+        if process:
+            completed = close_replica_process(
+                output_file, process, completed=completed)
+        else:
+            completed = close_replica_file(
+                output_file, replica['path'], completed=completed)
+        if succeeded and not completed:
+            failed_replicas.append(replica['name'])
+
+    return failed_replicas
+
+
+# Close the input of the given replica command, returning whether it stored
+# the backup; closing its input signals the end of the backup, so the
+# command of an incomplete copy is killed (and reaped) first, lest it store
+# the partial backup as a whole one
+def close_replica_process(input_file, process, *, completed):
+
+    if not completed:
+        process.kill()
+        process.wait()
+    try:
+        input_file.close()
+    except BrokenPipeError:
+        completed = False
+    process.wait()
+
+    return completed and process.returncode == 0
+
+
+# Move the given temporary file of a replica into place at the given path if
+# the copy is complete (or else discard it), returning whether it was moved
+def close_replica_file(temp_file, path, *, completed):
+
+    try:
+        if completed:
+            commit_temp_file(temp_file, path)
+    except (IOError, OSError):
+        completed = False
+    finally:
+        discard_temp_file(temp_file)
+
+    return completed
 
 
-# Download remote backup to local system
+# Download remote backup to local system, writing it to the local backup
+# path and to every replica in a single pass; returns the size and checksum
+# of the backup, along with the names of the replicas which failed
 def download_remote_backup(ssh_user, ssh_hostname, ssh_port, *,
                            remote_backup_path, local_backup_path,
-                           stdout, stderr):
+                           stdout, stderr, replicas=(), expected_size=None,
+                           transport='ssh'):
+
+    import subprocess
+
+    ssh = subprocess.Popen(get_remote_args(
+        ssh_user, ssh_hostname, ssh_port,
+        'cat', quote_arg(remote_backup_path),
+        transport=transport), stdout=subprocess.PIPE, stderr=stderr)
+
+    # Write the backup (and replicas stored as files) to temporary files,
+    # only moving them into place once the download has completed; a failed
+    # replica never stops the download (or discards the backup)
+    temp_file = open_temp_file(local_backup_path)
+    replica_outputs, failed_replicas = open_replicas(
+        replicas, stdout=stdout, stderr=stderr)
+    output_errors = {}
+    succeeded = False
+    try:
+        num_bytes, checksum = tee_stream(ssh.stdout, [temp_file] + [
+            output_file for replica, output_file, process in replica_outputs
+        ], output_errors=output_errors)
+        # The rest of the backup is not needed if it cannot be written out
+        if 0 in output_errors:
+            ssh.kill()
+            ssh.wait()
+            raise output_errors[0]
+        ssh.wait()
+        if ssh.returncode == 0:
+            verify_download_size(
+                temp_file, num_bytes, expected_size=expected_size)
+            commit_temp_file(temp_file, local_backup_path)
+            succeeded = True
+    finally:
+        discard_temp_file(temp_file)
+        failed_replicas += close_replicas(
+            replica_outputs, {index - 1 for index in output_errors},
+            succeeded=succeeded)
 
-    transfer_file(
-        ssh_user=ssh_user,
-        ssh_hostname=ssh_hostname,
-        ssh_port=ssh_port,
-        src_path=remote_backup_path,
-        dest_path=local_backup_path,
-        action='download',
-        stdout=stdout, stderr=stderr)
+    if ssh.returncode != 0:
+        sys.exit(ssh.returncode)
+
+    return {'backup_size': num_bytes, 'checksum': checksum,
+            'failed_replicas': failed_replicas}
+
+
+# Verify that the whole backup reported by the remote was received, and
+# written out to the given temporary file
+def verify_download_size(temp_file, num_bytes, *, expected_size):
+
+    if expected_size is not None and num_bytes != expected_size:
+        raise OSError('Backup is corrupted (expected {} bytes but'
+                      ' received {}). Aborting.'.format(
+                          expected_size, num_bytes))
+    if temp_file.tell() != num_bytes:
+        raise OSError('Backup could not be written to {}. Aborting.'.format(
+            temp_file.name))
 
 
 # Uploads the given local backup to the given remote destination
 def upload_local_backup(ssh_user, ssh_hostname, ssh_port, *,
                         local_backup_path, remote_backup_path,
-                        stdout, stderr):
+                        stdout, stderr, transport='ssh'):
 
     transfer_file(
         ssh_user=ssh_user,
@@ -144,13 +669,16 @@ def upload_local_backup(ssh_user, ssh_hostname, ssh_port, *,
         src_path=local_backup_path,
         dest_path=remote_backup_path,
         action='upload',
-        stdout=stdout, stderr=stderr)
+        stdout=stdout, stderr=stderr, transport=transport)
 
 
 # Restores the local backup after upload to remote
 def restore_remote_backup(ssh_user, ssh_hostname, ssh_port, *,
                           wordpress_path, remote_backup_path,
-                          backup_decompressor, stdout, stderr):
+                          backup_decompressor, backup_checksum, staging_db,
+                          stdout, stderr, backup_blocks='',
+                          defer_indexes=False, direct_load=False,
+                          transport='ssh'):
 
     exec_on_remote(
         ssh_user=ssh_user,
@@ -160,14 +688,61 @@ def restore_remote_backup(ssh_user, ssh_hostname, ssh_port, *,
         action_args=[
             wordpress_path,
             remote_backup_path,
-            backup_decompressor
+            backup_decompressor,
+            backup_checksum,
+            staging_db,
+            backup_blocks,
+            'true' if defer_indexes else '',
+            'true' if direct_load else ''
         ],
-        stdout=stdout, stderr=stderr)
+        stdout=stdout, stderr=stderr, transport=transport)
+
+
+# Pipe the given local backup over SSH and restore it without uploading it
+def stream_local_backup(ssh_user, ssh_hostname, ssh_port, *,
+                        wordpress_path, local_backup_path,
+                        backup_decompressor, backup_checksum, staging_db,
+                        stdout, stderr, encryption_identity=None,
+                        backup_blocks='', defer_indexes=False,
+                        transport='ssh'):
+
+    import subprocess
+
+    with open(local_backup_path, 'rb') as local_backup:
+
+        # Decrypt encrypted backups locally as they are streamed, so the
+        # private key never leaves the local system
+        if encryption_identity:
+            decryptor = subprocess.Popen(
+                ['age', '-d', '-i', encryption_identity],
+                stdin=local_backup, stdout=subprocess.PIPE)
+            local_backup = decryptor.stdout
+
+        exec_on_remote(
+            ssh_user=ssh_user,
+            ssh_hostname=ssh_hostname,
+            ssh_port=ssh_port,
+            action='restore-stream',
+            action_args=[
+                wordpress_path,
+                backup_decompressor,
+                backup_checksum,
+                staging_db,
+                backup_blocks,
+                'true' if defer_indexes else ''
+            ],
+            stdin=local_backup,
+            stdout=stdout, stderr=stderr, transport=transport)
+
+        if encryption_identity:
+            decryptor.wait()
+            if decryptor.returncode != 0:
+                sys.exit(decryptor.returncode)
 
 
 # Forcefully remove backup from remote
 def purge_remote_backup(ssh_user, ssh_hostname, ssh_port, *,
-                        remote_backup_path, stdout, stderr):
+                        remote_backup_path, stdout, stderr, transport='ssh'):
 
     exec_on_remote(
         ssh_user=ssh_user,
@@ -175,7 +750,305 @@ def purge_remote_backup(ssh_user, ssh_hostname, ssh_port, *,
         ssh_port=ssh_port,
         action='purge-backup',
         action_args=[remote_backup_path],
-        stdout=stdout, stderr=stderr)
+        stdout=stdout, stderr=stderr, transport=transport)
+
+
+# Compute the SHA-256 checksum of the file at the given path
+def get_file_checksum(path):
+
+    import hashlib
+
+    checksum = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(65536), b''):
+            checksum.update(chunk)
+
+    return checksum.hexdigest()
+
+
+# Retrieve the path to the manifest describing the given local backup
+def get_manifest_path(local_backup_path):
+
+    return '{}.json'.format(local_backup_path)
+
+
+# Write the manifest describing the given local backup alongside it
+def write_backup_manifest(local_backup_path, manifest):
+
+    import json
+
+    manifest_path = get_manifest_path(local_backup_path)
+    manifest_file = open_temp_file(manifest_path)
+    try:
+        manifest_file.write(json.dumps(
+            manifest, indent=2, sort_keys=True).encode('utf-8'))
+        commit_temp_file(manifest_file, manifest_path)
+    finally:
+        discard_temp_file(manifest_file)
+
+
+# Read the manifest describing the given local backup (if it has one)
+def read_backup_manifest(local_backup_path):
+
+    import json
+
+    try:
+        with open(get_manifest_path(local_backup_path), 'r') as manifest_file:
+            return json.load(manifest_file)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+# Retrieve the decompressor for the given backup, preferring the one recorded
+# in its manifest (i.e. if its compressor was chosen automatically), along
+# with the dictionary the backup was compressed with (if any), as stored on
+# the remote or else locally
+def get_backup_decompressor(config, local_backup_path, *, remote=False):
+
+    manifest = read_backup_manifest(local_backup_path)
+    if 'decompressor' in manifest:
+        backup_decompressor = manifest['decompressor']
+    else:
+        backup_decompressor = config.get('backup', 'decompressor')
+
+    if 'dictionary_id' in manifest:
+        backup_decompressor = add_dictionary_option(
+            backup_decompressor, get_dictionary_path(
+                config, manifest['dictionary_id'], remote=remote))
+
+    return backup_decompressor
+
+
+# Retrieve the compressor for new backups, along with the configured
+# dictionary (if any), as stored on the remote or else locally
+def get_backup_compressor(config, *, remote=False):
+
+    backup_compressor = config.get('backup', 'compressor')
+
+    if config.has_option('backup', 'dictionary_id'):
+        backup_compressor = add_dictionary_option(
+            backup_compressor, get_dictionary_path(
+                config, config.getint('backup', 'dictionary_id'),
+                remote=remote))
+
+    return backup_compressor
+
+
+# Append the option selecting the given dictionary to the given zstd command
+def add_dictionary_option(command, dictionary_path):
+
+    import shlex
+
+    if shlex.split(command)[0] != 'zstd':
+        raise OSError('Compression dictionaries require zstd. Aborting.')
+
+    return '{} -D {}'.format(command, shlex.quote(dictionary_path))
+
+
+# Retrieve the local directory in which trained dictionaries are stored
+def get_dictionary_dir(config):
+
+    if config.has_option('paths', 'dictionaries'):
+        dictionary_dir = config.get('paths', 'dictionaries')
+    else:
+        dictionary_dir = default_dictionary_dir
+
+    return os.path.expanduser(dictionary_dir)
+
+
+# Retrieve the path to the dictionary with the given ID, as stored on the
+# remote or else locally
+def get_dictionary_path(config, dictionary_id, *, remote=False):
+
+    if remote:
+        dictionary_dir = remote_dictionary_dir
+    else:
+        dictionary_dir = get_dictionary_dir(config)
+
+    return os.path.join(dictionary_dir, '{}.zdict'.format(dictionary_id))
+
+
+# Read the ID which zstd embeds in the header of the given dictionary
+def get_dictionary_id(dictionary_path):
+
+    with open(dictionary_path, 'rb') as dictionary_file:
+        header = dictionary_file.read(8)
+
+    if header[:4] != b'\x37\xa4\x30\xec':
+        raise OSError('{} is not a zstd dictionary. Aborting.'.format(
+            dictionary_path))
+
+    return int.from_bytes(header[4:8], 'little')
+
+
+# Upload the dictionary with the given ID to the remote (if it is not
+# already cached there)
+def install_remote_dictionary(config, dictionary_id, *, stderr):
+
+    with open(get_dictionary_path(config, dictionary_id), 'rb') as (
+            dictionary_file):
+        install_remote_file(
+            config.get('ssh', 'user'),
+            config.get('ssh', 'hostname'),
+            config.get('ssh', 'port'),
+            contents=dictionary_file.read(),
+            remote_path=get_dictionary_path(
+                config, dictionary_id, remote=True),
+            stderr=stderr, transport=get_transport(config))
+
+
+# Train a zstd dictionary on the start of the latest local backups of the
+# given sites (which share the WordPress schema and much boilerplate),
+# storing it under its ID; returns the ID
+def train_dictionary(configs, *, stderr=None):
+
+    import shlex
+    import subprocess
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        sample_paths = []
+        for config in configs:
+            backup_paths = get_local_backups(os.path.expanduser(
+                config.get('paths', 'local_backup')))
+            for backup_path in backup_paths[-dictionary_training_backups:]:
+                if read_backup_manifest(backup_path).get('encrypted'):
+                    continue
+                with open(backup_path, 'rb') as backup_file:
+                    decompressor = subprocess.Popen(
+                        shlex.split(get_backup_decompressor(
+                            config, backup_path)),
+                        stdin=backup_file, stdout=subprocess.PIPE,
+                        stderr=stderr)
+                    sample = decompressor.stdout.read(dictionary_sample_size)
+                    # The decompressor is cut off once the sample is read
+                    decompressor.stdout.close()
+                    decompressor.wait()
+                if not sample:
+                    raise OSError('Backup {} could not be decompressed.'
+                                  ' Aborting.'.format(backup_path))
+                sample_path = os.path.join(
+                    temp_dir, '{}.sql'.format(len(sample_paths)))
+                with open(sample_path, 'wb') as sample_file:
+                    sample_file.write(sample)
+                sample_paths.append(sample_path)
+
+        if not sample_paths:
+            raise OSError('No local backups to train a dictionary on.'
+                          ' Aborting.')
+
+        # Split the samples into blocks, since zstd trains on many small
+        # samples (like the blocks of a dump it compresses) best
+        trained_path = os.path.join(temp_dir, 'trained.zdict')
+        trainer = subprocess.Popen(
+            ['zstd', '--train', '-q', '-B{}'.format(128 * 1024)] +
+            sample_paths + ['-o', trained_path], stderr=stderr)
+        trainer.wait()
+        if trainer.returncode != 0:
+            raise OSError('Dictionary could not be trained. Aborting.')
+
+        dictionary_id = get_dictionary_id(trained_path)
+        dictionary_path = get_dictionary_path(configs[0], dictionary_id)
+        create_dir_structure(local_backup_path=dictionary_path)
+        with open(trained_path, 'rb') as trained_file:
+            temp_file = open_temp_file(dictionary_path)
+            try:
+                temp_file.write(trained_file.read())
+                commit_temp_file(temp_file, dictionary_path)
+            finally:
+                discard_temp_file(temp_file)
+
+    return dictionary_id
+
+
+# Retrieve the link bandwidth (in bytes per second) between the remote and
+# local systems, as configured or as measured by the latest download
+def get_link_bandwidth(config):
+
+    if config.has_option('backup', 'link_bandwidth'):
+        return config.getint('backup', 'link_bandwidth')
+
+    history = open_history(get_history_path(config))
+    latest_download = history.execute(
+        'SELECT backup_size, transfer_duration FROM runs'
+        ' WHERE site = ? AND action = ? AND succeeded'
+        ' AND transfer_duration > 0 ORDER BY started DESC LIMIT 1',
+        (get_site_name(config), 'back-up')).fetchone()
+    history.close()
+
+    if latest_download:
+        return int(latest_download[0] / latest_download[1])
+    else:
+        return None
+
+
+# Retrieve the options governing how the remote chooses the codec of an
+# automatically compressed backup
+def get_auto_codec_options(config):
+
+    codec_options = {}
+    if config.has_option('backup', 'auto_sample_size'):
+        codec_options['sample_size'] = int(1024 * 1024 * config.getfloat(
+            'backup', 'auto_sample_size'))
+    if config.has_option('backup', 'auto_objective'):
+        codec_options['objective'] = config.get('backup', 'auto_objective')
+    codec_options['link_bandwidth'] = get_link_bandwidth(config)
+
+    return codec_options
+
+
+# Retrieve the options selecting the tables (and rows) the remote dumps, by
+# globs matched without the table prefix
+def get_table_options(config):
+
+    table_options = {}
+    for option_name in ('include_tables', 'exclude_tables',
+                        'schema_only_tables'):
+        if config.has_option('backup', option_name):
+            table_options[option_name] = config.get(
+                'backup', option_name).split()
+    # Options inherited from the DEFAULT section are not table filters
+    if config.has_section('table_filters'):
+        table_options['table_filters'] = {
+            table_glob: where
+            for table_glob, where in config.items('table_filters')
+            if table_glob not in config.defaults()}
+
+    return table_options
+
+
+# Retrieve the options governing how the remote creates the backup
+def get_backup_options(config):
+
+    backup_options = {}
+    if config.get('backup', 'compressor') == 'auto':
+        backup_options.update(get_auto_codec_options(config))
+    if config.has_option('backup', 'encryption_recipient'):
+        backup_options['encryption_recipient'] = config.get(
+            'backup', 'encryption_recipient')
+    if config.has_option('backup', 'archive_block_size'):
+        backup_options['block_size'] = int(1024 * 1024 * config.getfloat(
+            'backup', 'archive_block_size'))
+    if config.has_option('backup', 'record_binlog'):
+        backup_options['binlog'] = config.getboolean(
+            'backup', 'record_binlog')
+    if config.has_option('backup', 'host_workers'):
+        backup_options['host_workers'] = config.getint(
+            'backup', 'host_workers')
+
+    backup_options.update(get_table_options(config))
+
+    # Tables left out of (or dumped outside) the consistent snapshot do not
+    # match the recorded binlog position, so replaying binlog events on top
+    # of them would fail or apply changes twice
+    if backup_options.get('binlog') and any(
+            option_name in backup_options for option_name in (
+                'include_tables', 'exclude_tables', 'schema_only_tables',
+                'table_filters')):
+        raise OSError('Binlog positions cannot be recorded for backups of'
+                      ' selected tables. Aborting.')
+
+    return backup_options
 
 
 # Retrieve a file's last modified time in seconds
@@ -184,43 +1057,535 @@ def get_last_modified_time(path):
     return os.stat(path).st_mtime
 
 
-# Purge empty directories originally created to store now-purged backups
-def purge_empty_dirs(dir_path):
+# Retrieve the local backups matching the given path (which may include date
+# format sequences), sorted from oldest to newest
+def get_local_backups(local_backup_path):
+
+    import glob
+    import re
 
-    while dir_path != '/':
+    # Convert date format sequences (and site labels) to wildcards
+    local_backup_path = re.sub(
+        r'%\-?[A-Za-z]|\{site\}', '*', local_backup_path)
+
+    return sorted(glob.iglob(local_backup_path), key=get_last_modified_time)
+
+
+# Compile a regular expression matching the paths expanded from the given
+# path pattern, returning it along with the date format sequences captured by
+# its groups (the site label of a fleet backup is captured as None)
+def compile_path_pattern(path_pattern):
+
+    import re
+
+    regex_parts = []
+    directives = []
+    for part in re.split(r'(%\-?[A-Za-z]|\{site\})', path_pattern):
+        if part == '{site}':
+            regex_parts.append(r'([^/]+)')
+            directives.append(None)
+        elif re.search(r'^%\-?[A-Za-z]$', part):
+            # Sequences such as %-d are not zero-padded
+            if '-' in part:
+                value_regex = r'\d+'
+            else:
+                value_regex = date_format_regexes.get(part[1], r'[^/]+?')
+            regex_parts.append('({})'.format(value_regex))
+            directives.append(part.replace('-', ''))
+        else:
+            regex_parts.append(re.escape(part))
+
+    return re.compile('^{}$'.format(''.join(regex_parts))), directives
+
+
+# Retrieve the time at which the given backup was made, as parsed from the
+# date format sequences in its path (or else its last modified time)
+def get_backup_time(backup_path, path_match, directives):
+
+    values = [value for value, directive
+              in zip(path_match.groups(), directives) if directive]
+    if values:
+        try:
+            return time.mktime(time.strptime(
+                ' '.join(values),
+                ' '.join(directive for directive in directives
+                         if directive)))
+        except (ValueError, OverflowError):
+            pass
+
+    return get_last_modified_time(backup_path)
+
+
+# Retrieve the deepest directory in the given path pattern which contains no
+# date format sequences or site labels (and so is the same for every backup)
+def get_static_root(path_pattern):
+
+    return os.path.dirname(path_pattern.split('%')[0].split('{site}')[0])
+
+
+# Scan the given directory (down to the given depth) once, returning the
+# paths of the files and the directories within it
+def scan_dir(dir_path, max_depth):
+
+    file_paths = []
+    dir_paths = []
+    dirs_to_scan = [(dir_path, 1)]
+    while dirs_to_scan:
+        dir_path, depth = dirs_to_scan.pop()
+        try:
+            entries = os.scandir(dir_path)
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    dir_paths.append(entry.path)
+                    if depth < max_depth:
+                        dirs_to_scan.append((entry.path, depth + 1))
+                else:
+                    file_paths.append(entry.path)
+
+    return file_paths, dir_paths
+
+
+# Retrieve the retention policies (the backup path patterns and the number of
+# backups to keep for each) configured for the given sites
+def get_retention_policies(configs):
+
+    policies = []
+    for config in configs:
+        if config.has_option('backup', 'max_local_backups'):
+            policies.append({
+                'path_pattern': os.path.expanduser(
+                    config.get('paths', 'local_backup')),
+                'max_backups': config.getint('backup', 'max_local_backups')
+            })
+        for replica in get_replicas(config):
+            if 'path' in replica and 'max_backups' in replica:
+                policies.append({
+                    'path_pattern': replica['path_pattern'],
+                    'max_backups': replica['max_backups']
+                })
+
+    return policies
+
+
+# Scan the backup directories of the given retention policies in parallel
+# (since each directory listing waits on the file system, e.g. over NFS),
+# returning the scan of each directory by its path
+def scan_policy_dirs(policies):
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    scan_depths = {}
+    for policy in policies:
+        root = get_static_root(policy['path_pattern'])
+        scan_depths[root] = max(
+            scan_depths.get(root, 0),
+            policy['path_pattern'][len(root):].count(os.sep))
+    with ThreadPoolExecutor(max_workers=retention_workers) as executor:
+        return dict(zip(scan_depths, executor.map(
+            scan_dir, scan_depths, scan_depths.values())))
+
+
+# Determine if the given temporary file was left behind long ago (i.e. by an
+# interrupted run) while writing a backup (or manifest) matching the given
+# path regex
+def is_stale_temp_file(temp_path, temp_target_path, path_regex):
+
+    if temp_target_path.endswith('.json'):
+        temp_target_path = temp_target_path[:-len('.json')]
+
+    return bool(path_regex.search(temp_target_path)) and (
+        time.time() - get_last_modified_time(temp_path) >
+        stale_temp_file_age)
+
+
+# Retrieve the paths of the backups (and their manifests) among the given
+# scanned files which exceed the limit of the given retention policy, along
+# with any stale temporary files
+def get_policy_purge_paths(policy, file_paths):
+
+    path_regex, directives = compile_path_pattern(policy['path_pattern'])
+    paths_to_purge = []
+    # The backups of each site of a fleet backup are counted separately
+    site_backups = {}
+    for file_path in file_paths:
+        # Temporary files are never counted as backups, and are only purged
+        # once stale
+        temp_target_path = get_temp_target_path(file_path)
+        if temp_target_path:
+            if is_stale_temp_file(file_path, temp_target_path, path_regex):
+                paths_to_purge.append(file_path)
+            continue
+        path_match = path_regex.search(file_path)
+        if path_match:
+            site = tuple(
+                value for value, directive
+                in zip(path_match.groups(), directives) if not directive)
+            site_backups.setdefault(site, []).append((get_backup_time(
+                file_path, path_match, directives), file_path))
+
+    file_paths = set(file_paths)
+    for backups in site_backups.values():
+        backups.sort()
+        for backup_time, backup_path in backups[:-policy['max_backups']]:
+            paths_to_purge.append(backup_path)
+            if get_manifest_path(backup_path) in file_paths:
+                paths_to_purge.append(get_manifest_path(backup_path))
+
+    return paths_to_purge
+
+
+# Retrieve the regexes matching the timestamped directories of the given
+# backup path pattern (the only directories which may be purged once empty)
+def get_timestamped_dir_regexes(path_pattern):
+
+    dir_regexes = []
+    dir_path = os.path.dirname(path_pattern)
+    while '%' in dir_path:
+        dir_regexes.append(compile_path_pattern(dir_path)[0])
         dir_path = os.path.dirname(dir_path)
-        dir_name = os.path.basename(dir_path)
-        # If next parent directory represents a timestamped directory
-        if '*' in dir_name:
-            expanded_dir_paths = glob.iglob(dir_path)
-            # Purge all empty timestamped directories
-            for expanded_dir_path in expanded_dir_paths:
-                try:
-                    os.rmdir(expanded_dir_path)
-                except OSError:
-                    pass
 
+    return dir_regexes
+
+
+# Purge the given scanned directories which match any of the given regexes
+# and are empty, from the bottom up (so that directories containing only
+# empty directories are purged too)
+def purge_empty_dirs(scans, dir_regexes):
+
+    dir_paths = sorted(
+        {dir_path for file_paths, dir_paths in scans.values()
+         for dir_path in dir_paths},
+        key=lambda dir_path: dir_path.count(os.sep), reverse=True)
+    for dir_path in dir_paths:
+        if any(dir_regex.search(dir_path) for dir_regex in dir_regexes):
+            try:
+                os.rmdir(dir_path)
+            except OSError:
+                pass
+
+
+# Purge the oldest backups to keep the number of backups within the limit of
+# every given retention policy, scanning each backup directory only once (no
+# matter how many sites share it), then purge the timestamped directories
+# left empty
+def purge_oldest_backups(policies):
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    scans = scan_policy_dirs(policies)
+
+    paths_to_purge = []
+    dir_regexes = []
+    for policy in policies:
+        file_paths, dir_paths = scans[get_static_root(policy['path_pattern'])]
+        paths_to_purge.extend(get_policy_purge_paths(policy, file_paths))
+        dir_regexes.extend(
+            get_timestamped_dir_regexes(policy['path_pattern']))
+
+    with ThreadPoolExecutor(max_workers=retention_workers) as executor:
+        list(executor.map(os.remove, set(paths_to_purge)))
+
+    purge_empty_dirs(scans, dir_regexes)
+
+
+# Retrieve the newest local backup whose raw dump may be the basis of a delta
+# transfer (i.e. whose manifest records the dump's checksum), along with the
+# checksum
+def get_delta_basis(local_backup_path):
+
+    for backup_path in reversed(get_local_backups(local_backup_path)):
+        manifest = read_backup_manifest(backup_path)
+        if 'raw_checksum' in manifest:
+            return backup_path, manifest['raw_checksum']
+
+    return None, ''
+
+
+# Rebuild a backup from the delta downloaded from the remote and the given
+# basis backup, compressing the rebuilt dump as it is hashed, and only moving
+# the backup into place at the given path if the dump matches the remote's
+# checksum
+def rebuild_delta_backup(delta_path, *, basis_backup_path, local_backup_path,
+                         backup_compressor, backup_decompressor,
+                         raw_checksum, stderr):
+
+    import shlex
+    import subprocess
+    import tempfile
+    import threading
+
+    # The decompressed basis is kept alongside the local backups (rather
+    # than in the system's temporary directory, which may be much smaller)
+    with tempfile.TemporaryDirectory(
+            dir=os.path.dirname(local_backup_path)) as temp_dir:
+        basis_path = os.path.join(temp_dir, 'basis.sql')
+        decompress_basis_backup(
+            basis_backup_path, basis_path,
+            backup_decompressor=backup_decompressor, stderr=stderr)
+
+        # The rebuilt dump is fed to the compressor on its own thread, while
+        # the compressed backup is written out (and hashed) on this one
+        temp_file = open_temp_file(local_backup_path)
+        try:
+            patch = subprocess.Popen([
+                'zstd', '-q', '-d', '-c', '--long=31',
+                '--patch-from={}'.format(basis_path), delta_path
+            ], stdout=subprocess.PIPE, stderr=stderr)
+            compressor = subprocess.Popen(
+                shlex.split(backup_compressor), stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE, stderr=stderr)
+            raw_stats = {}
+            feeder = threading.Thread(
+                target=feed_process,
+                args=(patch.stdout, compressor, raw_stats))
+            feeder.start()
+            try:
+                backup_size, checksum = tee_stream(
+                    compressor.stdout, [temp_file])
+            finally:
+                compressor.stdout.close()
+                feeder.join()
+                patch.stdout.close()
+                compressor.wait()
+                patch.wait()
+            if (patch.returncode != 0 or
+                    raw_stats.get('checksum') != raw_checksum):
+                raise OSError('Backup could not be rebuilt from delta.'
+                              ' Aborting.')
+            if compressor.returncode != 0:
+                raise OSError('Backup could not be compressed. Aborting.')
+            commit_temp_file(temp_file, local_backup_path)
+        finally:
+            discard_temp_file(temp_file)
+
+    return {'backup_size': backup_size, 'checksum': checksum}
+
+
+# Decompress the given basis backup of a delta to the given path
+def decompress_basis_backup(basis_backup_path, basis_path, *,
+                            backup_decompressor, stderr):
+
+    import shlex
+    import subprocess
+
+    with open(basis_backup_path, 'rb') as basis_backup:
+        with open(basis_path, 'wb') as basis_file:
+            decompressor = subprocess.Popen(
+                shlex.split(backup_decompressor),
+                stdin=basis_backup, stdout=basis_file, stderr=stderr)
+            decompressor.wait()
+    if decompressor.returncode != 0:
+        raise OSError('Basis backup could not be decompressed. Aborting.')
+
+
+# Copy the given input stream to the input of the given process (ending its
+# input afterwards), recording the number of bytes copied and their checksum
+# (or else the error which stopped the copy) in the given statistics
+def feed_process(input_stream, process, stats):
+
+    try:
+        stats['num_bytes'], stats['checksum'] = tee_stream(
+            input_stream, [process.stdin])
+    except (IOError, OSError) as error:
+        stats['error'] = error
+    finally:
+        try:
+            process.stdin.close()
+        except (IOError, OSError):
+            pass
+
+
+# Write the given local backup to every replica in a single pass, moving
+# replicas stored as files into place once they are complete; returns the
+# names of the replicas which failed
+def copy_to_replicas(local_backup_path, replicas, *, stdout, stderr):
+
+    replica_outputs, failed_replicas = open_replicas(
+        replicas, stdout=stdout, stderr=stderr)
+    output_errors = {}
+    succeeded = False
+    try:
+        with open(local_backup_path, 'rb') as backup_file:
+            tee_stream(backup_file, [
+                output_file
+                for replica, output_file, process in replica_outputs
+            ], output_errors=output_errors)
+        succeeded = True
+    finally:
+        failed_replicas += close_replicas(
+            replica_outputs, set(output_errors), succeeded=succeeded)
+
+    return failed_replicas
+
+
+# Retrieve the replicas (additional destinations) configured for backups,
+# with date format sequences expanded
+def get_replicas(config):
+
+    replicas = []
+    for section in config.sections():
+        if not section.startswith('replica:'):
+            continue
+        replica = {'name': section[len('replica:'):]}
+        if config.has_option(section, 'command'):
+            replica['command'] = time.strftime(config.get(section, 'command'))
+        else:
+            replica['path_pattern'] = os.path.expanduser(
+                config.get(section, 'path'))
+            replica['path'] = time.strftime(replica['path_pattern'])
+        if config.has_option(section, 'max_backups'):
+            replica['max_backups'] = config.getint(section, 'max_backups')
+        replicas.append(replica)
+
+    return replicas
+
+
+# Download the delta created by the remote against the given basis backup,
+# then rebuild the full backup from it; returns the size and checksum of the
+# rebuilt backup, along with the size of the delta
+def download_delta_backup(config, backup_stats, *, remote_backup_path,
+                          local_backup_path, basis_backup_path,
+                          stdout, stderr):
+
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        delta_path = os.path.join(temp_dir, 'backup.delta')
+        download_stats = download_remote_backup(
+            ssh_user=config.get('ssh', 'user'),
+            ssh_hostname=config.get('ssh', 'hostname'),
+            ssh_port=config.get('ssh', 'port'),
+            transport=get_transport(config),
+            remote_backup_path=remote_backup_path,
+            local_backup_path=delta_path,
+            expected_size=backup_stats.get('backup_size'),
+            stdout=stdout, stderr=stderr)
+        rebuild_stats = rebuild_delta_backup(
+            delta_path,
+            basis_backup_path=basis_backup_path,
+            local_backup_path=local_backup_path,
+            backup_compressor=get_backup_compressor(config),
+            backup_decompressor=get_backup_decompressor(
+                config, basis_backup_path),
+            raw_checksum=backup_stats['raw_checksum'],
+            stderr=stderr)
+
+    return dict(rebuild_stats, transfer_size=download_stats['backup_size'])
+
+
+# Estimate what fraction of a backup is done, and how many seconds remain,
+# from the given progress event (or None for each if it cannot be told)
+def get_progress_estimate(event, *, elapsed):
+
+    if event.get('done'):
+        return 1, 0
+    if not event.get('estimated_bytes') or not event.get('dumped_bytes'):
+        return None, None
+
+    # Table sizes only approximate the size of their dump
+    fraction = min(event['dumped_bytes'] / event['estimated_bytes'], 0.99)
+    return fraction, elapsed * (1 - fraction) / fraction
+
+
+# Format the given progress event of a backup as a line with a progress bar
+def format_progress(site, event, *, fraction, eta):
+
+    if fraction is None:
+        bar = '?' * progress_bar_width
+        percent = '?'
+    else:
+        filled_width = int(fraction * progress_bar_width)
+        bar = '#' * filled_width + '.' * (progress_bar_width - filled_width)
+        percent = '{:.0f}%'.format(fraction * 100)
+
+    line = '{} [{}] {} {}/{} tables, {} dumped'.format(
+        site, bar, percent, event.get('tables_done', 0),
+        event.get('tables_total', '?'),
+        format_size(event.get('dumped_bytes', 0)))
+    if event.get('compressed_bytes') is not None:
+        line += ', {} compressed'.format(
+            format_size(event['compressed_bytes']))
+    if event.get('current_table') and not event.get('done'):
+        line += ' ({})'.format(event['current_table'])
+    if eta is not None and not event.get('done'):
+        line += ', ETA {}m{:02d}s'.format(*divmod(int(eta), 60))
+
+    return line
+
+
+# Ask the remote (via the given backup options) to report its progress if a
+# style of rendering it is given, returning the function which renders it
+# (or None if no progress is reported)
+def request_progress(config, backup_options, *, style):
+
+    if not style:
+        return None
+
+    backup_options['progress'] = True
+    return create_progress_reporter(get_site_name(config), style=style)
+
+
+# Create the function which renders the progress reported by the remote
+# while backing up the given site (or the sites of a fleet backup, under
+# their labels), either as a progress bar on stderr or as JSON lines on
+# stdout (which are written even in quiet mode)
+def create_progress_reporter(site, *, style):
+
+    import json
+
+    started = {}
+
+    def report_progress(event):
+
+        event = dict(event)
+        event_site = event.pop('label', site)
+        started.setdefault(event_site, time.time())
+        fraction, eta = get_progress_estimate(
+            event, elapsed=time.time() - started[event_site])
+        if style == 'json':
+            sys.stdout.write(json.dumps(dict(
+                event, site=event_site, fraction=fraction, eta=eta)) + '\n')
+            sys.stdout.flush()
+        else:
+            sys.stderr.write('\r' + format_progress(
+                event_site, event, fraction=fraction, eta=eta))
+            if event.get('done'):
+                sys.stderr.write('\n')
+            sys.stderr.flush()
+
+    return report_progress
 
-# Purge oldest backups to keep number of backups within specified limit
-def purge_oldest_backups(local_backup_path, *, max_local_backups):
 
-    # Convert date format sequences to wildcards
-    local_backup_path = re.sub(r'%\-?[A-Za-z]', '*', local_backup_path)
+# Retrieve the path and checksum of the latest local backup, as the basis of
+# a delta transfer (only what changed since it is transferred), if delta
+# transfers are enabled; returns None for both otherwise
+def get_backup_basis(config, backup_options):
 
-    # Retrieve list of local backups sorted from oldest to newest
-    local_backups = sorted(glob.iglob(local_backup_path),
-                           key=get_last_modified_time)
-    backups_to_purge = local_backups[:-max_local_backups]
+    if not (config.has_option('backup', 'delta_transfer') and
+            config.getboolean('backup', 'delta_transfer')):
+        return None, None
 
-    for backup in backups_to_purge:
-        os.remove(backup)
+    if (config.get('backup', 'compressor') == 'auto' or
+            'encryption_recipient' in backup_options or
+            'block_size' in backup_options):
+        raise OSError('Delta transfers require a fixed compressor and'
+                      ' backups which are neither encrypted nor'
+                      ' compressed in blocks. Aborting.')
 
-    # Purge timestamped directories that are now empty
-    purge_empty_dirs(local_backup_path)
+    return get_delta_basis(config.get('paths', 'local_backup'))
 
 
-# Run backup script on remote
-def back_up(config, *, stdout=None, stderr=None):
+# Run backup script on remote, rendering the progress reported by the remote
+# in the given style (if any)
+def back_up(config, *, stdout=None, stderr=None, progress=None):
+
+    # Back up every install on the remote instead if roots are configured
+    if config.has_option('paths', 'wordpress_roots'):
+        return back_up_fleet(
+            config, stdout=stdout, stderr=stderr, progress=progress)
 
     # Expand home directory for local backup path
     config.set('paths', 'local_backup', os.path.expanduser(
@@ -232,60 +1597,1344 @@ def back_up(config, *, stdout=None, stderr=None):
     expanded_remote_backup_path = time.strftime(
         config.get('paths', 'remote_backup'))
 
-    create_remote_backup(
+    backup_options = get_backup_options(config)
+    read_progress = request_progress(config, backup_options, style=progress)
+
+    # Make sure the remote has the dictionary to compress the backup with
+    if config.has_option('backup', 'dictionary_id'):
+        if config.get('backup', 'compressor') == 'auto':
+            raise OSError('Compression dictionaries require a fixed'
+                          ' compressor. Aborting.')
+        install_remote_dictionary(
+            config, config.getint('backup', 'dictionary_id'), stderr=stderr)
+
+    basis_backup_path, basis_checksum = get_backup_basis(
+        config, backup_options)
+
+    backup_stats = create_remote_backup(
         ssh_user=config.get('ssh', 'user'),
         ssh_hostname=config.get('ssh', 'hostname'),
         ssh_port=config.get('ssh', 'port'),
+        transport=get_transport(config),
         wordpress_path=config.get('paths', 'wordpress'),
         remote_backup_path=expanded_remote_backup_path,
-        backup_compressor=config.get('backup', 'compressor'),
+        backup_compressor=get_backup_compressor(config, remote=True),
+        backup_options=backup_options,
+        basis_checksum=basis_checksum,
+        read_progress=read_progress,
         stdout=stdout, stderr=stderr)
 
+    if config.has_option('backup', 'dictionary_id'):
+        backup_stats['dictionary_id'] = config.getint(
+            'backup', 'dictionary_id')
+
     create_dir_structure(local_backup_path=expanded_local_backup_path)
+    replicas = get_replicas(config)
 
-    download_remote_backup(
-        ssh_user=config.get('ssh', 'user'),
-        ssh_hostname=config.get('ssh', 'hostname'),
-        ssh_port=config.get('ssh', 'port'),
+    download_stats = transfer_backup(
+        config, backup_stats,
         remote_backup_path=expanded_remote_backup_path,
         local_backup_path=expanded_local_backup_path,
-        stdout=stdout, stderr=stderr)
+        basis_backup_path=basis_backup_path,
+        replicas=replicas, stdout=stdout, stderr=stderr)
+    backup_stats['checksum'] = download_stats['checksum']
+
+    # Record how the backup was made (e.g. the chosen codec) alongside it
+    # before anything is written to the replicas
+    write_backup_manifest(expanded_local_backup_path, backup_stats)
+
+    # A rebuilt backup is only copied to the replicas once it is complete,
+    # whereas a downloaded one was written to them as it arrived
+    failed_replicas = download_stats['failed_replicas']
+    if 'delta_basis' in backup_stats and replicas:
+        failed_replicas = copy_to_replicas(
+            expanded_local_backup_path, replicas,
+            stdout=stdout, stderr=stderr)
+    write_replica_manifests(replicas, backup_stats, failed_replicas)
 
     purge_remote_backup(
         ssh_user=config.get('ssh', 'user'),
         ssh_hostname=config.get('ssh', 'hostname'),
         ssh_port=config.get('ssh', 'port'),
+        transport=get_transport(config),
         remote_backup_path=expanded_remote_backup_path,
         stdout=stdout, stderr=stderr)
 
-    if config.has_option('backup', 'max_local_backups'):
-        purge_oldest_backups(
-            local_backup_path=config.get('paths', 'local_backup'),
-            max_local_backups=config.getint('backup', 'max_local_backups'))
-
-
-# Restore the chosen database revision to the Wordpress install on remote
-def restore(config, *, local_backup_path, stdout=None, stderr=None):
-
-    expanded_remote_backup_path = time.strftime(
-        config.get('paths', 'remote_backup'))
-
-    upload_local_backup(
+    # The local backup is kept when replicas fail, but the run has failed
+    if failed_replicas:
+        raise OSError('Backup could not be written to replicas: {}.'.format(
+            ', '.join(failed_replicas)))
+
+    return {
+        'backup_size': download_stats['backup_size'],
+        'raw_size': backup_stats.get('raw_size'),
+        'transfer_duration': download_stats['transfer_duration']
+    }
+
+
+# Transfer the backup made by the remote to the given local backup path,
+# rebuilding it if the remote made a delta (against the given basis backup),
+# or else writing it to the given replicas as it is downloaded; returns
+# statistics about the transfer
+def transfer_backup(config, backup_stats, *, remote_backup_path,
+                    local_backup_path, basis_backup_path, replicas,
+                    stdout, stderr):
+
+    if 'delta_basis' in backup_stats:
+        download_stats = download_delta_backup(
+            config, backup_stats,
+            remote_backup_path=remote_backup_path,
+            local_backup_path=local_backup_path,
+            basis_backup_path=basis_backup_path,
+            stdout=stdout, stderr=stderr)
+        backup_stats['transfer_size'] = download_stats['transfer_size']
+        backup_stats['backup_size'] = download_stats['backup_size']
+        # The time taken to transfer a delta says little about the link
+        # bandwidth (as estimated from the backup size), so it is not kept
+        return dict(download_stats, transfer_duration=None,
+                    failed_replicas=[])
+
+    download_started = time.time()
+    download_stats = download_remote_backup(
         ssh_user=config.get('ssh', 'user'),
         ssh_hostname=config.get('ssh', 'hostname'),
         ssh_port=config.get('ssh', 'port'),
+        transport=get_transport(config),
+        remote_backup_path=remote_backup_path,
         local_backup_path=local_backup_path,
-        remote_backup_path=expanded_remote_backup_path,
+        replicas=replicas,
+        expected_size=backup_stats.get('backup_size'),
         stdout=stdout, stderr=stderr)
 
-    restore_remote_backup(
+    return dict(download_stats,
+                transfer_duration=time.time() - download_started)
+
+
+# Record how the backup was made alongside every given replica stored as a
+# file, except those which failed
+def write_replica_manifests(replicas, backup_stats, failed_replicas):
+
+    for replica in replicas:
+        if 'path' in replica and replica['name'] not in failed_replicas:
+            write_backup_manifest(replica['path'], backup_stats)
+
+
+# Read the frames of a fleet backup stream (written by the remote script),
+# yielding the type, site label and payload of each
+def read_frames(input_stream):
+
+    import struct
+
+    frame_header = struct.Struct('>cHI')
+    while True:
+        header = input_stream.read(frame_header.size)
+        if not header:
+            return
+        if len(header) < frame_header.size:
+            raise OSError('Fleet backup stream is truncated. Aborting.')
+        frame_type, label_size, payload_size = frame_header.unpack(header)
+        label = input_stream.read(label_size).decode('utf-8')
+        payload = input_stream.read(payload_size)
+        if len(payload) < payload_size:
+            raise OSError('Fleet backup stream is truncated. Aborting.')
+        yield frame_type, label, payload
+
+
+# Write the backups interleaved in the given fleet backup stream to the local
+# backup path of each site, returning the backup statistics of each site (or
+# else the error which aborted its backup); the given statistics common to
+# every backup are also recorded in each manifest
+def receive_fleet_backups(input_stream, *, local_backup_path,
+                          common_stats=None):
+
+    import hashlib
+    import json
+
+    backups = {}
+    fleet_stats = {}
+    try:
+        for frame_type, label, payload in read_frames(input_stream):
+            if label not in backups:
+                backup_path = local_backup_path.replace('{site}', label)
+                create_dir_structure(local_backup_path=backup_path)
+                backups[label] = (
+                    backup_path, open_temp_file(backup_path),
+                    hashlib.sha256())
+            backup_path, temp_file, checksum = backups[label]
+            if frame_type == b'D':
+                temp_file.write(payload)
+                checksum.update(payload)
+                continue
+            del backups[label]
+            if frame_type == b'E':
+                backup_stats = json.loads(payload.decode('utf-8'))
+                backup_stats.update(common_stats or {})
+                backup_stats['checksum'] = checksum.hexdigest()
+                if temp_file.tell() != backup_stats['backup_size']:
+                    discard_temp_file(temp_file)
+                    raise OSError(
+                        'Backup of {} is corrupted. Aborting.'.format(label))
+                commit_temp_file(temp_file, backup_path)
+                write_backup_manifest(backup_path, backup_stats)
+                fleet_stats[label] = backup_stats
+            else:
+                discard_temp_file(temp_file)
+                fleet_stats[label] = {'error': payload.decode('utf-8')}
+    finally:
+        # Discard the backups cut off by an interrupted stream
+        for backup_path, temp_file, checksum in backups.values():
+            discard_temp_file(temp_file)
+
+    return fleet_stats
+
+
+# Back up every WordPress install found on the remote (under the configured
+# root directories) in a single session
+def back_up_fleet(config, *, stdout=None, stderr=None, progress=None):
+
+    import json
+    import subprocess
+
+    local_backup_path = time.strftime(os.path.expanduser(
+        config.get('paths', 'local_backup')))
+    if '{site}' not in local_backup_path:
+        raise OSError('Local backup path must include {site} to back up'
+                      ' every site. Aborting.')
+    if config.has_option('backup', 'fleet_workers'):
+        num_workers = config.getint('backup', 'fleet_workers')
+    else:
+        num_workers = 4
+
+    # Small sites benefit the most from a shared dictionary
+    common_stats = {}
+    if config.has_option('backup', 'dictionary_id'):
+        common_stats['dictionary_id'] = config.getint(
+            'backup', 'dictionary_id')
+        install_remote_dictionary(
+            config, common_stats['dictionary_id'], stderr=stderr)
+
+    # The progress of each site is reported under its label
+    backup_options = get_backup_options(config)
+    read_progress = request_progress(config, backup_options, style=progress)
+
+    fleet_stats = {}
+    transfer_started = time.time()
+    exec_on_remote(
         ssh_user=config.get('ssh', 'user'),
         ssh_hostname=config.get('ssh', 'hostname'),
         ssh_port=config.get('ssh', 'port'),
-        wordpress_path=config.get('paths', 'wordpress'),
-        remote_backup_path=config.get('paths', 'remote_backup'),
-        backup_decompressor=config.get('backup', 'decompressor'),
-        stdout=stdout, stderr=stderr)
+        transport=get_transport(config),
+        action='back-up-fleet',
+        action_args=[
+            json.dumps(config.get('paths', 'wordpress_roots').split()),
+            get_backup_compressor(config, remote=True),
+            json.dumps(backup_options),
+            str(num_workers)
+        ],
+        stdout=subprocess.PIPE, stderr=stderr, read_progress=read_progress,
+        read_output=lambda output_stream: fleet_stats.update(
+            receive_fleet_backups(
+                output_stream, local_backup_path=local_backup_path,
+                common_stats=common_stats)))
+    transfer_duration = time.time() - transfer_started
+
+    failed_labels = sorted(
+        label for label in fleet_stats if 'error' in fleet_stats[label])
+    if failed_labels:
+        raise OSError('Sites could not be backed up: {}. Aborting.'.format(
+            '; '.join('{} ({})'.format(label, fleet_stats[label]['error'])
+                      for label in failed_labels)))
+
+    return {
+        'backup_size': sum(
+            site_stats['backup_size'] for site_stats in fleet_stats.values()),
+        'raw_size': sum(
+            site_stats.get('raw_size', 0)
+            for site_stats in fleet_stats.values()),
+        'transfer_duration': transfer_duration
+    }
+
+
+# Retrieve the staging database into which the backup is restored before
+# being swapped in (an empty name lets the remote create a temporary one), and
+# whether it is instead loaded directly into the WordPress database
+def get_restore_staging(config, *, stream):
+
+    if config.has_option('restore', 'staging_db'):
+        return config.get('restore', 'staging_db'), False
+
+    direct_load = (config.has_option('restore', 'direct_load') and
+                   config.getboolean('restore', 'direct_load'))
+
+    # A streamed backup can only be verified once it has been loaded, so it
+    # must be staged lest a corrupted backup overwrite the WordPress database
+    if stream and direct_load:
+        raise OSError('Streamed restores cannot be loaded directly into the'
+                      ' database (direct_load). Aborting.')
+
+    return '', direct_load
+
+
+# Restore the chosen database revision to the Wordpress install on remote
+def restore(config, *, local_backup_path, stream=False, until=None,
+            stdout=None, stderr=None):
+
+    backup_decompressor = get_backup_decompressor(
+        config, local_backup_path, remote=True)
+
+    # Encrypted backups are decrypted locally and streamed to the remote;
+    # their authenticated encryption stands in for the checksum
+    if read_backup_manifest(local_backup_path).get('encrypted'):
+        encryption_identity = os.path.expanduser(
+            config.get('restore', 'encryption_identity'))
+        backup_checksum = ''
+        stream = True
+    else:
+        encryption_identity = None
+        # The checksum lets the remote reject a corrupted transfer before
+        # the database is touched
+        backup_checksum = get_file_checksum(local_backup_path)
+
+    # Make sure the backup can be rolled forward before the database is
+    # touched
+    if until:
+        get_backup_binlog_chain(config, local_backup_path)
+
+    staging_db, direct_load = get_restore_staging(config, stream=stream)
+
+    # Make sure the remote has the dictionary the backup was compressed with
+    dictionary_id = read_backup_manifest(local_backup_path).get(
+        'dictionary_id')
+    if dictionary_id is not None:
+        install_remote_dictionary(config, dictionary_id, stderr=stderr)
+
+    # Secondary indexes are optionally built after the rows are loaded
+    defer_indexes = (config.has_option('restore', 'defer_indexes') and
+                     config.getboolean('restore', 'defer_indexes'))
+
+    # The blocks of block archives are decompressed in parallel
+    backup_blocks = ','.join(
+        str(block[3]) for block in
+        read_backup_manifest(local_backup_path).get('blocks', []))
+
+    if stream:
+        stream_local_backup(
+            ssh_user=config.get('ssh', 'user'),
+            ssh_hostname=config.get('ssh', 'hostname'),
+            ssh_port=config.get('ssh', 'port'),
+            transport=get_transport(config),
+            wordpress_path=config.get('paths', 'wordpress'),
+            local_backup_path=local_backup_path,
+            backup_decompressor=backup_decompressor,
+            backup_checksum=backup_checksum,
+            staging_db=staging_db,
+            encryption_identity=encryption_identity,
+            backup_blocks=backup_blocks,
+            defer_indexes=defer_indexes,
+            stdout=stdout, stderr=stderr)
+    else:
+        expanded_remote_backup_path = time.strftime(
+            config.get('paths', 'remote_backup'))
+
+        upload_local_backup(
+            ssh_user=config.get('ssh', 'user'),
+            ssh_hostname=config.get('ssh', 'hostname'),
+            ssh_port=config.get('ssh', 'port'),
+            transport=get_transport(config),
+            local_backup_path=local_backup_path,
+            remote_backup_path=expanded_remote_backup_path,
+            stdout=stdout, stderr=stderr)
+
+        restore_remote_backup(
+            ssh_user=config.get('ssh', 'user'),
+            ssh_hostname=config.get('ssh', 'hostname'),
+            ssh_port=config.get('ssh', 'port'),
+            transport=get_transport(config),
+            wordpress_path=config.get('paths', 'wordpress'),
+            remote_backup_path=expanded_remote_backup_path,
+            backup_decompressor=backup_decompressor,
+            backup_checksum=backup_checksum,
+            staging_db=staging_db,
+            backup_blocks=backup_blocks,
+            defer_indexes=defer_indexes,
+            direct_load=direct_load,
+            stdout=stdout, stderr=stderr)
+
+    # Roll the restored database forward to the given point in time
+    if until:
+        replay_binlogs(
+            config, local_backup_path=local_backup_path, until=until,
+            stdout=stdout, stderr=stderr)
+
+    return {'backup_size': os.path.getsize(local_backup_path)}
+
+
+# Decompress (and decrypt) the given local backup, returning the processes
+# doing so; the last process outputs the dump
+def open_backup_stream(config, local_backup_path, *, stderr):
+
+    import shlex
+    import subprocess
+
+    commands = []
+    if read_backup_manifest(local_backup_path).get('encrypted'):
+        commands.append(['age', '-d', '-i', os.path.expanduser(
+            config.get('restore', 'encryption_identity'))])
+    commands.append(shlex.split(
+        get_backup_decompressor(config, local_backup_path)))
+
+    processes = []
+    with open(local_backup_path, 'rb') as local_backup:
+        input_stream = local_backup
+        for command in commands:
+            processes.append(subprocess.Popen(
+                command, stdin=input_stream, stdout=subprocess.PIPE,
+                stderr=stderr))
+            input_stream = processes[-1].stdout
+
+    return processes
+
+
+# Retrieve the ranges of the dump (in order) to extract for the given tables,
+# beginning with the dump's header (which sets up the session)
+def get_extract_ranges(table_offsets, table_names):
+
+    for table_name in table_names:
+        if table_name not in table_offsets:
+            raise OSError('Table {} not found in backup. Aborting.'.format(
+                table_name))
+
+    header_end = min(start for start, end in table_offsets.values())
+    return [(None, 0, header_end)] + sorted(
+        ((table_name,) + tuple(table_offsets[table_name])
+         for table_name in set(table_names)),
+        key=lambda extract_range: extract_range[1])
+
+
+# Read the given (ordered) ranges of the given stream, yielding each chunk
+# read from a range along with the range's name; the bytes in between are
+# skipped without being parsed, and reading stops after the last range
+def read_stream_ranges(input_stream, ranges):
+
+    position = 0
+    for range_name, start, end in ranges:
+        while position < end:
+            in_range = position >= start
+            chunk = input_stream.read(min(
+                1024 * 1024, (end if in_range else start) - position))
+            if not chunk:
+                return
+            if in_range:
+                yield range_name, chunk
+            position += len(chunk)
+
+
+# Read (and verify) the given block of the given block archive, returning
+# the offset of the block within the dump along with its decompressed data
+def read_archive_block(local_backup_path, block, *, backup_decompressor):
+
+    import hashlib
+    import shlex
+    import subprocess
+
+    raw_offset, raw_size, offset, size, checksum = block
+    with open(local_backup_path, 'rb') as local_backup:
+        local_backup.seek(offset)
+        compressed_block = local_backup.read(size)
+    if hashlib.sha256(compressed_block).hexdigest() != checksum:
+        raise OSError('Block at offset {} is corrupted. Aborting.'.format(
+            offset))
+
+    return raw_offset, subprocess.check_output(
+        shlex.split(backup_decompressor), input=compressed_block)
+
+
+# Yield the part of the given (decompressed) block within each of the given
+# ranges, along with the range's name
+def slice_block_ranges(raw_offset, raw_block, ranges):
+
+    for range_name, start, end in ranges:
+        chunk = raw_block[max(start - raw_offset, 0):max(end - raw_offset, 0)]
+        if chunk:
+            yield range_name, chunk
+
+
+# Read the given (ordered) ranges of the dump in the given block archive,
+# yielding each chunk read from a range along with the range's name; only
+# the blocks containing the ranges are read (and verified) and decompressed,
+# in parallel
+def read_archive_ranges(local_backup_path, blocks, ranges, *,
+                        backup_decompressor):
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    needed_blocks = [
+        block for block in blocks
+        if any(start < block[0] + block[1] and block[0] < end
+               for range_name, start, end in ranges)]
+
+    # Only decompress a few blocks ahead, to bound memory use
+    num_workers = os.cpu_count() or 1
+    batches = [needed_blocks[index:index + num_workers * 2]
+               for index in range(0, len(needed_blocks), num_workers * 2)]
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        for batch in batches:
+            for raw_offset, raw_block in executor.map(
+                    lambda block: read_archive_block(
+                        local_backup_path, block,
+                        backup_decompressor=backup_decompressor), batch):
+                yield from slice_block_ranges(raw_offset, raw_block, ranges)
+
+
+# Scan the given stream line by line for the sections of the given tables
+# (for backups made before tables were indexed), yielding each line of the
+# dump's header and of those sections along with the name of its table
+def scan_table_lines(input_stream, table_names):
+
+    import re
+
+    table_name = None
+    tables_left = set(table_names)
+    for line in input_stream:
+        match = re.search(
+            br'^-- Table structure for table `((?:[^`]|``)+)`$', line)
+        if match:
+            table_name = match.group(1).replace(b'``', b'`').decode('utf-8')
+            # Stop as soon as every table has been found
+            if not tables_left:
+                return
+            tables_left.discard(table_name)
+        if table_name is None or table_name in table_names:
+            yield table_name, line
+
+
+# Split the given chunks (each named by its table) into lines
+def split_chunk_lines(chunks):
+
+    partial_line = b''
+    for table_name, chunk in chunks:
+        lines = (partial_line + chunk).split(b'\n')
+        partial_line = lines.pop()
+        for line in lines:
+            yield table_name, line + b'\n'
+    if partial_line:
+        yield table_name, partial_line
+
+
+# Unescape a string value from a dump
+def unescape_sql_value(value):
+
+    import re
+
+    escapes = {b'0': b'\0', b'b': b'\b', b'n': b'\n', b'r': b'\r',
+               b't': b'\t', b'Z': b'\x1a'}
+    return re.sub(br'\\(.)', lambda match: escapes.get(
+        match.group(1), match.group(1)), value)
+
+
+# Parse the values of each row inserted by the given INSERT statement,
+# returning each row's text along with its values (None for NULL)
+def parse_insert_rows(insert_values):
+
+    import re
+
+    rows = []
+    for row_match in re.finditer(
+            br"\((?:'(?:[^'\\]|\\.)*'|[^'()])*\)", insert_values):
+        values = []
+        for value_match in re.finditer(
+                br"'((?:[^'\\]|\\.)*)'|([^,]+)", row_match.group(0)[1:-1]):
+            if value_match.group(1) is not None:
+                values.append(unescape_sql_value(value_match.group(1)))
+            elif value_match.group(2) == b'NULL':
+                values.append(None)
+            else:
+                values.append(value_match.group(2))
+        rows.append((row_match.group(0), values))
+
+    return rows
+
+
+# Filter the given INSERT statement (of the given table, with the given
+# columns) down to the rows whose columns have the given values, returning
+# None if no row matches
+def filter_insert_line(line, table_name, columns, row_filters):
+
+    for column in row_filters:
+        if column not in columns:
+            raise OSError('Column {} not found in table {}. Aborting.'.format(
+                column, table_name))
+    values_start = line.index(b' VALUES ') + len(b' VALUES ')
+    matching_rows = [
+        row for row, values in parse_insert_rows(line[values_start:])
+        if all(values[columns.index(column)] == value.encode('utf-8')
+               for column, value in row_filters.items())]
+    if not matching_rows:
+        return None
+
+    return line[:values_start] + b','.join(matching_rows) + b';\n'
+
+
+# Filter the given dump lines down to the dump's header and INSERT
+# statements for only the rows whose columns have the given values
+def filter_row_lines(lines, row_filters):
+
+    import re
+
+    columns = []
+    for table_name, line in lines:
+        if table_name is None:
+            yield line
+        elif line.startswith(b'CREATE TABLE '):
+            columns = []
+        elif line.startswith(b'  `'):
+            columns.append(re.search(br'^  `((?:[^`]|``)+)`', line).group(
+                1).replace(b'``', b'`').decode('utf-8'))
+        elif line.startswith(b'INSERT INTO '):
+            filtered_line = filter_insert_line(
+                line, table_name, columns, row_filters)
+            if filtered_line is not None:
+                yield filtered_line
+
+
+# Read the given tables from the given local backup, returning the chunks of
+# SQL read (paired with their tables) along with the processes decompressing
+# the backup (if any)
+def read_backup_tables(config, local_backup_path, table_names, *, stderr):
+
+    manifest = read_backup_manifest(local_backup_path)
+    table_offsets = manifest.get('table_offsets')
+
+    # Seek straight to each table using the offsets recorded with the
+    # backup (only decompressing the blocks containing them, if the backup
+    # is a block archive), falling back to scanning every line of the dump
+    if table_offsets and manifest.get('blocks') and not manifest.get(
+            'encrypted'):
+        return read_archive_ranges(
+            local_backup_path, manifest['blocks'],
+            get_extract_ranges(table_offsets, table_names),
+            backup_decompressor=get_backup_decompressor(
+                config, local_backup_path)), []
+
+    processes = open_backup_stream(config, local_backup_path, stderr=stderr)
+    dump = processes[-1].stdout
+    if table_offsets:
+        chunks = read_stream_ranges(
+            dump, get_extract_ranges(table_offsets, table_names))
+    else:
+        chunks = scan_table_lines(dump, table_names)
+
+    return chunks, processes
+
+
+# Write the given chunks (paired with their tables) to the file at the given
+# path, or else to stdout
+def write_extracted_chunks(chunks, output_path):
+
+    if not output_path:
+        for table_name, chunk in chunks:
+            sys.stdout.buffer.write(chunk)
+        return
+
+    output_file = open_temp_file(output_path)
+    try:
+        for table_name, chunk in chunks:
+            output_file.write(chunk)
+        commit_temp_file(output_file, output_path)
+    finally:
+        discard_temp_file(output_file)
+
+
+# Extract the given tables (or only their rows whose columns have the given
+# values) from the given local backup as SQL, without decompressing the
+# backup to disk or past the last table requested
+def extract(config, *, local_backup_path, table_names, row_filters,
+            output_path, stderr=None):
+
+    chunks, processes = read_backup_tables(
+        config, local_backup_path, table_names, stderr=stderr)
+    if row_filters:
+        chunks = ((None, line) for line in filter_row_lines(
+            split_chunk_lines(chunks), row_filters))
+
+    write_extracted_chunks(chunks, output_path)
+
+    # The rest of the dump is not needed
+    for process in processes:
+        if process.poll() is None:
+            process.kill()
+        elif process.returncode != 0:
+            raise OSError('Backup could not be decompressed. Aborting.')
+        process.wait()
+
+
+# Retrieve the path to the local directory in which binlog segments are kept
+def get_binlog_dir(config):
+
+    return os.path.expanduser(config.get('paths', 'local_binlogs'))
+
+
+# Retrieve the path of the binlog segment starting at the given position
+def get_binlog_segment_path(binlog_dir, binlog_file, binlog_position):
+
+    return os.path.join(binlog_dir, '{}-{:012d}.sql'.format(
+        binlog_file, binlog_position))
+
+
+# Read the binlog file and position at which the given segment ends
+def read_binlog_segment_end(segment_path):
+
+    with open(segment_path, 'r') as segment:
+        header = segment.readline().split()
+
+    if header[:2] != ['--', 'swb-binlog-end:']:
+        raise OSError('Binlog segment {} has no header. Aborting.'.format(
+            segment_path))
+
+    return header[2], int(header[3])
+
+
+# Parse the binlog file and position at which the segment at the given path
+# starts (or None if the path is not that of a segment)
+def parse_binlog_segment_path(segment_path):
+
+    import re
+
+    match = re.search(r'^(.+)-(\d{12})\.sql$', os.path.basename(segment_path))
+    if match:
+        return match.group(1), int(match.group(2))
+
+    return None
+
+
+# Retrieve the binlog segments in the given directory as a dictionary mapping
+# the position at which each segment starts to its path
+def get_binlog_segments(binlog_dir):
+
+    segments = {}
+    try:
+        segment_names = os.listdir(binlog_dir)
+    except OSError:
+        segment_names = []
+    for segment_name in segment_names:
+        segment_start = parse_binlog_segment_path(segment_name)
+        if segment_start:
+            segments[segment_start] = os.path.join(binlog_dir, segment_name)
+
+    return segments
+
+
+# Retrieve the binlog position from which to fetch the next segment: the end
+# of the latest segment, or else the position recorded by the latest backup
+def get_binlog_start(config):
+
+    segments = get_binlog_segments(get_binlog_dir(config))
+    if segments:
+        return read_binlog_segment_end(segments[max(segments)])
+
+    local_backups = get_local_backups(os.path.expanduser(
+        config.get('paths', 'local_backup')))
+    for local_backup in reversed(local_backups):
+        manifest = read_backup_manifest(local_backup)
+        if 'binlog_file' in manifest:
+            return manifest['binlog_file'], manifest['binlog_position']
+
+    raise OSError('No backup with a recorded binlog position. Aborting.')
+
+
+# Fetch the binlog events since the last backup or segment from the remote,
+# storing them locally as a new segment
+def fetch_binlog(config, *, stdout=None, stderr=None):
+
+    binlog_dir = get_binlog_dir(config)
+    binlog_file, binlog_position = get_binlog_start(config)
+    segment_path = get_binlog_segment_path(
+        binlog_dir, binlog_file, binlog_position)
+
+    create_dir_structure(local_backup_path=segment_path)
+    segment = open_temp_file(segment_path)
+    try:
+        exec_on_remote(
+            ssh_user=config.get('ssh', 'user'),
+            ssh_hostname=config.get('ssh', 'hostname'),
+            ssh_port=config.get('ssh', 'port'),
+            transport=get_transport(config),
+            action='binlog',
+            action_args=[
+                config.get('paths', 'wordpress'),
+                binlog_file,
+                str(binlog_position)
+            ],
+            stdout=segment, stderr=stderr)
+        segment.flush()
+
+        # Only keep segments containing events, so each segment starts where
+        # the previous one ended
+        if read_binlog_segment_end(segment.name) == (
+                binlog_file, binlog_position):
+            return {'backup_size': 0}
+
+        commit_temp_file(segment, segment_path)
+    finally:
+        discard_temp_file(segment)
+
+    return {'backup_size': os.path.getsize(segment_path)}
+
+
+# Retrieve the paths of the segments continuing on from the given position,
+# in order; since each segment continues from the end of the previous one,
+# the position recorded by any backup but the first falls within a segment,
+# so the chain starts at the segment containing the position
+def get_binlog_chain(binlog_dir, binlog_file, binlog_position):
+
+    segments = get_binlog_segments(binlog_dir)
+    chain = []
+    position = max((start for start in segments
+                    if start <= (binlog_file, binlog_position)),
+                   default=None)
+    while position in segments:
+        chain.append(segments[position])
+        position = read_binlog_segment_end(segments[position])
+
+    if position is None or position < (binlog_file, binlog_position):
+        raise OSError('Binlog segments covering {} {} are missing.'
+                      ' Aborting.'.format(binlog_file, binlog_position))
+
+    # Events after a gap in the chain cannot be replayed
+    if any(start > position for start in segments):
+        raise OSError('Binlog segments after {} {} are missing.'
+                      ' Aborting.'.format(*position))
+
+    return chain
+
+
+# Split the given binlog segment into its events (as lists of lines), each
+# along with the offset at which it starts (or None for the lines preceding
+# the first event)
+def read_binlog_events(segment):
+
+    offset = None
+    event_lines = []
+    for line in segment:
+        if line.startswith(b'# at '):
+            yield offset, event_lines
+            offset, event_lines = int(line.split()[2]), []
+        event_lines.append(line)
+    yield offset, event_lines
+
+
+# Retrieve the time (as a UTC timestamp) at which the given binlog event was
+# logged, or None if the lines are not those of an event
+def get_binlog_event_time(event_lines):
+
+    import calendar
+    import re
+
+    for line in event_lines:
+        match = re.search(br'^#(\d{6} +\d+:\d\d:\d\d) server id', line)
+        if match:
+            # The remote decodes the binlog with its timezone set to UTC
+            return calendar.timegm(time.strptime(
+                ' '.join(match.group(1).decode('utf-8').split()),
+                '%y%m%d %H:%M:%S'))
+
+    return None
+
+
+# Retrieve the binlog file which follows the given event: the file the event
+# rotates the binlog to, or else the given current file
+def get_next_binlog_file(event_lines, binlog_file):
+
+    import re
+
+    for line in event_lines:
+        match = re.search(br'\sRotate to (\S+)\s+pos: \d+', line)
+        if match:
+            return match.group(1).decode('utf-8')
+
+    return binlog_file
+
+
+# Determine if the given binlog event is a format description event, which
+# must precede the (base64-encoded) events after it when they are replayed
+def is_format_description_event(event_lines):
+
+    return any(b'\tStart: binlog v' in line for line in event_lines)
+
+
+# Read the events in the given (chained) binlog segments, yielding the
+# binlog file and offset of each event (see read_binlog_events) along with
+# its lines
+def read_binlog_chain_events(segment_paths):
+
+    if not segment_paths:
+        return
+
+    binlog_file = parse_binlog_segment_path(segment_paths[0])[0]
+    for segment_path in segment_paths:
+        with open(segment_path, 'rb') as segment:
+            for offset, event_lines in read_binlog_events(segment):
+                yield binlog_file, offset, event_lines
+                binlog_file = get_next_binlog_file(event_lines, binlog_file)
+
+
+# Write the binlog events in the given segments from the given position (if
+# any) up to (and including) the given time (local) to the given output file
+def write_binlog_events(segment_paths, output_file, *, until, start=None):
+
+    until_time = time.mktime(time.strptime(until, '%Y-%m-%d %H:%M:%S'))
+    skipping = start is not None
+    for binlog_file, offset, event_lines in read_binlog_chain_events(
+            segment_paths):
+        event_time = get_binlog_event_time(event_lines)
+        if event_time is not None and event_time > until_time:
+            # Roll back any transaction left open by the cut-off
+            output_file.write(b'DELIMITER ;\nROLLBACK;\n')
+            return
+        # Events before the given position are already in the backup
+        if skipping and offset is not None:
+            skipping = (binlog_file, offset) < start
+        if not skipping or offset is None or (
+                is_format_description_event(event_lines)):
+            output_file.writelines(event_lines)
+
+
+# Retrieve the chain of binlog segments continuing on from the given backup,
+# along with the binlog position the backup was made at
+def get_backup_binlog_chain(config, local_backup_path):
+
+    manifest = read_backup_manifest(local_backup_path)
+    if 'binlog_file' not in manifest:
+        raise OSError('Backup has no recorded binlog position. Aborting.')
+
+    start = (manifest['binlog_file'], manifest['binlog_position'])
+    return get_binlog_chain(get_binlog_dir(config), *start), start
+
+
+# Replay the binlog events recorded since the given backup was made on the
+# remote database, up to the given time
+def replay_binlogs(config, *, local_backup_path, until, stdout, stderr):
+
+    import tempfile
+
+    chain, start = get_backup_binlog_chain(config, local_backup_path)
+
+    with tempfile.TemporaryFile() as binlog_events:
+        write_binlog_events(chain, binlog_events, until=until, start=start)
+        binlog_events.seek(0)
+        exec_on_remote(
+            ssh_user=config.get('ssh', 'user'),
+            ssh_hostname=config.get('ssh', 'hostname'),
+            ssh_port=config.get('ssh', 'port'),
+            transport=get_transport(config),
+            action='replay-binlog',
+            action_args=[config.get('paths', 'wordpress')],
+            stdin=binlog_events,
+            stdout=stdout, stderr=stderr)
+
+
+# Retrieve the name under which a site's runs are recorded in the history
+# (the runs of a fleet backup are recorded under its root directories)
+def get_site_name(config):
+
+    if config.has_option('paths', 'wordpress'):
+        wordpress_path = config.get('paths', 'wordpress')
+    else:
+        wordpress_path = config.get('paths', 'wordpress_roots')
+
+    return '{}@{}:{}'.format(
+        config.get('ssh', 'user'),
+        config.get('ssh', 'hostname'),
+        wordpress_path)
+
+
+# Retrieve the path to the run history database
+def get_history_path(config):
+
+    if config.has_option('paths', 'history'):
+        history_path = config.get('paths', 'history')
+    else:
+        history_path = default_history_path
+
+    return os.path.expanduser(history_path)
+
+
+# Open the run history database, creating it if necessary
+def open_history(history_path):
+
+    import sqlite3
+
+    create_dir_structure(history_path)
+    history = sqlite3.connect(history_path)
+    history.execute("""CREATE TABLE IF NOT EXISTS runs (
+        site TEXT NOT NULL,
+        action TEXT NOT NULL,
+        started REAL NOT NULL,
+        duration REAL NOT NULL,
+        succeeded INTEGER NOT NULL,
+        backup_size INTEGER,
+        raw_size INTEGER,
+        transfer_duration REAL
+    )""")
+
+    # Add columns missing from histories created by older versions
+    columns = [row[1] for row in history.execute('PRAGMA table_info(runs)')]
+    if 'transfer_duration' not in columns:
+        history.execute('ALTER TABLE runs ADD COLUMN transfer_duration REAL')
+
+    return history
+
+
+# Record a single backup/restore run in the run history database
+def record_run(config, *, action, started, succeeded, run_stats):
+
+    history = open_history(get_history_path(config))
+    with history:
+        history.execute(
+            'INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (
+                get_site_name(config),
+                action,
+                started,
+                time.time() - started,
+                succeeded,
+                run_stats.get('backup_size'),
+                run_stats.get('raw_size'),
+                run_stats.get('transfer_duration')))
+    history.close()
+
+
+# Run the given backup/restore procedure, recording it in the run history
+# whether or not it succeeds
+def run_and_record(config, procedure, *, action, **procedure_kwargs):
+
+    started = time.time()
+    run_stats = {}
+    succeeded = False
+    try:
+        run_stats = procedure(config, **procedure_kwargs)
+        succeeded = True
+    finally:
+        record_run(
+            config, action=action, started=started,
+            succeeded=succeeded, run_stats=run_stats)
+
+
+# Retrieve the value at the given percentile (0-100) of the given values
+def get_percentile(values, percentile):
+
+    values = sorted(values)
+    index = max(0, int(round(percentile / 100 * len(values))) - 1)
+    return values[index]
+
+
+# Format the given number of bytes as a human-readable size
+def format_size(num_bytes):
+
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(num_bytes) < 1024:
+            break
+        num_bytes /= 1024
+    else:
+        unit = 'TB'
+
+    return '{:.1f} {}'.format(num_bytes, unit)
+
+
+# Find successful backups much smaller than the backup before them
+def get_size_anomalies(backups, *, max_shrinkage):
+
+    anomalies = []
+    for previous_backup, backup in zip(backups, backups[1:]):
+        previous_size = previous_backup[2]
+        size = backup[2]
+        if previous_size and size < previous_size * (1 - max_shrinkage):
+            anomalies.append((backup[0], size, previous_size))
+
+    return anomalies
+
+
+# Summarize the recorded backup history of a single site
+def get_site_report(history, site):
+
+    runs = history.execute(
+        'SELECT started, duration, backup_size, raw_size, succeeded'
+        ' FROM runs WHERE site = ? AND action = ? ORDER BY started',
+        (site, 'back-up')).fetchall()
+    backups = [run for run in runs if run[4]]
+
+    lines = ['{}'.format(site)]
+    lines.append('  backups: {} ({} failed)'.format(
+        len(runs), len(runs) - len(backups)))
+    if not backups:
+        return lines
+
+    durations = [backup[1] for backup in backups]
+    lines.append('  duration: p50 {:.1f}s, p95 {:.1f}s'.format(
+        get_percentile(durations, 50), get_percentile(durations, 95)))
+
+    first_size = backups[0][2]
+    last_size = backups[-1][2]
+    days = max((backups[-1][0] - backups[0][0]) / 86400, 1)
+    lines.append('  size: {} (from {}, {}/day)'.format(
+        format_size(last_size), format_size(first_size),
+        format_size((last_size - first_size) / days)))
+
+    ratios = [backup[3] / backup[2] for backup in backups
+              if backup[2] and backup[3]]
+    if ratios:
+        lines.append('  compression ratio: {:.2f} (latest {:.2f})'.format(
+            sum(ratios) / len(ratios), ratios[-1]))
+
+    for started, size, previous_size in get_size_anomalies(
+            backups, max_shrinkage=0.8):
+        lines.append('  anomaly: backup at {} is {} (previous: {})'.format(
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(started)),
+            format_size(size), format_size(previous_size)))
+
+    return lines
+
+
+# Print backup trends for every site in the run history database
+def report(config):
+
+    history = open_history(get_history_path(config))
+    sites = [row[0] for row in history.execute(
+        'SELECT DISTINCT site FROM runs ORDER BY site')]
+
+    for site in sites:
+        print('\n'.join(get_site_report(history, site)))
+
+    history.close()
+
+
+# Retrieve the schedule on which the given site is backed up in daemon mode
+def get_schedule(config):
+
+    schedule = {
+        'interval': default_backup_interval,
+        'retries': default_retry_attempts,
+        'retry_delay': default_retry_delay
+    }
+    if config.has_option('schedule', 'interval'):
+        schedule['interval'] = config.getfloat('schedule', 'interval')
+    if config.has_option('schedule', 'retries'):
+        schedule['retries'] = config.getint('schedule', 'retries')
+    if config.has_option('schedule', 'retry_delay'):
+        schedule['retry_delay'] = config.getfloat('schedule', 'retry_delay')
+
+    # Random delays keep sites on the same interval from starting at once
+    if config.has_option('schedule', 'jitter'):
+        schedule['jitter'] = config.getfloat('schedule', 'jitter')
+    else:
+        schedule['jitter'] = schedule['interval'] / 10
+
+    return schedule
+
+
+# Retrieve the start times and durations of the recorded successful backups
+# of the given site, oldest first
+def get_backup_durations(config):
+
+    history = open_history(get_history_path(config))
+    backups = history.execute(
+        'SELECT started, duration FROM runs'
+        ' WHERE site = ? AND action = ? AND succeeded ORDER BY started',
+        (get_site_name(config), 'back-up')).fetchall()
+    history.close()
+
+    return backups
+
+
+# Estimate how long the next backup of a site will take from its past
+# backups (or None if it has never been backed up)
+def get_expected_duration(backups):
+
+    if not backups:
+        return None
+
+    return get_percentile([backup[1] for backup in backups], 50)
+
+
+# Retrieve the time at which the next scheduled backup of a site is due
+def get_next_due_time(schedule, last_started):
+
+    import random
+
+    return (last_started + schedule['interval'] +
+            random.uniform(0, schedule['jitter']))
+
+
+# Create the daemon job which backs up the given site, due one interval
+# after its last recorded backup (or right away if it is overdue)
+def create_backup_job(config, *, now):
+
+    import random
+
+    schedule = get_schedule(config)
+    backups = get_backup_durations(config)
+    if backups:
+        due = get_next_due_time(schedule, backups[-1][0])
+    else:
+        due = now
+
+    # Overdue sites are spread out as well, so they do not all start at once
+    if due <= now:
+        due = now + random.uniform(0, schedule['jitter'])
+
+    return {
+        'site': get_site_name(config),
+        'config': config,
+        'schedule': schedule,
+        'due': due,
+        'expected_duration': get_expected_duration(backups),
+        'running': False,
+        'attempt': 0,
+        'last_error': None
+    }
+
+
+# Choose which due jobs to start on the idle workers; the longest backups
+# are started first so that they do not overrun the backup window at its
+# end (sites never backed up before come first, as their duration is not
+# yet known)
+def get_jobs_to_start(jobs, *, num_workers, now):
+
+    num_idle_workers = num_workers - sum(job['running'] for job in jobs)
+    due_jobs = [job for job in jobs
+                if not job['running'] and job['due'] <= now]
+    due_jobs.sort(key=lambda job: (
+        job['expected_duration'] is not None,
+        -(job['expected_duration'] or 0)))
+
+    return due_jobs[:max(num_idle_workers, 0)]
+
+
+# Determine whether the given backup failure is worth retrying shortly
+def is_transient_failure(error):
+
+    if isinstance(error, SystemExit):
+        return error.code in transient_exit_statuses
+
+    return isinstance(error, (ConnectionError, TimeoutError))
+
+
+# Back up the site of the given daemon job and schedule its next run; a
+# transiently failed backup is retried with exponential backoff
+def run_backup_job(job, jobs_lock, *, stdout, stderr):
+
+    started = time.time()
+    error = None
+    try:
+        run_and_record(
+            job['config'], back_up, action='back-up',
+            stdout=stdout, stderr=stderr)
+        purge_oldest_backups(get_retention_policies([job['config']]))
+    except (Exception, SystemExit) as backup_error:
+        error = backup_error
+    expected_duration = get_expected_duration(
+        get_backup_durations(job['config']))
+
+    schedule = job['schedule']
+    with jobs_lock:
+        job['running'] = False
+        job['expected_duration'] = expected_duration
+        if error is None:
+            job['attempt'] = 0
+            job['last_error'] = None
+            job['due'] = get_next_due_time(schedule, started)
+        elif (is_transient_failure(error) and
+                job['attempt'] < schedule['retries']):
+            job['attempt'] += 1
+            job['last_error'] = repr(error)
+            job['due'] = time.time() + (
+                schedule['retry_delay'] * 2 ** (job['attempt'] - 1))
+        else:
+            job['attempt'] = 0
+            job['last_error'] = repr(error)
+            job['due'] = get_next_due_time(schedule, started)
+
+
+# Describe the state of the daemon's jobs, soonest first
+def get_queue_state(jobs, *, now):
+
+    return [{
+        'site': job['site'],
+        'state': 'running' if job['running'] else 'waiting',
+        'due_in': max(round(job['due'] - now), 0),
+        'expected_duration': job['expected_duration'],
+        'attempt': job['attempt'],
+        'last_error': job['last_error']
+    } for job in sorted(jobs, key=lambda job: job['due'])]
+
+
+# Serve the state of the daemon's jobs as JSON over HTTP on the loopback
+# interface (in a background thread)
+def start_status_server(jobs, jobs_lock, status_port):
+
+    import http.server
+    import json
+    import threading
+
+    class StatusHandler(http.server.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+
+            with jobs_lock:
+                queue_state = get_queue_state(jobs, now=time.time())
+            body = json.dumps(queue_state, indent=2).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        # Keep requests out of the backup output
+        def log_message(self, *args):
+
+            pass
+
+    status_server = http.server.ThreadingHTTPServer(
+        ('127.0.0.1', status_port), StatusHandler)
+    threading.Thread(
+        target=status_server.serve_forever, daemon=True).start()
+
+    return status_server
+
+
+# Back up the given sites on their schedules until interrupted (or until
+# the given event is set)
+def run_daemon(configs, *, num_workers, status_port=None,
+               stdout=None, stderr=None, stop_event=None):
+
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+
+    if stop_event is None:
+        stop_event = threading.Event()
+
+    jobs_lock = threading.Lock()
+    jobs = [create_backup_job(config, now=time.time()) for config in configs]
+    if status_port is not None:
+        status_server = start_status_server(jobs, jobs_lock, status_port)
+    else:
+        status_server = None
+
+    try:
+        # Running backups are allowed to finish when the daemon is stopped
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            while not stop_event.is_set():
+                with jobs_lock:
+                    for job in get_jobs_to_start(
+                            jobs, num_workers=num_workers, now=time.time()):
+                        job['running'] = True
+                        executor.submit(
+                            run_backup_job, job, jobs_lock,
+                            stdout=stdout, stderr=stderr)
+                stop_event.wait(daemon_poll_interval)
+    finally:
+        if status_server is not None:
+            status_server.shutdown()
+            status_server.server_close()
 
 
 # Parse command line arguments passed to the local driver
@@ -300,14 +2949,94 @@ def parse_cli_args():
         help='silences stdout and stderr')
 
     parser.add_argument(
-        'config_path',
-        help='the path to a configuration file (.ini)')
+        'config_paths',
+        metavar='config_path',
+        nargs='+',
+        help='the paths to one or more configuration files (.ini)')
 
     parser.add_argument(
         '--restore',
         '-r',
         help='the path to a compressed backup file from which to restore')
 
+    parser.add_argument(
+        '--report',
+        action='store_true',
+        help='prints duration and size trends from the run history')
+
+    parser.add_argument(
+        '--extract',
+        '-x',
+        help='the path to a compressed backup file from which to extract'
+             ' the given tables as SQL')
+
+    parser.add_argument(
+        '--table',
+        '-t',
+        action='append',
+        default=[],
+        help='the name of a table to extract (may be repeated)')
+
+    parser.add_argument(
+        '--row',
+        action='append',
+        default=[],
+        help='a COLUMN=VALUE condition that extracted rows must satisfy'
+             ' (may be repeated)')
+
+    parser.add_argument(
+        '--output',
+        '-o',
+        help='the path to the file to which extracted SQL is written'
+             ' (defaults to stdout)')
+
+    parser.add_argument(
+        '--until',
+        help='replays binlog events up to the given time (YYYY-MM-DD'
+             ' HH:MM:SS) after restoring from backup')
+
+    parser.add_argument(
+        '--train-dictionary',
+        action='store_true',
+        help='trains a compression dictionary on the latest local backups'
+             ' of the given sites')
+
+    parser.add_argument(
+        '--binlog',
+        action='store_true',
+        help='fetches the binlog events since the last backup or binlog'
+             ' segment')
+
+    parser.add_argument(
+        '--stream',
+        '-s',
+        action='store_true',
+        help='streams the backup directly into the database when restoring,'
+             ' rather than uploading it first')
+
+    parser.add_argument(
+        '--progress',
+        choices=('bar', 'json'),
+        help='reports the progress of backups as a progress bar (on stderr)'
+             ' or as JSON lines (on stdout)')
+
+    parser.add_argument(
+        '--daemon',
+        action='store_true',
+        help='keeps running, backing up the given sites on their schedules')
+
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=4,
+        help='the number of sites backed up at once in daemon mode')
+
+    parser.add_argument(
+        '--status-port',
+        type=int,
+        help='the local port on which the daemon serves the state of its'
+             ' queue')
+
     parser.add_argument(
         '--force',
         '-f',
@@ -321,16 +3050,72 @@ def parse_cli_args():
 # Parse configuration files at given paths into object
 def parse_config(config_path):
 
+    import configparser
+
     config = configparser.RawConfigParser()
     config.read(config_path)
 
     return config
 
 
+# Extract the tables (and rows) given on the command line from a local backup
+def extract_from_cli(config, cli_args, *, stderr):
+
+    if not cli_args.table:
+        raise Exception('No tables given to extract. Aborting.')
+    extract(
+        config, local_backup_path=cli_args.extract,
+        table_names=cli_args.table,
+        row_filters=dict(
+            row_filter.split('=', 1) for row_filter in cli_args.row),
+        output_path=cli_args.output, stderr=stderr)
+
+
+# Restore the backup given on the command line, once the user confirms it
+def restore_from_cli(configs, cli_args, *, stdout, stderr):
+
+    if len(configs) > 1:
+        raise Exception('Only one site can be restored at a time. Aborting.')
+    # Prompt user for confirmation before restoring from backup
+    if not cli_args.force:
+        print('Backup will overwrite WordPress database')
+        answer = input('Do you want to continue? (y/n) ')
+        if not answer.lower().lstrip().startswith('y'):
+            raise Exception('User canceled. Aborting.')
+    run_and_record(
+        configs[0], restore, action='restore',
+        local_backup_path=cli_args.restore,
+        stream=cli_args.stream, until=cli_args.until,
+        stdout=stdout, stderr=stderr)
+
+
+# Back up each of the given sites in turn, then apply their retention
+# policies; a site which fails does not keep the rest from being backed up
+def back_up_sites(configs, *, progress, stdout, stderr):
+
+    failed_sites = []
+    for config in configs:
+        try:
+            run_and_record(
+                config, back_up, action='back-up',
+                stdout=stdout, stderr=stderr, progress=progress)
+        except (Exception, SystemExit) as error:
+            failed_sites.append('{} ({})'.format(
+                get_site_name(config),
+                'exit status {}'.format(error.code)
+                if isinstance(error, SystemExit) else error))
+    # Apply the retention policies of every site in a single pass
+    purge_oldest_backups(get_retention_policies(configs))
+    if failed_sites:
+        raise OSError('Sites could not be backed up: {}.'
+                      ' Aborting.'.format('; '.join(failed_sites)))
+
+
 def main():
 
     cli_args = parse_cli_args()
-    config = parse_config(cli_args.config_path)
+    configs = [parse_config(config_path)
+               for config_path in cli_args.config_paths]
 
     # Open /dev/null to redirect stdout/stderr if necessary
     with open(os.devnull, 'w') as devnull:
@@ -340,18 +3125,30 @@ def main():
         else:
             stdout = stderr = None
 
-        if cli_args.restore:
-            # Prompt user for confirmation before restoring from backup
-            if not cli_args.force:
-                print('Backup will overwrite WordPress database')
-                answer = input('Do you want to continue? (y/n) ')
-                if not answer.lower().lstrip().startswith('y'):
-                    raise Exception('User canceled. Aborting.')
-            restore(
-                config, local_backup_path=cli_args.restore,
+        if cli_args.report:
+            report(configs[0])
+        elif cli_args.extract:
+            extract_from_cli(configs[0], cli_args, stderr=stderr)
+        elif cli_args.train_dictionary:
+            dictionary_id = train_dictionary(configs, stderr=stderr)
+            print('Trained dictionary {} (set dictionary_id = {} under'
+                  ' [backup] to use it)'.format(dictionary_id, dictionary_id))
+        elif cli_args.daemon:
+            run_daemon(
+                configs, num_workers=cli_args.workers,
+                status_port=cli_args.status_port,
                 stdout=stdout, stderr=stderr)
+        elif cli_args.restore:
+            restore_from_cli(configs, cli_args, stdout=stdout, stderr=stderr)
+        elif cli_args.binlog:
+            for config in configs:
+                run_and_record(
+                    config, fetch_binlog, action='binlog',
+                    stdout=stdout, stderr=stderr)
         else:
-            back_up(config, stdout=stdout, stderr=stderr)
+            back_up_sites(
+                configs, progress=cli_args.progress,
+                stdout=stdout, stderr=stderr)
 
 
 if __name__ == '__main__':
@@ -1,11 +1,88 @@
 #!/usr/bin/env python3
 
+import collections
+import contextlib
+import fcntl
+import fnmatch
+import hashlib
+import itertools
+import json
 import os
 import os.path
 import re
 import shlex
+import shutil
+import stat
 import subprocess
+import struct
 import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Compressor/decompressor pairs considered when choosing a codec automatically
+candidate_codecs = [
+    ('gzip -1', 'gzip -d'),
+    ('gzip -6', 'gzip -d'),
+    ('bzip2 -9', 'bzip2 -d'),
+    ('xz -1', 'xz -d'),
+    ('xz -6', 'xz -d'),
+    ('zstd -3', 'zstd -d'),
+    ('zstd -19', 'zstd -d')
+]
+# The number of bytes of the dump used to benchmark codecs by default
+default_sample_size = 8 * 1024 * 1024
+# The comment introducing each table's section of a dump (and its maximum
+# length, given MySQL's maximum identifier length)
+table_marker_regex = re.compile(
+    br'\n-- Table structure for table `((?:[^`]|``)+)`\n')
+table_marker_max_len = 40 + 64 * 4 * 2
+# The number of bytes at the start of a dump searched for the binlog position
+binlog_header_size = 64 * 1024
+# The directories never searched for WordPress installs (since they are
+# parts of an install)
+skipped_dir_names = {'wp-admin', 'wp-content', 'wp-includes', '.git',
+                     'node_modules'}
+# A definition of a secondary index within a CREATE TABLE statement
+secondary_index_regex = re.compile(
+    br'^\s*(?:(?:UNIQUE|FULLTEXT|SPATIAL)\s+)?KEY\s')
+# The first column of an index definition within a CREATE TABLE statement
+index_column_regex = re.compile(
+    br'KEY\s+(?:`(?:[^`]|``)+`\s*)?\(\s*(`(?:[^`]|``)+`)')
+# The definition of an AUTO_INCREMENT column within a CREATE TABLE statement
+auto_increment_column_regex = re.compile(
+    br'^\s*(`(?:[^`]|``)+`)\s.*\sAUTO_INCREMENT\b')
+# The directory in which the latest raw dumps of each site are kept, as the
+# bases of delta transfers
+dump_cache_dir = '~/.cache/ssh-wp-backup/dumps'
+# The header of each frame of a fleet backup stream (the frame's type, then
+# the lengths of its site label and of its payload)
+frame_header = struct.Struct('>cHI')
+# The number of bytes of backup sent in each frame of a fleet backup stream
+frame_size = 64 * 1024
+# The prefix of the lines on stderr which report progress to the local driver
+progress_prefix = 'swb-progress: '
+# The minimum interval (in seconds) between progress reports of a dump
+progress_interval = 1
+# Keeps the progress reports of concurrent dumps from interleaving
+progress_lock = threading.Lock()
+# The directory in which the dumps running on the host share out the host's
+# worker budget (as lock files, one per slot, and a queue of waiting dumps)
+host_slot_dir = '~/.cache/ssh-wp-backup/slots'
+# The interval (in seconds) at which a queued dump checks for a free slot
+host_slot_poll_interval = 0.1
+# The order in which this process's dumps joined the queue for a slot (which
+# breaks ties between dumps joining within the clock's resolution)
+host_slot_queue_counter = itertools.count()
+# The errors with which MySQL gives up waiting for a lock held by another
+# connection (or breaks a deadlock between connections)
+lock_wait_error_regex = re.compile(
+    rb'Lock wait timeout exceeded|Deadlock found')
+# The exit status of the remote script if a dump gave up waiting for a lock
+# (EX_TEMPFAIL), which the local driver retries
+lock_wait_exit_status = 75
 
 
 # Read contents of wp-config.php for a WordPress installation
@@ -40,32 +117,770 @@ def get_db_info(wordpress_path):
         value = match.group(2)
         db_info[key] = value
 
+    # Find the prefix shared by the names of the site's tables
+    match = re.search(r'\$table_prefix\s*=\s*[\'"](.*?)[\'"]',
+                      wp_config_contents)
+    if match:
+        db_info['table_prefix'] = match.group(1)
+    else:
+        db_info['table_prefix'] = 'wp_'
+
     return db_info
 
 
-# Dump MySQL database to compressed file
-def dump_compressed_db(db_name, db_host, db_user, db_password,
-                       backup_compressor, backup_path):
+# Pass through the given chunks of a dump, recording the offset at which
+# each table's section of the dump starts and ends
+def index_dump_chunks(chunks, *, table_offsets):
+
+    # The part of the dump not yet searched for table sections, which may
+    # end partway through the comment introducing a section
+    window = b''
+    window_offset = 0
+    # The range of the table whose section has not yet ended (sections do
+    # not overlap, so only one is open at a time)
+    open_range = None
+    for chunk in chunks:
+        yield chunk
+        window += chunk
+        searched_len = 0
+        for match in table_marker_regex.finditer(window):
+            table_start = window_offset + match.start() + 1
+            # The open table's section ends where the next one starts
+            if open_range:
+                open_range[1] = table_start
+            table_name = match.group(1).replace(b'``', b'`')
+            open_range = [table_start, None]
+            table_offsets[table_name.decode('utf-8')] = open_range
+            searched_len = match.end()
+        discarded_len = max(searched_len, len(window) - table_marker_max_len)
+        window = window[discarded_len:]
+        window_offset += discarded_len
+
+    # The last table's section ends with the dump
+    if open_range:
+        open_range[1] = window_offset + len(window)
+
+
+# Read the output of the given mysqldump process (preceded by the sample
+# already read from it), followed by the output of the given commands (which
+# dump tables separately) in chunks; the return code of every dump is
+# appended to the given list once it finishes, and their errors are written
+# to the given file
+def read_dump_chunks(mysqldump, sample, dump_commands, returncodes, *,
+                     stderr=None):
+
+    if sample:
+        yield sample
+    yield from iter(lambda: mysqldump.stdout.read(65536), b'')
+    mysqldump.wait()
+    returncodes.append(mysqldump.returncode)
+
+    for dump_command in dump_commands:
+        table_dump = subprocess.Popen(
+            dump_command, stdout=subprocess.PIPE, stderr=stderr)
+        yield from iter(lambda: table_dump.stdout.read(65536), b'')
+        table_dump.wait()
+        returncodes.append(table_dump.returncode)
+
+
+# Group the given chunks into blocks of the given size (except the last)
+def group_blocks(chunks, block_size):
+
+    block = bytearray()
+    for chunk in chunks:
+        block += chunk
+        while len(block) >= block_size:
+            yield bytes(block[:block_size])
+            del block[:block_size]
+    if block:
+        yield bytes(block)
+
+
+# Run the given (de)compressor on the given block of data
+def transform_block(command, block):
+
+    process = subprocess.Popen(
+        command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    output, _ = process.communicate(block)
+    if process.returncode != 0:
+        raise OSError('Block could not be processed by {}. Aborting.'.format(
+            command[0]))
+
+    return output
+
+
+# Apply the given function to the given items on a pool of threads, yielding
+# the results in order while only working a bounded number of items ahead
+def map_ordered(function, items, *, num_workers):
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        pending = collections.deque()
+        for item in items:
+            pending.append(executor.submit(function, item))
+            if len(pending) > num_workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+# Compress the given chunks of a dump in independently compressed blocks (in
+# parallel), writing them to the given output stream in order; returns the
+# index of the blocks (each block's offset and size within the dump, its
+# offset and size within the archive, and its checksum) and the dump size
+def compress_blocks(chunks, output_stream, *, compressor, block_size,
+                    num_workers=None):
+
+    blocks = []
+    raw_size = 0
+    offset = 0
+    for raw_block_size, block in map_ordered(
+            lambda raw_block: (
+                len(raw_block), transform_block(compressor, raw_block)),
+            group_blocks(chunks, block_size),
+            num_workers=num_workers or os.cpu_count() or 1):
+        output_stream.write(block)
+        blocks.append([
+            raw_size, raw_block_size, offset, len(block),
+            hashlib.sha256(block).hexdigest()])
+        raw_size += raw_block_size
+        offset += len(block)
+
+    return blocks, raw_size
+
+
+# Read up to the given number of bytes from the start of the given stream
+def read_sample(input_stream, sample_size):
+
+    chunks = []
+    num_bytes = 0
+    while num_bytes < sample_size:
+        chunk = input_stream.read(min(65536, sample_size - num_bytes))
+        if not chunk:
+            break
+        chunks.append(chunk)
+        num_bytes += len(chunk)
+
+    return b''.join(chunks)
+
+
+# Retrieve the candidate codecs whose programs are installed on the remote
+def get_available_codecs():
+
+    return [codec for codec in candidate_codecs
+            if shutil.which(shlex.split(codec[0])[0])]
+
+
+# Compress the given sample with the given compressor, returning the time
+# taken (in seconds) and the compressed size
+def benchmark_codec(compressor, sample):
+
+    started = time.time()
+    compressed_sample = subprocess.check_output(
+        shlex.split(compressor), input=sample)
+
+    return time.time() - started, len(compressed_sample)
+
+
+# Choose the codec that best fits the given objective (minimal total time
+# given the link bandwidth, or minimal size) for the given dump sample
+def choose_codec(sample, *, objective, link_bandwidth):
+
+    best_codec = None
+    best_score = None
+    for codec in get_available_codecs():
+        elapsed, compressed_size = benchmark_codec(codec[0], sample)
+        # If the link bandwidth is unknown, minimizing size is the best bet
+        if objective == 'time' and link_bandwidth:
+            score = elapsed + compressed_size / link_bandwidth
+        else:
+            score = compressed_size
+        if best_score is None or score < best_score:
+            best_codec = codec
+            best_score = score
+
+    if best_codec is None:
+        raise OSError('No supported compressor is installed. Aborting.')
+
+    return best_codec
+
+
+# Start the given commands as a pipeline (each command's output feeding the
+# next) whose output is written to the given file; input to the pipeline is
+# written to the first process's stdin
+def start_pipeline(commands, output_file):
+
+    processes = []
+    for command in commands:
+        if processes:
+            stdin = processes[-1].stdout
+        else:
+            stdin = subprocess.PIPE
+        if command is commands[-1]:
+            stdout = output_file
+        else:
+            stdout = subprocess.PIPE
+        process = subprocess.Popen(command, stdin=stdin, stdout=stdout)
+        # Only the next process in the pipeline should read this output
+        if processes:
+            processes[-1].stdout.close()
+        processes.append(process)
+
+    return processes
+
+
+# Retrieve the mysqldump option used to record the binlog position (which
+# was renamed in MySQL 8.0.26)
+def get_binlog_position_option():
+
+    mysqldump_help = subprocess.check_output(['mysqldump', '--help'])
+    if b'--source-data' in mysqldump_help:
+        return '--source-data'
+    else:
+        return '--master-data'
+
+
+# Parse the binlog file and position recorded at the start of a dump
+def parse_binlog_position(dump_head):
+
+    match = re.search(
+        br"_LOG_FILE='(.*?)', (?:MASTER|SOURCE)_LOG_POS=(\d+)", dump_head)
+    if match:
+        return match.group(1).decode('utf-8'), int(match.group(2))
+    else:
+        return None
+
+
+# Retrieve the name of the given table without the site's table prefix, as
+# matched by table globs
+def strip_table_prefix(table_name, table_prefix):
+
+    if table_prefix and table_name.startswith(table_prefix):
+        return table_name[len(table_prefix):]
+    else:
+        return table_name
+
+
+# Determine whether the given table matches any of the given globs (ignoring
+# case if requested)
+def match_table(table_name, table_globs, table_prefix, *, ignore_case=False):
+
+    table_name = strip_table_prefix(table_name, table_prefix)
+    if ignore_case:
+        table_name = table_name.lower()
+        table_globs = [table_glob.lower() for table_glob in table_globs]
+    return any(fnmatch.fnmatchcase(table_name, table_glob)
+               for table_glob in table_globs)
+
+
+# Retrieve the size (in bytes) and approximate row count of every table in
+# the given database
+def get_table_stats(db_name, db_host, db_user, db_password):
+
+    rows = query_db(
+        db_name=db_name, db_host=db_host,
+        db_user=db_user, db_password=db_password,
+        sql='SELECT table_name, data_length + index_length, table_rows'
+            ' FROM information_schema.tables'
+            ' WHERE table_schema = DATABASE()')
+
+    # Views have neither a size nor rows
+    return {
+        table_name: {
+            'size': int(size) if size.isdigit() else 0,
+            'rows': int(num_rows) if num_rows.isdigit() else 0
+        }
+        for table_name, size, num_rows in rows}
+
+
+# Retrieve the WHERE condition of the first table filter matching the given
+# table, if any; the filter globs (which are option names) are lowercased by
+# the config parser, so case is ignored
+def get_table_filter(table_name, table_filters, table_prefix):
+
+    for table_glob, where in table_filters.items():
+        if match_table(table_name, [table_glob], table_prefix,
+                       ignore_case=True):
+            return where
+
+    return None
+
+
+# Determine whether the given table is left out of the dump entirely by the
+# given backup options
+def is_skipped_table(table_name, backup_options, table_prefix):
+
+    include_tables = backup_options.get('include_tables')
+    if include_tables and not match_table(
+            table_name, include_tables, table_prefix):
+        return True
+
+    return match_table(
+        table_name, backup_options.get('exclude_tables', []), table_prefix)
+
+
+# Sort the given tables into those left out of the main dump, those of which
+# only the structure is dumped, and those whose rows are filtered (along with
+# their WHERE conditions), per the given backup options
+def select_dump_tables(table_stats, backup_options, table_prefix):
+
+    schema_only_tables = backup_options.get('schema_only_tables', [])
+    table_filters = backup_options.get('table_filters', {})
+    skipped_tables = {}
+    schema_only_names = []
+    filtered_tables = []
+    for table_name in sorted(table_stats):
+        if is_skipped_table(table_name, backup_options, table_prefix):
+            skipped_tables[table_name] = table_stats[table_name]
+        elif match_table(table_name, schema_only_tables, table_prefix):
+            skipped_tables[table_name] = table_stats[table_name]
+            schema_only_names.append(table_name)
+        else:
+            where = get_table_filter(table_name, table_filters, table_prefix)
+            if where is not None:
+                filtered_tables.append((table_name, where))
+
+    return skipped_tables, schema_only_names, filtered_tables
+
+
+# Construct the mysqldump commands whose output (concatenated) makes up the
+# dump, given the tables selected by the backup options; returns the
+# commands along with statistics on the tables which were left out
+def get_dump_commands(mysqldump_args, backup_options, *, db_name, db_host,
+                      db_user, db_password, table_prefix):
+
+    if not any(backup_options.get(option_name) for option_name in (
+            'include_tables', 'exclude_tables', 'schema_only_tables',
+            'table_filters')):
+        return [mysqldump_args], {}
+
+    table_stats = get_table_stats(
+        db_name=db_name, db_host=db_host,
+        db_user=db_user, db_password=db_password)
+    skipped_tables, schema_only_names, filtered_tables = select_dump_tables(
+        table_stats, backup_options, table_prefix)
+
+    # Tables which are left out or dumped separately are ignored by the
+    # main dump (which records the binlog position, if requested)
+    dump_commands = [mysqldump_args + [
+        '--ignore-table={}.{}'.format(db_name, table_name)
+        for table_name in sorted(skipped_tables) + [
+            table_name for table_name, where in filtered_tables]]]
+    base_args = mysqldump_args[:mysqldump_args.index('--add-drop-table') + 1]
+    if schema_only_names:
+        dump_commands.append(base_args + ['--no-data'] + schema_only_names)
+    for table_name, where in filtered_tables:
+        dump_commands.append(base_args + [
+            '--where={}'.format(where), table_name])
+
+    return dump_commands, {
+        'skipped_tables': skipped_tables,
+        'schema_only_tables': schema_only_names,
+        'filtered_tables': [
+            table_name for table_name, where in filtered_tables]
+    }
+
+
+# Retrieve the number of bytes written so far to the given file (or None if
+# it is not a regular file, e.g. a pipe)
+def get_written_size(output_file):
+
+    file_stat = os.fstat(output_file.fileno())
+    if stat.S_ISREG(file_stat.st_mode):
+        return file_stat.st_size
+
+    return None
+
+
+# Report the progress of a dump to the local driver (as a line on stderr,
+# alongside the output of the commands run)
+def report_progress(progress, *, table_offsets, output_file):
+
+    event = dict(progress)
+    # The last table found is still being dumped, unless the dump is done
+    table_names = list(table_offsets)
+    event['tables_done'] = len(table_names) - (
+        0 if progress.get('done') else min(len(table_names), 1))
+    event['current_table'] = table_names[-1] if table_names else None
+    event['compressed_bytes'] = get_written_size(output_file)
 
-    mysqldump = subprocess.Popen([
+    with progress_lock:
+        sys.stderr.write(progress_prefix + json.dumps(event) + '\n')
+        sys.stderr.flush()
+
+
+# Pass through the given chunks of a dump, periodically reporting how much
+# of it has been dumped (and compressed into the given file) so far
+def track_dump_progress(chunks, progress, *, table_offsets, output_file):
+
+    last_reported = time.time()
+    for chunk in chunks:
+        yield chunk
+        progress['dumped_bytes'] += len(chunk)
+        if time.time() - last_reported >= progress_interval:
+            report_progress(
+                progress, table_offsets=table_offsets,
+                output_file=output_file)
+            last_reported = time.time()
+
+
+# Estimate how many tables (and bytes) of the given database are dumped
+# given the tables left out, so that progress can be reported against them
+def get_dump_progress(db_name, db_host, db_user, db_password, *,
+                      table_stats, label=None):
+
+    skipped_tables = table_stats.get('skipped_tables', {})
+    schema_only_tables = table_stats.get('schema_only_tables', [])
+    dumped_tables = {
+        table_name: stats for table_name, stats in get_table_stats(
+            db_name=db_name, db_host=db_host,
+            db_user=db_user, db_password=db_password).items()
+        if table_name not in skipped_tables or
+        table_name in schema_only_tables}
+
+    progress = {
+        'stage': 'dump',
+        'tables_total': len(dumped_tables),
+        'estimated_bytes': sum(
+            stats['size'] for table_name, stats in dumped_tables.items()
+            if table_name not in schema_only_tables),
+        'dumped_bytes': 0
+    }
+    if label is not None:
+        progress['label'] = label
+
+    return progress
+
+
+# Try to lock the given file without waiting, returning whether it is locked
+# (the lock is released once the file is closed, or its process dies)
+def try_lock(lock_file):
+
+    try:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
+
+    return True
+
+
+# Retrieve the paths of the entries of the given slot queue, oldest first,
+# removing the entries of dumps which died while waiting (whose entries are
+# no longer locked)
+def get_slot_queue(queue_dir, entry_path):
+
+    queue_paths = []
+    for entry_name in sorted(os.listdir(queue_dir)):
+        queued_path = os.path.join(queue_dir, entry_name)
+        if queued_path != entry_path:
+            try:
+                with open(queued_path, 'rb') as queued_file:
+                    if try_lock(queued_file):
+                        os.remove(queued_path)
+                        continue
+            except FileNotFoundError:
+                # The dump stopped waiting in the meantime
+                continue
+        queue_paths.append(queued_path)
+
+    return queue_paths
+
+
+# Lock up to the given number of the host's free slots, returning the
+# (open) slot files locked
+def lock_free_slots(slot_dir, host_workers, max_slots):
+
+    slot_files = []
+    for slot_index in range(host_workers):
+        if len(slot_files) == max_slots:
+            break
+        slot_file = open(os.path.join(
+            slot_dir, 'slot-{}'.format(slot_index)), 'ab')
+        if try_lock(slot_file):
+            slot_files.append(slot_file)
+        else:
+            slot_file.close()
+
+    return slot_files
+
+
+# Hold a slot of the host's worker budget (shared by every dump on the host,
+# of any site) while the block runs, waiting for it in turn if the budget is
+# used up; the number of slots held is yielded, which is up to the given
+# maximum if no other dump is waiting
+@contextlib.contextmanager
+def hold_host_slots(host_workers, *, max_slots=1):
+
+    if not host_workers:
+        yield max_slots
+        return
+
+    slot_dir = os.path.expanduser(host_slot_dir)
+    queue_dir = os.path.join(slot_dir, 'queue')
+    os.makedirs(queue_dir, exist_ok=True)
+
+    # Join the queue; the entry is locked before it appears in the queue, so
+    # that it is never taken for the entry of a dump which died
+    entry_name = '{:020d}-{:010d}-{}-{}'.format(
+        int(time.time() * 1000000), next(host_slot_queue_counter),
+        os.getpid(), threading.get_ident())
+    entry_path = os.path.join(queue_dir, entry_name)
+    entry_file = open(os.path.join(slot_dir, entry_name), 'wb')
+    try_lock(entry_file)
+    os.rename(entry_file.name, entry_path)
+
+    slot_files = []
+    try:
+        # Only the dump at the head of the queue may take free slots, so
+        # that dumps are served in the order they arrived
+        while not slot_files:
+            queue_paths = get_slot_queue(queue_dir, entry_path)
+            if queue_paths[0] == entry_path:
+                slot_files = lock_free_slots(
+                    slot_dir, host_workers,
+                    max_slots if len(queue_paths) == 1 else 1)
+            if not slot_files:
+                time.sleep(host_slot_poll_interval)
+        os.remove(entry_path)
+        entry_file.close()
+        yield len(slot_files)
+    finally:
+        for slot_file in slot_files:
+            slot_file.close()
+        if not entry_file.closed:
+            os.remove(entry_path)
+            entry_file.close()
+
+
+# Retrieve the arguments of the mysqldump command dumping the given database
+def get_mysqldump_args(db_name, db_host, db_user, db_password, *,
+                       record_binlog):
+
+    mysqldump_args = [
         'mysqldump',
         db_name,
         '-h', db_host,
         '-u', db_user,
         '-p{}'.format(db_password),
         '--add-drop-table'
-    ], stdout=subprocess.PIPE)
+    ]
 
-    # Create remote backup so as to write output of dump/compress to file
-    with open(backup_path, 'w') as backup_file:
+    # Record the binlog position at which the (consistent) dump is taken, so
+    # binlog events since then can be replayed on top of it
+    if record_binlog:
+        mysqldump_args += [
+            '--single-transaction',
+            '{}=2'.format(get_binlog_position_option())
+        ]
+
+    return mysqldump_args
+
+
+# Read the start of the given dump ahead of time if it needs to be inspected
+# (for its binlog position, or to choose a codec), recording what is found in
+# the given dump statistics; the sample is returned along with the compressor
+# to use
+def inspect_dump_sample(dump_stream, backup_compressor, backup_options,
+                        dump_stats, *, record_binlog):
+
+    sample_size = 0
+    if backup_compressor == 'auto':
+        sample_size = backup_options.get('sample_size', default_sample_size)
+    if record_binlog:
+        sample_size = max(sample_size, binlog_header_size)
+    sample = read_sample(dump_stream, sample_size)
+
+    if record_binlog:
+        binlog_position = parse_binlog_position(sample)
+        if binlog_position is None:
+            raise OSError('Binlog position not found in dump. Aborting.')
+        dump_stats['binlog_file'], dump_stats['binlog_position'] = (
+            binlog_position)
+
+    # Benchmark candidate codecs on the start of the dump to choose one
+    if backup_compressor == 'auto':
+        backup_compressor, backup_decompressor = choose_codec(
+            sample,
+            objective=backup_options.get('objective', 'time'),
+            link_bandwidth=backup_options.get('link_bandwidth'))
+        dump_stats['compressor'] = backup_compressor
+        dump_stats['decompressor'] = backup_decompressor
+
+    return sample, backup_compressor
+
+
+# Report the progress of the given dump (as chunks) if the local driver asked
+# for it, returning the chunks along with the progress (or None)
+def start_dump_progress(chunks, db_name, db_host, db_user, db_password,
+                        backup_options, *, table_stats, table_offsets,
+                        output_file):
+
+    if not backup_options.get('progress'):
+        return chunks, None
+
+    progress = get_dump_progress(
+        db_name=db_name, db_host=db_host,
+        db_user=db_user, db_password=db_password,
+        table_stats=table_stats,
+        label=backup_options.get('progress_label'))
+
+    return track_dump_progress(
+        chunks, progress,
+        table_offsets=table_offsets, output_file=output_file), progress
 
-        compressor = subprocess.Popen(
-            shlex.split(backup_compressor),
-            stdin=mysqldump.stdout, stdout=backup_file)
 
-        # Wait for remote to dump and compress database
-        mysqldump.wait()
-        compressor.wait()
+# Compress the given dump (as chunks) through the given pipeline of commands
+# (the compressor, then the encryptor if any) to the given file, recording
+# its raw size (and blocks) in the given dump statistics; the processes of
+# the pipeline are returned once the dump has been written to them
+def write_dump_pipeline(chunks, pipeline_commands, backup_file, dump_stats,
+                        *, block_size=None, num_workers=None):
+
+    # Compress the dump in independent blocks (so that parts of it can
+    # be decompressed on their own, in parallel), or else as one stream
+    if block_size:
+        pipeline = start_pipeline(pipeline_commands[1:], backup_file)
+        if pipeline:
+            output_stream = pipeline[0].stdin
+        else:
+            output_stream = backup_file
+        dump_stats['blocks'], dump_stats['raw_size'] = compress_blocks(
+            chunks, output_stream,
+            compressor=pipeline_commands[0], block_size=block_size,
+            num_workers=num_workers)
+    else:
+        pipeline = start_pipeline(pipeline_commands, backup_file)
+        output_stream = pipeline[0].stdin
+        dump_stats['raw_size'] = 0
+        for chunk in chunks:
+            output_stream.write(chunk)
+            dump_stats['raw_size'] += len(chunk)
+    if pipeline:
+        output_stream.close()
+
+    return pipeline
+
+
+# Dump MySQL database to the given (open) file, compressed, returning
+# statistics about the dump (including its size before compression)
+def write_compressed_dump(db_name, db_host, db_user, db_password,
+                          backup_compressor, backup_file, backup_options=None,
+                          table_prefix='wp_', num_workers=None):
+
+    backup_options = backup_options or {}
+    dump_stats = {}
+
+    record_binlog = backup_options.get('binlog', False)
+    mysqldump_args = get_mysqldump_args(
+        db_name, db_host, db_user, db_password, record_binlog=record_binlog)
+
+    dump_commands, table_stats = get_dump_commands(
+        mysqldump_args, backup_options,
+        db_name=db_name, db_host=db_host,
+        db_user=db_user, db_password=db_password,
+        table_prefix=table_prefix)
+    dump_stats.update(table_stats)
+
+    # The errors of the dumps are collected so that lock waits (which are
+    # worth retrying) can be told apart from other failures
+    dump_errors = tempfile.TemporaryFile()
+    mysqldump = subprocess.Popen(
+        dump_commands[0], stdout=subprocess.PIPE, stderr=dump_errors)
+
+    sample, backup_compressor = inspect_dump_sample(
+        mysqldump.stdout, backup_compressor, backup_options, dump_stats,
+        record_binlog=record_binlog)
+
+    pipeline_commands = [shlex.split(backup_compressor)]
+
+    # Encrypt the compressed dump in-stream for the given age recipient
+    encryption_recipient = backup_options.get('encryption_recipient')
+    if encryption_recipient:
+        pipeline_commands.append(['age', '-r', encryption_recipient])
+        dump_stats['encrypted'] = True
+
+    # Pass the dump through this process so its size can be measured and
+    # its tables indexed (so they can be extracted later on)
+    table_offsets = {}
+    returncodes = []
+    chunks, progress = start_dump_progress(
+        index_dump_chunks(
+            read_dump_chunks(
+                mysqldump, sample, dump_commands[1:], returncodes,
+                stderr=dump_errors),
+            table_offsets=table_offsets),
+        db_name, db_host, db_user, db_password, backup_options,
+        table_stats=table_stats, table_offsets=table_offsets,
+        output_file=backup_file)
+
+    pipeline = write_dump_pipeline(
+        chunks, pipeline_commands, backup_file, dump_stats,
+        block_size=backup_options.get('block_size'),
+        num_workers=num_workers)
+
+    # Wait for remote to compress (and encrypt) database
+    for process in pipeline:
+        process.wait()
+
+    if table_offsets:
+        dump_stats['table_offsets'] = table_offsets
+    check_dump_errors(dump_errors, returncodes)
+    if encryption_recipient and pipeline[-1].returncode != 0:
+        raise OSError('Backup could not be encrypted. Aborting.')
+
+    if progress is not None:
+        progress['done'] = True
+        report_progress(
+            progress, table_offsets=table_offsets, output_file=backup_file)
+
+    return dump_stats
+
+
+# Pass the errors of the dumps (collected in the given file) through to
+# stderr, then raise an error if any dump failed; a dump which gave up
+# waiting for a lock raises TimeoutError, since it is worth retrying
+def check_dump_errors(dump_errors, returncodes):
+
+    dump_errors.seek(0)
+    error_output = dump_errors.read()
+    dump_errors.close()
+    sys.stderr.buffer.write(error_output)
+    sys.stderr.buffer.flush()
+
+    if any(returncodes) and lock_wait_error_regex.search(error_output):
+        raise TimeoutError('Database dump timed out waiting for a lock.'
+                           ' Aborting.')
+    if any(returncodes):
+        raise OSError('Database could not be dumped. Aborting.')
+
+
+# Retrieve the number of slots of the host's worker budget a dump may hold:
+# one, or as many as there are cores if it is compressed in blocks
+def get_max_slots(backup_options):
+
+    if backup_options.get('block_size'):
+        return os.cpu_count() or 1
+
+    return 1
+
+
+# Dump MySQL database to compressed file, returning statistics about the
+# dump (including its size before compression)
+def dump_compressed_db(db_name, db_host, db_user, db_password,
+                       backup_compressor, backup_path, backup_options=None,
+                       table_prefix='wp_'):
+
+    backup_options = backup_options or {}
+
+    # Create remote backup so as to write output of dump/compress to file
+    # (once the host has a worker to spare, if it has a budget)
+    with hold_host_slots(
+            backup_options.get('host_workers'),
+            max_slots=get_max_slots(backup_options)) as num_workers:
+        with open(backup_path, 'wb') as backup_file:
+            return write_compressed_dump(
+                db_name, db_host, db_user, db_password,
+                backup_compressor, backup_file, backup_options=backup_options,
+                table_prefix=table_prefix, num_workers=num_workers)
 
 
 # Verify integrity of remote backup by checking its size
@@ -83,54 +898,664 @@ def purge_downloaded_backup(backup_path):
 
 
 # Back up WordPress database or installation
-def back_up(wordpress_path, backup_compressor, backup_path):
+def back_up(wordpress_path, backup_compressor, backup_path,
+            backup_options='{}'):
 
     backup_path = os.path.expanduser(backup_path)
     create_dir_structure(backup_path)
     db_info = get_db_info(wordpress_path)
 
     # backup_path is assumed to refer to SQL database file backup
-    dump_compressed_db(
+    dump_stats = dump_compressed_db(
         db_name=db_info['name'], db_host=db_info['host'],
         db_user=db_info['user'], db_password=db_info['password'],
         backup_compressor=backup_compressor,
-        backup_path=backup_path)
+        backup_path=backup_path,
+        backup_options=json.loads(backup_options),
+        table_prefix=db_info['table_prefix'])
 
     verify_backup_integrity(backup_path)
 
+    # Report backup statistics to the local driver via stdout
+    dump_stats['backup_size'] = os.path.getsize(backup_path)
+    print(json.dumps(dump_stats))
+
+
+# Retrieve the directory in which the raw dumps of the given site are kept
+def get_dump_dir(wordpress_path):
+
+    return os.path.join(
+        os.path.expanduser(dump_cache_dir),
+        hashlib.sha256(os.path.abspath(wordpress_path).encode(
+            'utf-8')).hexdigest()[:16])
+
+
+# Back up WordPress database as a delta against the raw dump with the given
+# checksum (i.e. that of the latest backup confirmed by the local driver),
+# keeping the new raw dump as the basis of the next delta; the backup is
+# compressed in full if no such dump is kept
+def back_up_delta(wordpress_path, backup_compressor, backup_path,
+                  basis_checksum, backup_options='{}'):
+
+    wordpress_path = os.path.expanduser(wordpress_path)
+    backup_path = os.path.expanduser(backup_path)
+    create_dir_structure(backup_path)
+    dump_dir = get_dump_dir(wordpress_path)
+    os.makedirs(dump_dir, exist_ok=True)
+    db_info = get_db_info(wordpress_path)
+    backup_options = json.loads(backup_options)
+
+    # Dump the database uncompressed, so it can serve as a basis later on
+    new_dump_path = os.path.join(dump_dir, '{}.sql.part'.format(os.getpid()))
+    dump_stats = dump_compressed_db(
+        db_name=db_info['name'], db_host=db_info['host'],
+        db_user=db_info['user'], db_password=db_info['password'],
+        backup_compressor='cat',
+        backup_path=new_dump_path,
+        backup_options=backup_options,
+        table_prefix=db_info['table_prefix'])
+    dump_stats['raw_checksum'] = get_file_checksum(new_dump_path)
+    dump_path = os.path.join(
+        dump_dir, '{}.sql'.format(dump_stats['raw_checksum']))
+    os.replace(new_dump_path, dump_path)
+
+    basis_path = os.path.join(dump_dir, '{}.sql'.format(basis_checksum))
+    if (re.search(r'^[0-9a-f]{64}$', basis_checksum) and
+            os.path.exists(basis_path)):
+        # The dump is read via stdin, since it may be the basis itself
+        compressor_args = [
+            'zstd', '-q', '-c', '--long=31',
+            '--patch-from={}'.format(basis_path),
+            '--stream-size={}'.format(os.path.getsize(dump_path))]
+        dump_stats['delta_basis'] = basis_checksum
+    else:
+        compressor_args = shlex.split(backup_compressor)
+
+    with hold_host_slots(backup_options.get('host_workers')):
+        with open(dump_path, 'rb') as dump_file:
+            with open(backup_path, 'wb') as backup_file:
+                compressor = subprocess.Popen(
+                    compressor_args, stdin=dump_file, stdout=backup_file)
+                compressor.wait()
+    if compressor.returncode != 0:
+        raise OSError('Backup could not be compressed. Aborting.')
+
+    # Keep only the dumps which may be the basis of the next delta (since
+    # the local driver may not confirm receipt of this backup); the dumps
+    # still being written by other runs (named after their process) are left
+    # alone
+    kept_file_names = {os.path.basename(dump_path),
+                       os.path.basename(basis_path)}
+    for file_name in os.listdir(dump_dir):
+        if (re.search(r'^[0-9a-f]{64}\.sql$', file_name) and
+                file_name not in kept_file_names):
+            os.remove(os.path.join(dump_dir, file_name))
+
+    # A delta against an unchanged database may well be tiny
+    if 'delta_basis' not in dump_stats:
+        verify_backup_integrity(backup_path)
+
+    # Report backup statistics to the local driver via stdout
+    dump_stats['backup_size'] = os.path.getsize(backup_path)
+    print(json.dumps(dump_stats))
+
+
+# Find the WordPress installs (i.e. directories containing wp-config.php)
+# under the given root directories, returning the label and path of each
+def discover_wordpress_installs(root_paths):
+
+    installs = []
+    for root_path in root_paths:
+        root_path = os.path.expanduser(root_path)
+        for dir_path, dir_names, file_names in os.walk(root_path):
+            dir_names[:] = sorted(
+                dir_name for dir_name in dir_names
+                if dir_name not in skipped_dir_names)
+            if 'wp-config.php' in file_names:
+                installs.append((get_install_label(root_path, dir_path),
+                                 dir_path))
+
+    # Different paths may be reduced to the same label (e.g. sites/foo-bar
+    # and sites/foo/bar), so such labels are told apart by their paths
+    label_counts = collections.Counter(label for label, path in installs)
+    return [
+        (get_unique_install_label(label, path)
+         if label_counts[label] > 1 else label, path)
+        for label, path in installs]
+
+
+# Retrieve the label identifying the given install within a fleet backup
+# (derived from the install's path, so it is the same for every backup)
+def get_install_label(root_path, install_path):
+
+    label = os.path.normpath(os.path.join(
+        os.path.basename(os.path.normpath(root_path)),
+        os.path.relpath(install_path, root_path)))
+
+    return re.sub(r'[^A-Za-z0-9._-]+', '-', label).strip('-.')
+
+
+# Distinguish the given label from those of other installs by a short hash
+# of the install's path
+def get_unique_install_label(label, install_path):
+
+    return '{}-{}'.format(label, hashlib.sha256(
+        os.path.normpath(install_path).encode('utf-8')).hexdigest()[:8])
+
+
+# Write a single frame of a fleet backup stream (which interleaves the
+# backups of several sites) to the given output stream
+def write_frame(output_stream, output_lock, frame_type, label, payload):
+
+    label = label.encode('utf-8')
+    with output_lock:
+        output_stream.write(frame_header.pack(
+            frame_type, len(label), len(payload)))
+        output_stream.write(label)
+        output_stream.write(payload)
+
+
+# Back up the given install as part of a fleet backup, sending the backup to
+# the given output stream as it is compressed (framed with the install's
+# label), followed by its statistics or else the error which aborted it
+def back_up_install(label, install_path, *, backup_compressor,
+                    backup_options, output_stream, output_lock):
+
+    read_fd, write_fd = os.pipe()
+    dump_result = {}
+
+    # Dump the database on its own thread, so that the compressed backup
+    # can be sent as it is written to the pipe
+    def dump():
+        try:
+            with open(write_fd, 'wb') as backup_file, hold_host_slots(
+                    backup_options.get('host_workers'),
+                    max_slots=get_max_slots(backup_options)) as num_workers:
+                db_info = get_db_info(install_path)
+                dump_result['stats'] = write_compressed_dump(
+                    db_name=db_info['name'], db_host=db_info['host'],
+                    db_user=db_info['user'], db_password=db_info['password'],
+                    backup_compressor=backup_compressor,
+                    backup_file=backup_file,
+                    backup_options=dict(backup_options, progress_label=label),
+                    table_prefix=db_info['table_prefix'],
+                    num_workers=num_workers)
+        except Exception as error:
+            dump_result['error'] = error
+
+    dump_thread = threading.Thread(target=dump)
+    dump_thread.start()
+    backup_size = 0
+    with open(read_fd, 'rb') as backup_pipe:
+        for payload in iter(lambda: backup_pipe.read(frame_size), b''):
+            write_frame(output_stream, output_lock, b'D', label, payload)
+            backup_size += len(payload)
+    dump_thread.join()
+
+    if 'error' not in dump_result and backup_size < 1024:
+        dump_result['error'] = OSError(
+            'Backup is corrupted (too small). Aborting.')
+    if 'error' in dump_result:
+        write_frame(output_stream, output_lock, b'X', label,
+                    str(dump_result['error']).encode('utf-8'))
+        return False
+
+    dump_stats = dump_result['stats']
+    dump_stats['backup_size'] = backup_size
+    write_frame(output_stream, output_lock, b'E', label,
+                json.dumps(dump_stats).encode('utf-8'))
+    return True
+
+
+# Back up every WordPress install found under the given root directories,
+# dumping several at once and streaming the backups to stdout
+def back_up_fleet(root_paths, backup_compressor, backup_options='{}',
+                  num_workers='4'):
+
+    installs = discover_wordpress_installs(json.loads(root_paths))
+    backup_options = json.loads(backup_options)
+    output_stream = sys.stdout.buffer
+    output_lock = threading.Lock()
+
+    with ThreadPoolExecutor(max_workers=int(num_workers)) as executor:
+        list(executor.map(lambda install: back_up_install(
+            *install,
+            backup_compressor=backup_compressor,
+            backup_options=backup_options,
+            output_stream=output_stream,
+            output_lock=output_lock), installs))
+
+    output_stream.flush()
+
+
+# Construct the arguments used to connect to the given MySQL database
+def get_mysql_args(db_name, db_host, db_user, db_password):
+
+    return [
+        'mysql',
+        db_name,
+        '-h', db_host,
+        '-u', db_user,
+        '-p{}'.format(db_password)
+    ]
+
+
+# Execute the given SQL statements against the given database
+def exec_sql(db_name, db_host, db_user, db_password, sql):
+
+    mysql = subprocess.Popen(get_mysql_args(
+        db_name=db_name, db_host=db_host,
+        db_user=db_user, db_password=db_password) + ['-e', sql])
+    mysql.wait()
+
+    if mysql.returncode != 0:
+        raise OSError('Could not execute SQL on database. Aborting.')
+
 
-# Decompress the given backup file to a database file in the same directory
-def decompress_backup(backup_path, backup_decompressor):
+# Retrieve the names of all tables in the given database
+def get_table_names(db_name, db_host, db_user, db_password):
 
-    compressor = subprocess.Popen(
-        shlex.split(backup_decompressor) + [backup_path])
-    compressor.wait()
+    output = subprocess.check_output(get_mysql_args(
+        db_name=db_name, db_host=db_host,
+        db_user=db_user, db_password=db_password) + [
+            '--skip-column-names', '-e', 'SHOW TABLES'])
 
+    return output.decode('utf-8').splitlines()
 
-# Replace a WordPress database with the database at the given path
-def replace_db(db_name, db_host, db_user, db_password, db_path):
 
-    with open(db_path, 'r') as db_file:
+# Quote the given database/table identifier for use in a SQL statement
+def quote_identifier(*names):
 
-        # Execute SQL script on the respective database
-        mysql = subprocess.Popen([
-            'mysql',
-            db_name,
-            '-h', db_host,
-            '-u', db_user,
-            '-p{}'.format(db_password)
-        ], stdin=db_file)
+    return '.'.join('`{}`'.format(name.replace('`', '``')) for name in names)
 
-        mysql.wait()
 
+# Compute the SHA-256 checksum of the file at the given path
+def get_file_checksum(backup_path):
 
-# Purge backup and the decompressed database after it has been restored
-def purge_restored_backup(backup_path, db_path):
+    checksum = hashlib.sha256()
+    with open(backup_path, 'rb') as backup_file:
+        for chunk in iter(lambda: backup_file.read(65536), b''):
+            checksum.update(chunk)
+
+    return checksum.hexdigest()
+
+
+# Verify that the backup was transferred intact by comparing checksums
+def verify_backup_checksum(backup_path, backup_checksum):
+
+    if get_file_checksum(backup_path) != backup_checksum:
+        os.remove(backup_path)
+        raise OSError('Backup is corrupted (checksum mismatch). Aborting.')
+
+
+# Determine if the given definition within a CREATE TABLE statement is a
+# secondary index which can be added once the table's rows are loaded; an
+# index starting with an AUTO_INCREMENT column is kept, since MySQL requires
+# such a column to be indexed (ER_WRONG_AUTO_KEY)
+def is_deferrable_index(definition, auto_increment_columns):
+
+    if not secondary_index_regex.search(definition):
+        return False
+    index_column_match = index_column_regex.search(definition)
+    return not (index_column_match and
+                index_column_match.group(1) in auto_increment_columns)
+
+
+# Retrieve the (quoted) names of the AUTO_INCREMENT columns among the given
+# definitions within a CREATE TABLE statement
+def get_auto_increment_columns(definitions):
+
+    return {
+        column_match.group(1) for column_match in (
+            auto_increment_column_regex.search(definition)
+            for definition in definitions)
+        if column_match}
+
+
+# Construct the ALTER TABLE statements which add the given index definitions
+# to the given (quoted) table
+def get_add_index_statements(table_name, index_definitions):
+
+    # InnoDB only builds one FULLTEXT index per ALTER TABLE statement
+    index_groups = [[
+        definition for definition in index_definitions
+        if not definition.startswith(b'FULLTEXT')]] + [
+        [definition] for definition in index_definitions
+        if definition.startswith(b'FULLTEXT')]
+
+    return [
+        b'ALTER TABLE ' + table_name + b' ' + b', '.join(
+            b'ADD ' + definition for definition in index_group) + b';'
+        for index_group in index_groups if index_group]
+
+
+# Remove the secondary indexes from the given CREATE TABLE statement (as a
+# list of lines), returning the remaining statement along with the ALTER
+# TABLE statements which add the indexes back; tables with foreign keys are
+# left as they are, since their keys depend on the indexes
+def split_secondary_indexes(create_lines):
+
+    table_name = re.search(
+        br'^CREATE TABLE (`(?:[^`]|``)+`)', create_lines[0]).group(1)
+    definitions = create_lines[1:-1]
+    auto_increment_columns = get_auto_increment_columns(definitions)
+    index_definitions = [
+        definition.strip().rstrip(b',') for definition in definitions
+        if is_deferrable_index(definition, auto_increment_columns)]
+    if not index_definitions or any(
+            definition.lstrip().startswith(b'CONSTRAINT')
+            for definition in definitions):
+        return create_lines, []
+
+    kept_definitions = [
+        definition for definition in definitions
+        if not is_deferrable_index(definition, auto_increment_columns)]
+    kept_definitions[-1] = kept_definitions[-1].rstrip(b',')
+
+    return ([create_lines[0]] + kept_definitions + [create_lines[-1]],
+            get_add_index_statements(table_name, index_definitions))
+
+
+# Rewrite the given dump (as chunks) so that its tables are created without
+# their secondary indexes, which are added once every row has been loaded;
+# building an index in a single pass is much faster than updating it with
+# every insert
+def defer_secondary_indexes(chunks):
+
+    partial_line = []
+    create_lines = None
+    alter_statements = []
+    for chunk in chunks:
+        # Chunks without line breaks (i.e. within long INSERT statements)
+        # are held back until the line is complete
+        if b'\n' not in chunk:
+            partial_line.append(chunk)
+            continue
+        partial_line.append(chunk)
+        lines = b''.join(partial_line).split(b'\n')
+        partial_line = [lines.pop()]
+        output_lines = []
+        for line in lines:
+            if create_lines is not None:
+                create_lines.append(line)
+                if line.startswith(b')'):
+                    create_lines, table_alter_statements = (
+                        split_secondary_indexes(create_lines))
+                    output_lines.extend(create_lines)
+                    alter_statements.extend(table_alter_statements)
+                    create_lines = None
+            elif line.startswith(b'CREATE TABLE '):
+                create_lines = [line]
+            else:
+                output_lines.append(line)
+        if output_lines:
+            yield b'\n'.join(output_lines) + b'\n'
+
+    if create_lines:
+        yield b'\n'.join(create_lines) + b'\n'
+    yield b''.join(partial_line)
+    if alter_statements:
+        yield b'\n' + b'\n'.join(alter_statements) + b'\n'
+
+
+# Load the given compressed backup into a database, returning the checksum
+# of the compressed data that was read; if the sizes of the backup's
+# independently compressed blocks are given, the blocks are decompressed in
+# parallel
+def replace_db(db_name, db_host, db_user, db_password,
+               backup_file, backup_decompressor, block_sizes=None,
+               defer_indexes=False):
+
+    if block_sizes:
+        return replace_db_blocks(
+            db_name=db_name, db_host=db_host,
+            db_user=db_user, db_password=db_password,
+            backup_file=backup_file, backup_decompressor=backup_decompressor,
+            block_sizes=block_sizes, defer_indexes=defer_indexes)
+
+    checksum = hashlib.sha256()
+
+    decompressor = subprocess.Popen(
+        shlex.split(backup_decompressor),
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    mysql_args = get_mysql_args(
+        db_name=db_name, db_host=db_host,
+        db_user=db_user, db_password=db_password)
+
+    if defer_indexes:
+        mysql = subprocess.Popen(mysql_args, stdin=subprocess.PIPE)
+
+        # Rewrite the decompressed SQL script on its own thread, as the
+        # backup is fed to the decompressor
+        def rewrite_dump():
+            try:
+                for chunk in defer_secondary_indexes(
+                        iter(lambda: decompressor.stdout.read(65536), b'')):
+                    mysql.stdin.write(chunk)
+            except BrokenPipeError:
+                pass
+            finally:
+                # Allow the decompressor to receive SIGPIPE if mysql exits
+                # early
+                decompressor.stdout.close()
+                try:
+                    mysql.stdin.close()
+                except BrokenPipeError:
+                    pass
+
+        rewriter = threading.Thread(target=rewrite_dump)
+        rewriter.start()
+    else:
+        # Execute decompressed SQL script on the respective database
+        mysql = subprocess.Popen(mysql_args, stdin=decompressor.stdout)
+        rewriter = None
+
+        # Allow the decompressor to receive SIGPIPE if mysql exits early
+        decompressor.stdout.close()
 
     try:
-        os.remove(db_path)
-    except OSError:
+        for chunk in iter(lambda: backup_file.read(65536), b''):
+            checksum.update(chunk)
+            decompressor.stdin.write(chunk)
+    except BrokenPipeError:
         pass
+    finally:
+        try:
+            decompressor.stdin.close()
+        except BrokenPipeError:
+            pass
+
+    decompressor.wait()
+    if rewriter:
+        rewriter.join()
+    mysql.wait()
+
+    if decompressor.returncode != 0:
+        raise OSError('Backup could not be decompressed. Aborting.')
+    if mysql.returncode != 0:
+        raise OSError('Backup could not be loaded into database. Aborting.')
+
+    return checksum.hexdigest()
+
+
+# Load the given compressed backup (consisting of independently compressed
+# blocks of the given sizes) into a database, decompressing its blocks in
+# parallel; returns the checksum of the compressed data that was read
+def replace_db_blocks(db_name, db_host, db_user, db_password,
+                      backup_file, backup_decompressor, block_sizes,
+                      defer_indexes=False):
+
+    checksum = hashlib.sha256()
+
+    # Read the blocks in order, so the checksum covers the whole backup
+    def read_blocks():
+        for block_size in block_sizes:
+            block = backup_file.read(block_size)
+            checksum.update(block)
+            yield block
+        for chunk in iter(lambda: backup_file.read(65536), b''):
+            checksum.update(chunk)
+
+    mysql = subprocess.Popen(get_mysql_args(
+        db_name=db_name, db_host=db_host,
+        db_user=db_user, db_password=db_password),
+        stdin=subprocess.PIPE)
+
+    blocks = map_ordered(
+        lambda block: transform_block(
+            shlex.split(backup_decompressor), block),
+        read_blocks(), num_workers=os.cpu_count() or 1)
+    if defer_indexes:
+        blocks = defer_secondary_indexes(blocks)
+
+    try:
+        for block in blocks:
+            mysql.stdin.write(block)
+    except BrokenPipeError:
+        pass
+    finally:
+        try:
+            mysql.stdin.close()
+        except BrokenPipeError:
+            pass
+
+    mysql.wait()
+
+    if mysql.returncode != 0:
+        raise OSError('Backup could not be loaded into database. Aborting.')
+
+    return checksum.hexdigest()
+
+
+# Drop every table in the staging database so it can be loaded afresh
+def empty_staging_db(db_host, db_user, db_password, staging_db):
+
+    table_names = get_table_names(
+        db_name=staging_db, db_host=db_host,
+        db_user=db_user, db_password=db_password)
+
+    if table_names:
+        exec_sql(
+            db_name=staging_db, db_host=db_host,
+            db_user=db_user, db_password=db_password,
+            sql='DROP TABLE {}'.format(', '.join(
+                quote_identifier(staging_db, table_name)
+                for table_name in table_names)))
+
+
+# Atomically swap the restored tables in the staging database into the
+# WordPress database, then drop the tables that were replaced
+def swap_staging_tables(db_name, db_host, db_user, db_password, staging_db):
+
+    staged_tables = get_table_names(
+        db_name=staging_db, db_host=db_host,
+        db_user=db_user, db_password=db_password)
+    existing_tables = set(get_table_names(
+        db_name=db_name, db_host=db_host,
+        db_user=db_user, db_password=db_password))
+
+    renames = []
+    replaced_tables = []
+    for table_name in staged_tables:
+        if table_name in existing_tables:
+            replaced_table = 'swb_old_{}'.format(table_name)
+            renames.append('{} TO {}'.format(
+                quote_identifier(db_name, table_name),
+                quote_identifier(staging_db, replaced_table)))
+            replaced_tables.append(replaced_table)
+        renames.append('{} TO {}'.format(
+            quote_identifier(staging_db, table_name),
+            quote_identifier(db_name, table_name)))
+
+    if not renames:
+        raise OSError('Staging database is empty. Aborting.')
+
+    # A single RENAME TABLE statement is applied atomically by MySQL
+    exec_sql(
+        db_name=db_name, db_host=db_host,
+        db_user=db_user, db_password=db_password,
+        sql='RENAME TABLE {}'.format(', '.join(renames)))
+
+    if replaced_tables:
+        exec_sql(
+            db_name=staging_db, db_host=db_host,
+            db_user=db_user, db_password=db_password,
+            sql='DROP TABLE {}'.format(', '.join(
+                quote_identifier(staging_db, table_name)
+                for table_name in replaced_tables)))
+
+
+# Create the staging database used when none is configured (named after the
+# WordPress database), returning its name
+def create_default_staging_db(db_info):
+
+    staging_db = '{}_swb_staging'.format(db_info['name'])
+    exec_sql(
+        db_name=db_info['name'], db_host=db_info['host'],
+        db_user=db_info['user'], db_password=db_info['password'],
+        sql='CREATE DATABASE IF NOT EXISTS {}'.format(
+            quote_identifier(staging_db)))
+
+    return staging_db
+
+
+# Drop the staging database created when none is configured
+def drop_default_staging_db(db_info, staging_db):
+
+    exec_sql(
+        db_name=db_info['name'], db_host=db_info['host'],
+        db_user=db_info['user'], db_password=db_info['password'],
+        sql='DROP DATABASE {}'.format(quote_identifier(staging_db)))
+
+
+# Load the given backup into the WordPress database via the given staging
+# database (or else a temporary one), unless loading it directly was chosen
+def load_backup(db_info, backup_file, backup_decompressor,
+                backup_checksum, staging_db, block_sizes=None,
+                defer_indexes=False, direct_load=False):
+
+    default_staging = not staging_db and not direct_load
+    if default_staging:
+        staging_db = create_default_staging_db(db_info)
+
+    if staging_db:
+        if staging_db == db_info['name']:
+            raise OSError('Staging database must differ from the WordPress'
+                          ' database. Aborting.')
+        empty_staging_db(
+            db_host=db_info['host'], db_user=db_info['user'],
+            db_password=db_info['password'], staging_db=staging_db)
+
+    checksum = replace_db(
+        db_name=staging_db or db_info['name'], db_host=db_info['host'],
+        db_user=db_info['user'], db_password=db_info['password'],
+        backup_file=backup_file, backup_decompressor=backup_decompressor,
+        block_sizes=block_sizes, defer_indexes=defer_indexes)
+
+    if backup_checksum and checksum != backup_checksum:
+        raise OSError('Backup is corrupted (checksum mismatch). Aborting.')
+
+    if staging_db:
+        swap_staging_tables(
+            db_name=db_info['name'], db_host=db_info['host'],
+            db_user=db_info['user'], db_password=db_info['password'],
+            staging_db=staging_db)
+
+    if default_staging:
+        drop_default_staging_db(db_info, staging_db)
+
+
+# Parse the comma-separated sizes of the blocks making up a backup
+def parse_block_sizes(backup_blocks):
+
+    return [int(block_size) for block_size in backup_blocks.split(',')
+            if block_size]
+
+
+# Purge backup after it has been restored
+def purge_restored_backup(backup_path):
+
     try:
         os.remove(backup_path)
     except OSError:
@@ -138,24 +1563,143 @@ def purge_restored_backup(backup_path, db_path):
 
 
 # Restore WordPress database using the given remote backup
-def restore(wordpress_path, backup_path, backup_decompressor):
+def restore(wordpress_path, backup_path, backup_decompressor,
+            backup_checksum='', staging_db='', backup_blocks='',
+            defer_indexes='', direct_load=''):
 
     wordpress_path = os.path.expanduser(wordpress_path)
     backup_path = os.path.expanduser(backup_path)
+
+    # Validate the uploaded backup before the database is touched
     verify_backup_integrity(backup_path)
-    decompress_backup(
-        backup_path=backup_path,
-        backup_decompressor=backup_decompressor)
+    if backup_checksum:
+        verify_backup_checksum(backup_path, backup_checksum)
 
     db_info = get_db_info(wordpress_path)
-    db_path = os.path.splitext(backup_path)[0]
 
-    replace_db(
+    with open(backup_path, 'rb') as backup_file:
+        load_backup(
+            db_info=db_info, backup_file=backup_file,
+            backup_decompressor=backup_decompressor,
+            backup_checksum=backup_checksum, staging_db=staging_db,
+            block_sizes=parse_block_sizes(backup_blocks),
+            defer_indexes=bool(defer_indexes),
+            direct_load=bool(direct_load))
+
+    purge_restored_backup(backup_path)
+
+
+# Restore WordPress database from a compressed backup streamed via stdin
+def restore_stream(wordpress_path, backup_decompressor,
+                   backup_checksum='', staging_db='', backup_blocks='',
+                   defer_indexes='', direct_load=''):
+
+    # The streamed backup is only verified once it has been loaded, so it is
+    # never loaded directly into the WordPress database
+    if direct_load:
+        raise OSError('Streamed restores cannot be loaded directly into the'
+                      ' database. Aborting.')
+
+    wordpress_path = os.path.expanduser(wordpress_path)
+    db_info = get_db_info(wordpress_path)
+
+    load_backup(
+        db_info=db_info, backup_file=sys.stdin.buffer,
+        backup_decompressor=backup_decompressor,
+        backup_checksum=backup_checksum, staging_db=staging_db,
+        block_sizes=parse_block_sizes(backup_blocks),
+        defer_indexes=bool(defer_indexes))
+
+
+# Run the given SQL query against the given database, returning the rows of
+# the result as lists of column values
+def query_db(db_name, db_host, db_user, db_password, sql):
+
+    output = subprocess.check_output(get_mysql_args(
+        db_name=db_name, db_host=db_host,
+        db_user=db_user, db_password=db_password) + [
+            '--skip-column-names', '--batch', '-e', sql])
+
+    return [row.split('\t') for row in output.decode('utf-8').splitlines()]
+
+
+# Retrieve the binlog file and position the server is currently writing to
+def get_current_binlog_position(db_info):
+
+    db_args = dict(
+        db_name=db_info['name'], db_host=db_info['host'],
+        db_user=db_info['user'], db_password=db_info['password'])
+    try:
+        rows = query_db(sql='SHOW MASTER STATUS', **db_args)
+    except subprocess.CalledProcessError:
+        # SHOW MASTER STATUS was removed in MySQL 8.4
+        rows = query_db(sql='SHOW BINARY LOG STATUS', **db_args)
+
+    if not rows:
+        raise OSError('Binary logging is not enabled. Aborting.')
+
+    return rows[0][0], int(rows[0][1])
+
+
+# Retrieve the names of the binlog files from the first to the last given
+def get_binlog_files(db_info, start_file, end_file):
+
+    binlog_files = [row[0] for row in query_db(
         db_name=db_info['name'], db_host=db_info['host'],
         db_user=db_info['user'], db_password=db_info['password'],
-        db_path=db_path)
+        sql='SHOW BINARY LOGS')]
+
+    return [binlog_file for binlog_file in binlog_files
+            if start_file <= binlog_file <= end_file]
+
+
+# Stream the binlog events from the given position to the current position
+# via stdout, preceded by a header recording where the events end
+def stream_binlog(wordpress_path, start_file, start_position):
+
+    wordpress_path = os.path.expanduser(wordpress_path)
+    db_info = get_db_info(wordpress_path)
+    end_file, end_position = get_current_binlog_position(db_info)
+    binlog_files = get_binlog_files(db_info, start_file, end_file)
+
+    sys.stdout.write('-- swb-binlog-end: {} {}\n'.format(
+        end_file, end_position))
+    sys.stdout.flush()
+
+    # The start position applies to the first file and the stop position to
+    # the last file; the binlog is shared by every database on the server,
+    # so only the events of the site's own database are kept, and the times
+    # of the events are printed in UTC (so they do not depend on the
+    # server's timezone)
+    mysqlbinlog = subprocess.Popen([
+        'mysqlbinlog',
+        '--read-from-remote-server',
+        '-h', db_info['host'],
+        '-u', db_info['user'],
+        '-p{}'.format(db_info['password']),
+        '--database={}'.format(db_info['name']),
+        '--start-position={}'.format(start_position),
+        '--stop-position={}'.format(end_position)
+    ] + binlog_files, env=dict(os.environ, TZ='UTC'))
+    mysqlbinlog.wait()
+
+    if mysqlbinlog.returncode != 0:
+        raise OSError('Binlog could not be read. Aborting.')
 
-    purge_restored_backup(backup_path=backup_path, db_path=db_path)
+
+# Replay the binlog events piped via stdin on the WordPress database
+def replay_binlog(wordpress_path):
+
+    wordpress_path = os.path.expanduser(wordpress_path)
+    db_info = get_db_info(wordpress_path)
+
+    mysql = subprocess.Popen(get_mysql_args(
+        db_name=db_info['name'], db_host=db_info['host'],
+        db_user=db_info['user'], db_password=db_info['password']))
+    mysql.wait()
+
+    if mysql.returncode != 0:
+        raise OSError('Binlog could not be replayed. Aborting.')
 
 
 def main():
@@ -163,8 +1707,29 @@ def main():
     # Parse action to take as well as the action's respective arguments
     action, *action_args = sys.argv[1:]
 
+    # Lock waits exit with their own status, so they can be retried
+    try:
+        run_action(action, action_args)
+    except TimeoutError as error:
+        print(error, file=sys.stderr)
+        sys.exit(lock_wait_exit_status)
+
+
+# Run the given action of the remote script with the given arguments
+def run_action(action, action_args):
+
     if action == 'restore':
         restore(*action_args)
+    elif action == 'restore-stream':
+        restore_stream(*action_args)
+    elif action == 'binlog':
+        stream_binlog(*action_args)
+    elif action == 'replay-binlog':
+        replay_binlog(*action_args)
+    elif action == 'back-up-delta':
+        back_up_delta(*action_args)
+    elif action == 'back-up-fleet':
+        back_up_fleet(*action_args)
     elif action == 'purge-backup':
         purge_downloaded_backup(*action_args)
     else:
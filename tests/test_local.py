@@ -1,13 +1,33 @@
 #!/usr/bin/env python3
 
+import calendar
 import configparser
+import hashlib
+import io
+import json
 import os
 import os.path
 import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
 import nose.tools as nose
 import swb.local as swb
 from time import strftime
-from mock import ANY, call, patch
+from mock import ANY, Mock, call, patch
+
+
+def test_lazy_imports():
+    """should not import modules only needed by some actions at startup"""
+    imported_modules = subprocess.check_output([
+        sys.executable, '-c',
+        'import sys, swb.local; print(" ".join(sys.modules))'
+    ]).decode('utf-8').split()
+    for module_name in ('configparser', 'json', 'sqlite3', 'subprocess',
+                        'threading', 'pipes', 'http.server'):
+        nose.assert_not_in(module_name, imported_modules)
 
 
 def test_parse_config():
@@ -61,21 +81,111 @@ def test_quote_arg_str(unquote_home_dir):
     unquote_home_dir.assert_called_once_with('\'a/b c/d\'')
 
 
-@patch('swb.local.unquote_home_dir', side_effect=lambda x: x)
-@patch('swb.local.shlex')
-def test_quote_arg_py32(shlex, unquote_home_dir):
-    """should correctly quote arguments passed to the shell on Python 3.2"""
-    del shlex.quote
-    nose.assert_false(hasattr(shlex, 'quote'))
-    quoted_arg = swb.quote_arg('a/b c/d')
-    nose.assert_equal(quoted_arg, '\'a/b c/d\'')
-    unquote_home_dir.assert_called_once_with('\'a/b c/d\'')
+@patch('builtins.open')
+def test_read_remote_script(builtin_open):
+    """should key the cached remote script by the hash of its contents"""
+    builtin_open.return_value.__enter__().read.return_value = b'print(1)'
+    contents, path = swb.read_remote_script()
+    builtin_open.assert_called_once_with(swb.remote_driver_path, 'rb')
+    nose.assert_equal(contents, b'print(1)')
+    nose.assert_equal(path, '~/.cache/ssh-wp-backup/remote-{}.py'.format(
+        hashlib.sha256(b'print(1)').hexdigest()[:16]))
 
 
 @patch('subprocess.Popen', spec=subprocess.Popen)
-@patch('builtins.open')
-def test_exec_on_remote(builtin_open, popen):
-    """should execute script on remote server"""
+def test_install_remote_script(popen):
+    """should upload the remote script to the remote cache if missing"""
+    popen.return_value.returncode = 0
+    swb.install_remote_script(
+        'myname', 'mysite.com', '2222',
+        remote_script_contents=b'print(1)',
+        remote_script_path='~/.cache/ssh-wp-backup/remote-abc.py',
+        stderr=2)
+    popen.assert_called_once_with([
+        'ssh', '-p 2222', 'myname@mysite.com',
+        'test -f ~/.cache/ssh-wp-backup/remote-abc.py || {'
+        ' mkdir -p ~/.cache/ssh-wp-backup'
+        ' && cat > ~/.cache/ssh-wp-backup/remote-abc.py.$$.tmp'
+        ' && mv ~/.cache/ssh-wp-backup/remote-abc.py.$$.tmp'
+        ' ~/.cache/ssh-wp-backup/remote-abc.py; }'],
+        stdin=subprocess.PIPE, stderr=2)
+    popen.return_value.communicate.assert_called_once_with(b'print(1)')
+
+
+def test_get_transport_default():
+    """should reach the remote via SSH if no transport is configured"""
+    config = configparser.RawConfigParser()
+    config.read('tests/files/config.ini')
+    nose.assert_equal(swb.get_transport(config), 'ssh')
+
+
+def test_get_transport_unknown():
+    """should raise OSError if the configured transport is unknown"""
+    config = configparser.RawConfigParser()
+    config.read('tests/files/config.ini')
+    config.set('ssh', 'transport', 'telnet')
+    with nose.assert_raises(OSError):
+        swb.get_transport(config)
+
+
+def test_get_remote_args_local():
+    """should run remote commands in a local shell from the home directory"""
+    nose.assert_equal(swb.get_remote_args(
+        'myname', 'mysite.com', '2222', 'cat', '~/\'a b\'',
+        transport='local'), ['sh', '-c', 'cd && cat ~/\'a b\''])
+
+
+@patch('subprocess.Popen', spec=subprocess.Popen)
+def test_run_ssh_output(popen):
+    """should return the exit status and output of the SSH command"""
+    popen.return_value.returncode = 0
+    popen.return_value.stdout = io.BytesIO(b'abc')
+    nose.assert_equal(swb.run_ssh(
+        ['ssh'], stdin=None, stdout=subprocess.PIPE, stderr=2), (0, b'abc'))
+
+
+@patch('subprocess.Popen', spec=subprocess.Popen)
+def test_run_ssh_read_output(popen):
+    """should pass the output stream of the SSH command to the given reader"""
+    popen.return_value.returncode = 0
+    popen.return_value.stdout = io.BytesIO(b'abc')
+    nose.assert_equal(swb.run_ssh(
+        ['ssh'], stdin=None, stdout=subprocess.PIPE, stderr=2,
+        read_output=lambda output_stream: output_stream.read(2)), (0, b'ab'))
+
+
+def test_relay_stderr():
+    """should separate progress reports from the rest of the remote's stderr"""
+    output_file = io.StringIO()
+    read_progress = Mock()
+    swb.relay_stderr(io.BytesIO(
+        b'swb-progress: {"dumped_bytes": 10}\n  (stdin): 4.2:1\n'),
+        output_file, read_progress=read_progress)
+    read_progress.assert_called_once_with({'dumped_bytes': 10})
+    nose.assert_equal(output_file.getvalue(), '  (stdin): 4.2:1\n')
+
+
+def test_run_ssh_progress():
+    """should pass the progress reported by the command to the given reader"""
+    output_file = io.StringIO()
+    read_progress = Mock()
+    nose.assert_equal(swb.run_ssh(
+        ['sh', '-c', 'echo abc >&2; echo \'swb-progress: {"a": 1}\' >&2'],
+        stdin=None, stdout=None, stderr=output_file,
+        read_progress=read_progress), (0, None))
+    read_progress.assert_called_once_with({'a': 1})
+    nose.assert_equal(output_file.getvalue(), 'abc\n')
+
+
+REMOTE_SCRIPT_PATH = '~/.cache/ssh-wp-backup/remote-abc.py'
+
+
+@patch('swb.local.read_remote_script', return_value=(
+    b'print(1)', REMOTE_SCRIPT_PATH))
+@patch('swb.local.install_remote_script')
+@patch('subprocess.Popen', spec=subprocess.Popen)
+def test_exec_on_remote(popen, install_remote_script, read_remote_script):
+    """should execute cached script on remote server"""
     popen.return_value.returncode = 0
     swb.exec_on_remote(
         ssh_user='myname', ssh_hostname='mysite.com', ssh_port='2222',
@@ -84,16 +194,64 @@ def test_exec_on_remote(builtin_open, popen):
         stdout=1, stderr=2)
     popen.assert_called_once_with([
         'ssh', '-p 2222', 'myname@mysite.com',
-        'python3', '-', 'back-up', '~/\'public_html/mysite\'',
+        'test -f {path} || exit 75; exec python3 {path}'.format(
+            path=REMOTE_SCRIPT_PATH),
+        'back-up', '~/\'public_html/mysite\'',
         '\'bzip2 -v\'', '\'a/b c/d\''],
-        stdin=builtin_open.return_value.__enter__(), stdout=1, stderr=2)
+        stdin=None, stdout=1, stderr=2)
     popen.return_value.wait.assert_called_once_with()
+    install_remote_script.assert_not_called()
+
+
+@patch('swb.local.read_remote_script', return_value=(
+    b'print(1)', REMOTE_SCRIPT_PATH))
+@patch('swb.local.install_remote_script')
+@patch('subprocess.Popen', spec=subprocess.Popen)
+def test_exec_on_remote_cache_miss(popen, install_remote_script,
+                                   read_remote_script):
+    """should upload remote script and retry if it is not yet cached"""
+    first_ssh = Mock(returncode=75)
+    second_ssh = Mock(returncode=0)
+    popen.side_effect = [first_ssh, second_ssh]
+    swb.exec_on_remote(
+        ssh_user='myname', ssh_hostname='mysite.com', ssh_port='2222',
+        action='purge-backup', action_args=['a/b c/d'],
+        stdout=1, stderr=2)
+    install_remote_script.assert_called_once_with(
+        'myname', 'mysite.com', '2222',
+        remote_script_contents=b'print(1)',
+        remote_script_path=REMOTE_SCRIPT_PATH, stderr=2,
+        transport='ssh')
+    nose.assert_equal(popen.call_count, 2)
+    second_ssh.wait.assert_called_once_with()
+
+
+@patch('swb.local.read_remote_script', return_value=(
+    b'print(1)', REMOTE_SCRIPT_PATH))
+@patch('swb.local.install_remote_script')
+@patch('subprocess.Popen', spec=subprocess.Popen)
+def test_exec_on_remote_stdin(popen, install_remote_script,
+                              read_remote_script):
+    """should cache remote script beforehand if stdin is needed by action"""
+    popen.return_value.returncode = 0
+    swb.exec_on_remote(
+        ssh_user='myname', ssh_hostname='mysite.com', ssh_port='2222',
+        action='restore-stream',
+        action_args=['~/public_html/mysite', 'bzip2 -d'],
+        stdin=3, stdout=1, stderr=2)
+    install_remote_script.assert_called_once_with(
+        'myname', 'mysite.com', '2222',
+        remote_script_contents=b'print(1)',
+        remote_script_path=REMOTE_SCRIPT_PATH, stderr=2,
+        transport='ssh')
+    nose.assert_equal(popen.call_args[1]['stdin'], 3)
 
 
 @patch('sys.exit')
+@patch('swb.local.read_remote_script', return_value=(
+    b'print(1)', REMOTE_SCRIPT_PATH))
 @patch('subprocess.Popen', spec=subprocess.Popen)
-@patch('builtins.open')
-def test_exec_on_remote_nonzero_return(builtin_open, popen, exit):
+def test_exec_on_remote_nonzero_return(popen, read_remote_script, exit):
     """should exit script if nonzero status code is returned"""
     popen.return_value.returncode = 3
     swb.exec_on_remote(
@@ -106,6 +264,7 @@ def test_exec_on_remote_nonzero_return(builtin_open, popen, exit):
 @patch('subprocess.Popen', spec=subprocess.Popen)
 def test_transfer_file_download(popen):
     """should download backup from remote server when backing up"""
+    popen.return_value.returncode = 0
     swb.transfer_file(
         ssh_user='myname', ssh_hostname='mysite.com', ssh_port='2222',
         src_path='a/b c/d', dest_path='e/f g/h',
@@ -119,6 +278,7 @@ def test_transfer_file_download(popen):
 @patch('subprocess.Popen', spec=subprocess.Popen)
 def test_transfer_file_upload(popen):
     """should upload backup to remote server when restoring"""
+    popen.return_value.returncode = 0
     swb.transfer_file(
         ssh_user='myname', ssh_hostname='mysite.com', ssh_port='2222',
         src_path='a/b c/d', dest_path='e/f g/h',
@@ -129,31 +289,311 @@ def test_transfer_file_upload(popen):
     popen.return_value.wait.assert_called_once_with()
 
 
-@patch('swb.local.exec_on_remote')
+@patch('subprocess.Popen', spec=subprocess.Popen)
+def test_transfer_file_upload_local(popen):
+    """should copy backup into the home directory with the local transport"""
+    popen.return_value.returncode = 0
+    swb.transfer_file(
+        ssh_user='myname', ssh_hostname='mysite.com', ssh_port='2222',
+        src_path='a/b c/d', dest_path='e/f g/h',
+        action='upload', stdout=1, stderr=2, transport='local')
+    popen.assert_called_once_with(
+        ['cp', 'a/b c/d', os.path.expanduser('~/e/f g/h')],
+        stdout=1, stderr=2)
+
+
+@patch('sys.exit')
+@patch('subprocess.Popen', spec=subprocess.Popen)
+def test_transfer_file_nonzero_return(popen, exit):
+    """should exit script if file transfer fails"""
+    popen.return_value.returncode = 1
+    swb.transfer_file(
+        ssh_user='myname', ssh_hostname='mysite.com', ssh_port='2222',
+        src_path='a/b c/d', dest_path='e/f g/h',
+        action='upload', stdout=1, stderr=2)
+    exit.assert_called_once_with(1)
+
+
+@patch('swb.local.read_remote_script', return_value=(
+    b'print(1)', REMOTE_SCRIPT_PATH))
+@patch('subprocess.Popen', spec=subprocess.Popen)
+def test_exec_on_remote_output(popen, read_remote_script):
+    """should return output of remote script if it was requested"""
+    popen.return_value.returncode = 0
+    popen.return_value.stdout = io.BytesIO(b'abc')
+    output = swb.exec_on_remote(
+        ssh_user='myname', ssh_hostname='mysite.com', ssh_port='2222',
+        action='back-up', action_args=[],
+        stdout=subprocess.PIPE, stderr=2)
+    nose.assert_equal(output, b'abc')
+
+
+@patch('swb.local.exec_on_remote', return_value=b'{"raw_size": 8192}')
 def test_create_remote_backup(exec_on_remote):
     """should execute remote script when creating remote backup"""
-    swb.create_remote_backup(
+    backup_stats = swb.create_remote_backup(
         ssh_user='myname', ssh_hostname='mysite.com', ssh_port='2222',
         wordpress_path='a/b c/d', remote_backup_path='e/f g/h',
-        backup_compressor='bzip2 -v',
+        backup_compressor='bzip2 -v', backup_options={'a': 1},
         stdout=1, stderr=2)
     exec_on_remote.assert_called_once_with(
         ssh_user='myname', ssh_hostname='mysite.com', ssh_port='2222',
-        action='back-up', action_args=['a/b c/d', 'bzip2 -v', 'e/f g/h'],
-        stdout=1, stderr=2)
+        transport='ssh',
+        action='back-up',
+        action_args=['a/b c/d', 'bzip2 -v', 'e/f g/h', '{"a": 1}'],
+        stdout=subprocess.PIPE, stderr=2, read_progress=None)
+    nose.assert_equal(backup_stats, {'raw_size': 8192})
 
 
-@patch('swb.local.transfer_file')
-def test_download_remote_backup(transfer_file):
-    """should download remote backup after creation"""
-    swb.download_remote_backup(
+@patch('swb.local.exec_on_remote', return_value=b'{"raw_size": 8192}')
+def test_create_remote_backup_delta(exec_on_remote):
+    """should request a delta against the given basis from the remote"""
+    swb.create_remote_backup(
         ssh_user='myname', ssh_hostname='mysite.com', ssh_port='2222',
-        remote_backup_path='a/b c/d', local_backup_path='e/f g/h',
-        stdout=1, stderr=2)
-    transfer_file.assert_called_once_with(
+        wordpress_path='a/b c/d', remote_backup_path='e/f g/h',
+        backup_compressor='bzip2 -v', backup_options={},
+        basis_checksum='abc', stdout=1, stderr=2)
+    exec_on_remote.assert_called_once_with(
         ssh_user='myname', ssh_hostname='mysite.com', ssh_port='2222',
-        src_path='a/b c/d', dest_path='e/f g/h',
-        action='download', stdout=1, stderr=2)
+        transport='ssh',
+        action='back-up-delta',
+        action_args=['a/b c/d', 'bzip2 -v', 'e/f g/h', 'abc', '{}'],
+        stdout=subprocess.PIPE, stderr=2, read_progress=None)
+
+
+@patch('subprocess.Popen')
+def test_download_remote_backup(popen):
+    """should stream remote backup to local backup path and replicas"""
+    popen.return_value.stdout = io.BytesIO(b'abc')
+    popen.return_value.returncode = 0
+    with tempfile.TemporaryDirectory() as temp_dir:
+        local_backup_path = os.path.join(temp_dir, 'a.sql.bz2')
+        replica_path = os.path.join(temp_dir, 'nas', 'b.sql.bz2')
+        download_stats = swb.download_remote_backup(
+            ssh_user='myname', ssh_hostname='mysite.com', ssh_port='2222',
+            remote_backup_path='a/b c/d', local_backup_path=local_backup_path,
+            replicas=[{'name': 'nas', 'path': replica_path}],
+            stdout=1, stderr=2)
+        with open(local_backup_path, 'rb') as local_backup:
+            nose.assert_equal(local_backup.read(), b'abc')
+        with open(replica_path, 'rb') as replica:
+            nose.assert_equal(replica.read(), b'abc')
+    popen.assert_called_once_with(
+        ['ssh', '-p 2222', 'myname@mysite.com', 'cat', '\'a/b c/d\''],
+        stdout=subprocess.PIPE, stderr=2)
+    nose.assert_equal(download_stats, {
+        'backup_size': 3, 'checksum': hashlib.sha256(b'abc').hexdigest(),
+        'failed_replicas': []})
+
+
+@patch('sys.exit')
+@patch('subprocess.Popen')
+def test_download_remote_backup_nonzero_return(popen, exit):
+    """should exit script if remote backup could not be read"""
+    popen.return_value.stdout = io.BytesIO(b'')
+    popen.return_value.returncode = 1
+    with tempfile.TemporaryDirectory() as temp_dir:
+        swb.download_remote_backup(
+            ssh_user='myname', ssh_hostname='mysite.com', ssh_port='2222',
+            remote_backup_path='a/b c/d',
+            local_backup_path=os.path.join(temp_dir, 'a.sql.bz2'),
+            stdout=1, stderr=2)
+    exit.assert_called_once_with(1)
+
+
+@patch('sys.exit')
+@patch('subprocess.Popen')
+def test_download_remote_backup_partial(popen, exit):
+    """should not leave partially downloaded backups in place"""
+    popen.return_value.stdout = io.BytesIO(b'abc')
+    popen.return_value.returncode = 255
+    with tempfile.TemporaryDirectory() as temp_dir:
+        swb.download_remote_backup(
+            ssh_user='myname', ssh_hostname='mysite.com', ssh_port='2222',
+            remote_backup_path='a/b c/d',
+            local_backup_path=os.path.join(temp_dir, 'a.sql.bz2'),
+            stdout=1, stderr=2)
+        nose.assert_equal(os.listdir(temp_dir), [])
+    exit.assert_called_once_with(255)
+
+
+@patch('subprocess.Popen')
+def test_download_remote_backup_size_mismatch(popen):
+    """should raise error if fewer bytes are received than expected"""
+    popen.return_value.stdout = io.BytesIO(b'abc')
+    popen.return_value.returncode = 0
+    with tempfile.TemporaryDirectory() as temp_dir:
+        with nose.assert_raises(OSError):
+            swb.download_remote_backup(
+                ssh_user='myname', ssh_hostname='mysite.com',
+                ssh_port='2222', remote_backup_path='a/b c/d',
+                local_backup_path=os.path.join(temp_dir, 'a.sql.bz2'),
+                expected_size=4096, stdout=1, stderr=2)
+        nose.assert_equal(os.listdir(temp_dir), [])
+
+
+@patch('os.fsync')
+@patch('subprocess.Popen')
+def test_download_remote_backup_fsync(popen, fsync):
+    """should flush the backup to disk before moving it into place"""
+    popen.return_value.stdout = io.BytesIO(b'abc')
+    popen.return_value.returncode = 0
+    with tempfile.TemporaryDirectory() as temp_dir:
+        swb.download_remote_backup(
+            ssh_user='myname', ssh_hostname='mysite.com', ssh_port='2222',
+            remote_backup_path='a/b c/d',
+            local_backup_path=os.path.join(temp_dir, 'a.sql.bz2'),
+            stdout=1, stderr=2)
+        nose.assert_equal(os.listdir(temp_dir), ['a.sql.bz2'])
+    nose.assert_equal(fsync.call_count, 1)
+
+
+def test_commit_temp_file_buffered():
+    """should write out everything written to a temporary file"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, 'a.sql.bz2')
+        temp_file = swb.open_temp_file(path)
+        nose.assert_is_instance(temp_file, io.BufferedWriter)
+        temp_file.write(b'abc')
+        swb.commit_temp_file(temp_file, path)
+        with open(path, 'rb') as backup_file:
+            nose.assert_equal(backup_file.read(), b'abc')
+        nose.assert_equal(os.listdir(temp_dir), ['a.sql.bz2'])
+
+
+@patch('swb.local.open_replica')
+@patch('subprocess.Popen')
+def test_download_remote_backup_replica_fail(popen, open_replica):
+    """should keep the backup but report replica commands which fail"""
+    popen.return_value.stdout = io.BytesIO(b'abc')
+    popen.return_value.returncode = 0
+    open_replica.return_value = (io.BytesIO(), Mock(returncode=1))
+    with tempfile.TemporaryDirectory() as temp_dir:
+        download_stats = swb.download_remote_backup(
+            ssh_user='myname', ssh_hostname='mysite.com',
+            ssh_port='2222', remote_backup_path='a/b c/d',
+            local_backup_path=os.path.join(temp_dir, 'a.sql.bz2'),
+            replicas=[{'name': 's3', 'command': 'mc pipe s3/a'}],
+            stdout=1, stderr=2)
+        nose.assert_equal(os.listdir(temp_dir), ['a.sql.bz2'])
+    nose.assert_equal(download_stats['failed_replicas'], ['s3'])
+
+
+@patch('swb.local.open_replica')
+@patch('subprocess.Popen')
+def test_download_remote_backup_replica_write_fail(popen, open_replica):
+    """should keep the backup and other replicas if a replica fails"""
+    popen.return_value.stdout = io.BytesIO(b'abc' * 100000)
+    popen.return_value.returncode = 0
+    replica = Mock()
+    replica.process.returncode = 0
+    replica.temp_file.write.side_effect = OSError
+    open_replica.side_effect = [
+        (replica.temp_file, None), (replica.input, replica.process)]
+    with tempfile.TemporaryDirectory() as temp_dir:
+        replica.temp_file.name = os.path.join(temp_dir, '.b.part')
+        download_stats = swb.download_remote_backup(
+            ssh_user='myname', ssh_hostname='mysite.com',
+            ssh_port='2222', remote_backup_path='a/b c/d',
+            local_backup_path=os.path.join(temp_dir, 'a.sql.bz2'),
+            replicas=[{'name': 'nas', 'path': os.path.join(temp_dir, 'b')},
+                      {'name': 's3', 'command': 'mc pipe s3/a'}],
+            stdout=1, stderr=2)
+        nose.assert_equal(os.listdir(temp_dir), ['a.sql.bz2'])
+    nose.assert_equal(download_stats['failed_replicas'], ['nas'])
+    replica.process.kill.assert_not_called()
+    nose.assert_equal(
+        b''.join(write_call[1][0] for write_call
+                 in replica.input.write.mock_calls),
+        b'abc' * 100000)
+
+
+@patch('sys.exit', side_effect=SystemExit)
+@patch('swb.local.open_replica')
+@patch('subprocess.Popen')
+def test_download_remote_backup_replica_abort(popen, open_replica, exit):
+    """should kill replica commands before ending their input on failure"""
+    popen.return_value.stdout = io.BytesIO(b'abc')
+    popen.return_value.returncode = 255
+    replica = Mock()
+    open_replica.return_value = (replica.input, replica.process)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        with nose.assert_raises(SystemExit):
+            swb.download_remote_backup(
+                ssh_user='myname', ssh_hostname='mysite.com',
+                ssh_port='2222', remote_backup_path='a/b c/d',
+                local_backup_path=os.path.join(temp_dir, 'a.sql.bz2'),
+                replicas=[{'name': 's3', 'command': 'mc pipe s3/a'}],
+                stdout=1, stderr=2)
+    nose.assert_equal(replica.mock_calls[-4:], [
+        call.process.kill(), call.process.wait(), call.input.close(),
+        call.process.wait()])
+    exit.assert_called_once_with(255)
+
+
+@patch('swb.local.tee_stream', side_effect=OSError)
+@patch('swb.local.open_replica')
+def test_copy_to_replicas_abort(open_replica, tee_stream):
+    """should kill replica commands before ending their input on failure"""
+    replica = Mock()
+    open_replica.side_effect = [
+        (replica.input, replica.process), (replica.temp_file, None)]
+    with tempfile.TemporaryDirectory() as temp_dir:
+        replica.temp_file.name = os.path.join(temp_dir, '.b.part')
+        local_backup_path = os.path.join(temp_dir, 'a.sql.bz2')
+        with open(local_backup_path, 'wb') as local_backup:
+            local_backup.write(b'abc')
+        with nose.assert_raises(OSError):
+            swb.copy_to_replicas(
+                local_backup_path, [
+                    {'name': 's3', 'command': 'mc pipe s3/a'},
+                    {'name': 'nas', 'path': os.path.join(temp_dir, 'b')}],
+                stdout=1, stderr=2)
+    nose.assert_equal(replica.mock_calls[-5:], [
+        call.process.kill(), call.process.wait(), call.input.close(),
+        call.process.wait(), call.temp_file.close()])
+
+
+def test_tee_stream():
+    """should copy input stream to every output, returning its checksum"""
+    output_files = [io.BytesIO(), io.BytesIO()]
+    num_bytes, checksum = swb.tee_stream(
+        io.BytesIO(b'abc' * 100000), output_files)
+    nose.assert_equal(num_bytes, 300000)
+    nose.assert_equal(checksum, hashlib.sha256(b'abc' * 100000).hexdigest())
+    for output_file in output_files:
+        nose.assert_equal(output_file.getvalue(), b'abc' * 100000)
+
+
+def test_tee_stream_single():
+    """should copy input stream to a single output via a fixed buffer"""
+    output_file = io.BytesIO()
+    num_bytes, checksum = swb.tee_stream(
+        io.BytesIO(b'abc' * 1000000), [output_file])
+    nose.assert_equal(num_bytes, 3000000)
+    nose.assert_equal(checksum, hashlib.sha256(b'abc' * 1000000).hexdigest())
+    nose.assert_equal(output_file.getvalue(), b'abc' * 1000000)
+
+
+def test_tee_stream_error():
+    """should raise the error of any output that could not be written"""
+    failing_file = Mock()
+    failing_file.write.side_effect = OSError
+    with nose.assert_raises(OSError):
+        swb.tee_stream(
+            io.BytesIO(b'abc' * 100000), [io.BytesIO(), failing_file])
+
+
+@patch('subprocess.Popen')
+def test_open_replica_command(popen):
+    """should pipe backup into the command of a command replica"""
+    output_file, process = swb.open_replica(
+        {'name': 's3', 'command': 'mc pipe s3/a'}, stdout=1, stderr=2)
+    popen.assert_called_once_with(
+        'mc pipe s3/a', shell=True,
+        stdin=subprocess.PIPE, stdout=1, stderr=2)
+    nose.assert_equal(output_file, popen.return_value.stdin)
+    nose.assert_equal(process, popen.return_value)
 
 
 @patch('swb.local.transfer_file')
@@ -165,6 +605,7 @@ def test_upload_local_backup(transfer_file):
         stdout=1, stderr=2)
     transfer_file.assert_called_once_with(
         ssh_user='myname', ssh_hostname='mysite.com', ssh_port='2222',
+        transport='ssh',
         src_path='e/f g/h', dest_path='a/b c/d',
         action='upload', stdout=1, stderr=2)
 
@@ -175,13 +616,75 @@ def test_restore_remote_backup(exec_on_remote):
     swb.restore_remote_backup(
         ssh_user='myname', ssh_hostname='mysite.com', ssh_port='2222',
         wordpress_path='a/b c/d', remote_backup_path='e/f g/h',
-        backup_decompressor='bzip2 -v',
+        backup_decompressor='bzip2 -v', backup_checksum='abc',
+        staging_db='mydb_staging',
         stdout=1, stderr=2)
     exec_on_remote.assert_called_once_with(
         ssh_user='myname', ssh_hostname='mysite.com', ssh_port='2222',
+        transport='ssh',
         action='restore',
-        action_args=['a/b c/d', 'e/f g/h', 'bzip2 -v'],
+        action_args=[
+            'a/b c/d', 'e/f g/h', 'bzip2 -v', 'abc', 'mydb_staging', '', '',
+            ''],
+        stdout=1, stderr=2)
+
+
+@patch('swb.local.exec_on_remote')
+@patch('builtins.open')
+def test_stream_local_backup(builtin_open, exec_on_remote):
+    """should stream local backup to remote when restoring"""
+    swb.stream_local_backup(
+        ssh_user='myname', ssh_hostname='mysite.com', ssh_port='2222',
+        wordpress_path='a/b c/d', local_backup_path='e/f g/h',
+        backup_decompressor='bzip2 -d', backup_checksum='abc',
+        staging_db='',
+        stdout=1, stderr=2)
+    builtin_open.assert_called_once_with('e/f g/h', 'rb')
+    exec_on_remote.assert_called_once_with(
+        ssh_user='myname', ssh_hostname='mysite.com', ssh_port='2222',
+        transport='ssh',
+        action='restore-stream',
+        action_args=['a/b c/d', 'bzip2 -d', 'abc', '', '', ''],
+        stdin=builtin_open.return_value.__enter__(),
+        stdout=1, stderr=2)
+
+
+@patch('swb.local.exec_on_remote')
+@patch('subprocess.Popen')
+@patch('builtins.open')
+def test_stream_local_backup_encrypted(builtin_open, popen, exec_on_remote):
+    """should decrypt encrypted local backup as it is streamed to remote"""
+    popen.return_value.returncode = 0
+    swb.stream_local_backup(
+        ssh_user='myname', ssh_hostname='mysite.com', ssh_port='2222',
+        wordpress_path='a/b c/d', local_backup_path='e/f g/h',
+        backup_decompressor='bzip2 -d', backup_checksum='',
+        staging_db='', encryption_identity='i/j k/l',
+        stdout=1, stderr=2)
+    popen.assert_called_once_with(
+        ['age', '-d', '-i', 'i/j k/l'],
+        stdin=builtin_open.return_value.__enter__(),
+        stdout=subprocess.PIPE)
+    nose.assert_equal(
+        exec_on_remote.call_args[1]['stdin'], popen.return_value.stdout)
+    popen.return_value.wait.assert_called_once_with()
+
+
+@patch('sys.exit')
+@patch('swb.local.exec_on_remote')
+@patch('subprocess.Popen')
+@patch('builtins.open')
+def test_stream_local_backup_decrypt_fail(builtin_open, popen,
+                                          exec_on_remote, exit):
+    """should exit if encrypted local backup could not be decrypted"""
+    popen.return_value.returncode = 1
+    swb.stream_local_backup(
+        ssh_user='myname', ssh_hostname='mysite.com', ssh_port='2222',
+        wordpress_path='a/b c/d', local_backup_path='e/f g/h',
+        backup_decompressor='bzip2 -d', backup_checksum='',
+        staging_db='', encryption_identity='i/j k/l',
         stdout=1, stderr=2)
+    exit.assert_called_once_with(1)
 
 
 @patch('swb.local.exec_on_remote')
@@ -192,212 +695,1675 @@ def test_purge_remote_backup(exec_on_remote):
         remote_backup_path='a/b c/d', stdout=1, stderr=2)
     exec_on_remote.assert_called_once_with(
         ssh_user='myname', ssh_hostname='mysite.com', ssh_port='2222',
+        transport='ssh',
         action='purge-backup', action_args=['a/b c/d'],
         stdout=1, stderr=2)
 
 
-def test_get_last_modified_time():
-    """should retrieve correct last modified time of the supplied path"""
-    nose.assert_equal(
-        swb.get_last_modified_time('swb/local.py'),
-        os.stat('swb/local.py').st_mtime)
+def test_purge_remote_backup_local():
+    """should run the real remote script with the local transport"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        with patch.dict(os.environ, {'HOME': temp_dir}):
+            os.makedirs(os.path.join(temp_dir, 'backups'))
+            remote_backup_path = os.path.join(
+                temp_dir, 'backups', 'a b.sql.bz2')
+            open(remote_backup_path, 'wb').close()
+            swb.purge_remote_backup(
+                ssh_user='myname', ssh_hostname='mysite.com',
+                ssh_port='2222', remote_backup_path='~/backups/a b.sql.bz2',
+                stdout=None, stderr=None, transport='local')
+            nose.assert_false(os.path.exists(remote_backup_path))
+            _, remote_script_path = swb.read_remote_script()
+            nose.assert_true(os.path.exists(
+                os.path.expanduser(remote_script_path)))
 
 
-@patch('os.rmdir')
-@patch('glob.iglob', side_effect=[
-    ['/a/b/2011/02/03', '/a/b/2011/02/04'],
-    ['/a/b/2011/02'],
-    ['/a/b/2010', '/a/b/2011'],
-    ['/a/b'],
-    ['/a']
-])
-def test_purge_empty_dirs(iglob, rmdir):
-    """should purge empty timestamped directories"""
-    swb.purge_empty_dirs('/a/b/*/*/*/c')
-    nose.assert_equal(iglob.call_count, 3)
-    nose.assert_equal(iglob.call_args_list, [
-        call('/a/b/*/*/*'),
-        call('/a/b/*/*'),
-        call('/a/b/*')
-    ])
-    nose.assert_equal(rmdir.call_args_list, [
-        call('/a/b/2011/02/03'),
-        call('/a/b/2011/02/04'),
-        call('/a/b/2011/02'),
-        call('/a/b/2010'),
-        call('/a/b/2011')
-    ])
+def test_write_backup_manifest():
+    """should write the manifest of a backup alongside it atomically"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        local_backup_path = os.path.join(temp_dir, 'a.sql.bz2')
+        swb.write_backup_manifest(local_backup_path, {'checksum': 'abc'})
+        nose.assert_equal(os.listdir(temp_dir), ['a.sql.bz2.json'])
+        nose.assert_equal(
+            swb.read_backup_manifest(local_backup_path), {'checksum': 'abc'})
 
 
-@patch('os.rmdir', side_effect=OSError)
-@patch('glob.iglob', side_effect=[
-    ['/a/b/2011/02/03', '/a/b/2011/02/04'],
-    ['/a/b/2011/02'],
-    ['/a/b/2010', '/a/b/2011'],
-    ['/a/b'],
-    ['/a']
-])
-def test_purge_empty_dirs_silent_fail(iglob, rmdir):
-    """should ignore non-empty directories when purging empty directories"""
-    swb.purge_empty_dirs('/a/b/*/*/*/c')
-    nose.assert_equal(iglob.call_count, 3)
-    nose.assert_equal(rmdir.call_count, 5)
-
-
-@patch('swb.local.get_last_modified_time', side_effect=[5, 3, 6, 2, 4])
-@patch('swb.local.purge_empty_dirs')
-@patch('os.remove')
-@patch('glob.iglob', return_value=[
-    'a/2015/02/03/b',
-    'a/2013/04/05/b',
-    'a/2016/01/02/b',
-    'a/2012/05/06/b',
-    'a/2014/03/04/b'
-])
-def test_purge_oldest_backups(iglob, remove, purge_empty_dirs,
-                              get_last_modified_time):
-    """should purge oldest local backups"""
-    swb.purge_oldest_backups('a/%y/%m/%d/b', max_local_backups=3)
-    nose.assert_equal(remove.call_args_list, [
-        call('a/2012/05/06/b'),
-        call('a/2013/04/05/b')
-    ])
-    purge_empty_dirs.assert_called_once_with('a/*/*/*/b')
+def test_get_file_checksum():
+    """should compute the SHA-256 checksum of the supplied path"""
+    nose.assert_equal(
+        swb.get_file_checksum('tests/files/mysite/wp-content/foo.txt'),
+        hashlib.sha256(open(
+            'tests/files/mysite/wp-content/foo.txt', 'rb').read()).hexdigest())
 
 
-@patch('swb.local.purge_remote_backup')
-@patch('swb.local.purge_oldest_backups')
-@patch('swb.local.download_remote_backup')
-@patch('swb.local.create_remote_backup')
-@patch('swb.local.create_dir_structure')
-def test_back_up(create_dir_structure, create_remote_backup,
-                 download_remote_backup, purge_oldest_backups,
-                 purge_remote_backup):
-    """should run correct backup procedure"""
+def test_get_site_name():
+    """should identify site by its SSH login and WordPress path"""
     config = configparser.RawConfigParser()
     config.read('tests/files/config.ini')
-    swb.back_up(config, stdout=1, stderr=2)
-    expanded_local_backup_path = os.path.expanduser(strftime(
-        '~/Backups/%y/%m/%d/mysite.sql.bz2'))
-    expanded_remote_backup_path = strftime('~/backups/%y/%m/%d/mysite.sql.bz2')
-    create_remote_backup.assert_called_once_with(
-        ssh_user='myname', ssh_hostname='mysite.com', ssh_port='2222',
-        wordpress_path='~/public_html/mysite',
-        remote_backup_path=expanded_remote_backup_path,
-        backup_compressor='bzip2 -v',
-        stdout=1, stderr=2)
-    create_dir_structure.assert_called_once_with(
-        local_backup_path=expanded_local_backup_path)
-    download_remote_backup.assert_called_once_with(
-        ssh_user='myname', ssh_hostname='mysite.com', ssh_port='2222',
-        remote_backup_path=expanded_remote_backup_path,
-        local_backup_path=expanded_local_backup_path,
-        stdout=1, stderr=2)
-    purge_remote_backup.assert_called_once_with(
-        ssh_user='myname', ssh_hostname='mysite.com', ssh_port='2222',
-        remote_backup_path=expanded_remote_backup_path,
-        stdout=1, stderr=2)
+    nose.assert_equal(
+        swb.get_site_name(config), 'myname@mysite.com:~/public_html/mysite')
 
 
-@patch('swb.local.purge_remote_backup')
-@patch('swb.local.purge_oldest_backups')
-@patch('swb.local.download_remote_backup')
-@patch('swb.local.create_remote_backup')
-@patch('swb.local.create_dir_structure')
-def test_back_up_purge_oldest(create_dir_structure, create_remote_backup,
-                              download_remote_backup, purge_oldest_backups,
-                              purge_remote_backup):
-    """should purge oldest backups if max_local_backups option is set"""
+def test_get_history_path_default():
+    """should use default history path if none is configured"""
     config = configparser.RawConfigParser()
     config.read('tests/files/config.ini')
-    config.set('backup', 'max_local_backups', 3)
-    swb.back_up(config)
-    purge_oldest_backups.assert_called_once_with(
-        local_backup_path=os.path.expanduser(
-            '~/Backups/%y/%m/%d/mysite.sql.bz2'),
-        max_local_backups=3)
+    nose.assert_equal(
+        swb.get_history_path(config),
+        os.path.expanduser(swb.default_history_path))
 
 
-@patch('swb.local.upload_local_backup')
-@patch('swb.local.restore_remote_backup')
-def test_restore(restore_remote_backup, upload_local_backup):
-    """should run correct restore procedure"""
-    config = configparser.RawConfigParser()
-    config.read('tests/files/config.ini')
-    swb.restore(
-        config, local_backup_path='a/b/c.tar.bz2',
-        stdout=1, stderr=2)
-    expanded_remote_backup_path = strftime(
-        config.get('paths', 'remote_backup'))
-    upload_local_backup.assert_called_once_with(
-        ssh_user='myname', ssh_hostname='mysite.com', ssh_port='2222',
-        local_backup_path='a/b/c.tar.bz2',
-        remote_backup_path=expanded_remote_backup_path,
-        stdout=1, stderr=2)
+def test_record_run():
+    """should record runs in the run history database"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        config = configparser.RawConfigParser()
+        config.read('tests/files/config.ini')
+        config.set('paths', 'history', os.path.join(temp_dir, 'h.sqlite3'))
+        swb.record_run(
+            config, action='back-up', started=100, succeeded=True,
+            run_stats={'backup_size': 2048, 'raw_size': 8192})
+        history = swb.open_history(swb.get_history_path(config))
+        runs = history.execute('SELECT * FROM runs').fetchall()
+        history.close()
+    nose.assert_equal(len(runs), 1)
+    nose.assert_equal(runs[0][:3], (
+        'myname@mysite.com:~/public_html/mysite', 'back-up', 100))
+    nose.assert_equal(runs[0][4:], (1, 2048, 8192, None))
 
 
-@patch('swb.local.parse_config')
-@patch('swb.local.back_up')
-@patch('sys.argv', [swb.__file__, 'tests/files/config.ini'])
-def test_main_back_up(back_up, parse_config):
-    """should run backup procedure by default when utility is run"""
-    swb.main()
-    back_up.assert_called_once_with(
-        parse_config.return_value, stdout=None, stderr=None)
+def test_get_percentile():
+    """should retrieve the value at the given percentile"""
+    values = list(range(100, 0, -1))
+    nose.assert_equal(swb.get_percentile(values, 50), 50)
+    nose.assert_equal(swb.get_percentile(values, 95), 95)
+    nose.assert_equal(swb.get_percentile([3], 95), 3)
 
 
-@patch('swb.local.parse_config')
-@patch('swb.local.back_up')
-@patch('sys.argv', [swb.__file__, '-q', 'tests/files/config.ini'])
-@patch('builtins.open')
-def test_main_quiet(builtin_open, back_up, parse_config):
-    """should silence stdout/stderr when utility is run in quiet mode"""
-    swb.main()
-    devnull = builtin_open.return_value.__enter__()
-    back_up.assert_called_once_with(
-        parse_config.return_value,
-        stdout=devnull, stderr=devnull)
+def test_format_size():
+    """should format the given number of bytes as a human-readable size"""
+    nose.assert_equal(swb.format_size(512), '512.0 B')
+    nose.assert_equal(swb.format_size(1536), '1.5 KB')
+    nose.assert_equal(swb.format_size(3 * 1024 ** 3), '3.0 GB')
 
 
-@patch('swb.local.restore')
-@patch('swb.local.parse_config')
-@patch('sys.argv', [swb.__file__, 'tests/files/config.ini', '-r', 'a.tar.bz2'])
-@patch('builtins.print')
-@patch('builtins.input', return_value='y')
-def test_main_restore(builtin_input, builtin_print, parse_config, restore):
-    """should run restore procedure when -r/--restore is passed to utility"""
-    swb.main()
-    builtin_input.assert_called_once_with(ANY)
-    restore.assert_called_once_with(
-        parse_config.return_value, local_backup_path='a.tar.bz2',
-        stdout=None, stderr=None)
+def test_get_progress_estimate():
+    """should estimate the fraction done and time left from a progress event"""
+    nose.assert_equal(swb.get_progress_estimate(
+        {'dumped_bytes': 250, 'estimated_bytes': 1000}, elapsed=10),
+        (0.25, 30))
+    nose.assert_equal(swb.get_progress_estimate(
+        {'dumped_bytes': 0, 'estimated_bytes': 1000}, elapsed=10),
+        (None, None))
+    nose.assert_equal(swb.get_progress_estimate(
+        {'dumped_bytes': 250, 'done': True}, elapsed=10), (1, 0))
 
 
-@patch('swb.local.restore')
-@patch('swb.local.parse_config')
-@patch('sys.argv', [swb.__file__, 'tests/files/config.ini', '-r', 'a.tar.bz2'])
-@patch('builtins.print')
-@patch('builtins.input', return_value='n')
-def test_main_restore_cancel(builtin_input, builtin_print,
-                             parse_config, restore):
-    """should cancel restore procedure when user cancels confirmation"""
-    with nose.assert_raises(Exception):
-        swb.main()
-    restore.assert_not_called()
+def test_format_progress():
+    """should format a progress event as a line with a progress bar"""
+    nose.assert_equal(swb.format_progress('a', {
+        'tables_done': 3, 'tables_total': 12, 'dumped_bytes': 2048,
+        'compressed_bytes': 512, 'current_table': 'wp_posts'},
+        fraction=0.5, eta=125), 'a [' + '#' * 15 + '.' * 15 + '] 50%'
+        ' 3/12 tables, 2.0 KB dumped, 512.0 B compressed (wp_posts),'
+        ' ETA 2m05s')
 
 
-@patch('swb.local.restore')
-@patch('swb.local.parse_config')
-@patch('sys.argv', [
-    swb.__file__, 'tests/files/config.ini',
-    '-fr', 'a.tar.bz2'])
-@patch('builtins.print')
-@patch('builtins.input', return_value='y')
-def test_main_restore_force(builtin_input, builtin_print,
-                            parse_config, restore):
-    """should force restore procedure when -fr is passed to utility"""
-    swb.main()
+@patch('sys.stdout', new_callable=io.StringIO)
+def test_create_progress_reporter_json(stdout):
+    """should write progress events as JSON lines under their site"""
+    report_progress = swb.create_progress_reporter('a', style='json')
+    report_progress({'label': 'b', 'dumped_bytes': 10, 'done': True})
+    nose.assert_equal(json.loads(stdout.getvalue()), {
+        'site': 'b', 'dumped_bytes': 10, 'done': True,
+        'fraction': 1, 'eta': 0})
+
+
+def test_get_size_anomalies():
+    """should flag backups much smaller than the backup before them"""
+    backups = [(1, 0, 1000), (2, 0, 900), (3, 0, 100), (4, 0, 120)]
+    nose.assert_equal(
+        swb.get_size_anomalies(backups, max_shrinkage=0.8),
+        [(3, 100, 900)])
+
+
+def test_get_site_report():
+    """should summarize durations, sizes, and anomalies of a site"""
+    history = swb.open_history(':memory:')
+    history.executemany('INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?)', [
+        ('a', 'back-up', 0, 10, 1, 1000, 4000, 1),
+        ('a', 'back-up', 86400, 20, 1, 2000, 8000, 2),
+        ('a', 'back-up', 172800, 5, 0, None, None, None),
+        ('a', 'back-up', 259200, 30, 1, 100, 400, 1),
+        ('a', 'restore', 300000, 30, 1, 100, None, None)
+    ])
+    lines = swb.get_site_report(history, 'a')
+    history.close()
+    nose.assert_equal(lines[1], '  backups: 4 (1 failed)')
+    nose.assert_equal(lines[2], '  duration: p50 20.0s, p95 30.0s')
+    nose.assert_equal(lines[4], '  compression ratio: 4.00 (latest 4.00)')
+    nose.assert_true(lines[5].startswith('  anomaly: '))
+
+
+def test_get_schedule_default():
+    """should back up daily with a tenth of the interval as jitter"""
+    config = configparser.RawConfigParser()
+    config.read('tests/files/config.ini')
+    nose.assert_equal(swb.get_schedule(config), {
+        'interval': 86400, 'jitter': 8640, 'retries': 3, 'retry_delay': 60})
+
+
+def test_create_backup_job():
+    """should schedule a site one interval after its last backup"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        config = configparser.RawConfigParser()
+        config.read('tests/files/config.ini')
+        config.set('paths', 'history', os.path.join(temp_dir, 'h.sqlite3'))
+        config.add_section('schedule')
+        config.set('schedule', 'interval', '3600')
+        config.set('schedule', 'jitter', '60')
+        for started, duration in ((1000, 30), (2000, 10), (3000, 20)):
+            swb.record_run(
+                config, action='back-up', started=started, succeeded=True,
+                run_stats={})
+            history = swb.open_history(swb.get_history_path(config))
+            with history:
+                history.execute(
+                    'UPDATE runs SET duration = ? WHERE started = ?',
+                    (duration, started))
+            history.close()
+        job = swb.create_backup_job(config, now=4000)
+    nose.assert_equal(job['expected_duration'], 20)
+    nose.assert_true(6600 <= job['due'] <= 6660)
+    nose.assert_false(job['running'])
+
+
+def test_get_jobs_to_start():
+    """should start the longest due jobs first on the idle workers"""
+    jobs = [
+        {'site': 'a', 'due': 0, 'expected_duration': 10, 'running': False},
+        {'site': 'b', 'due': 0, 'expected_duration': 30, 'running': False},
+        {'site': 'c', 'due': 50, 'expected_duration': 90, 'running': False},
+        {'site': 'd', 'due': 0, 'expected_duration': None, 'running': False},
+        {'site': 'e', 'due': 0, 'expected_duration': 20, 'running': True}
+    ]
+    nose.assert_equal([job['site'] for job in swb.get_jobs_to_start(
+        jobs, num_workers=3, now=10)], ['d', 'b'])
+
+
+def get_test_job(**job):
+    """Create a daemon job with the given fields for testing"""
+    return dict({
+        'site': 'a', 'config': Mock(), 'due': 0, 'expected_duration': None,
+        'running': True, 'attempt': 0, 'last_error': None,
+        'schedule': {
+            'interval': 3600, 'jitter': 0, 'retries': 2, 'retry_delay': 60}
+    }, **job)
+
+
+@patch('swb.local.get_backup_durations', return_value=[(100, 30)])
+@patch('swb.local.purge_oldest_backups')
+@patch('swb.local.get_retention_policies')
+@patch('swb.local.run_and_record')
+@patch('time.time', return_value=1000)
+def test_run_backup_job(time, run_and_record, get_retention_policies,
+                        purge_oldest_backups, get_backup_durations):
+    """should back up the site of the job and schedule its next backup"""
+    job = get_test_job(attempt=1, last_error='SystemExit(255)')
+    swb.run_backup_job(job, threading.Lock(), stdout=1, stderr=2)
+    run_and_record.assert_called_once_with(
+        job['config'], swb.back_up, action='back-up', stdout=1, stderr=2)
+    purge_oldest_backups.assert_called_once_with(
+        get_retention_policies.return_value)
+    nose.assert_equal(
+        (job['running'], job['due'], job['attempt'], job['last_error'],
+         job['expected_duration']), (False, 4600, 0, None, 30))
+
+
+@patch('swb.local.get_backup_durations', return_value=[])
+@patch('swb.local.run_and_record', side_effect=SystemExit(255))
+@patch('time.time', return_value=1000)
+def test_run_backup_job_retry(time, run_and_record, get_backup_durations):
+    """should retry a backup whose connection dropped with backoff"""
+    job = get_test_job(attempt=1)
+    swb.run_backup_job(job, threading.Lock(), stdout=1, stderr=2)
+    nose.assert_equal((job['due'], job['attempt']), (1120, 2))
+    swb.run_backup_job(job, threading.Lock(), stdout=1, stderr=2)
+    nose.assert_equal((job['due'], job['attempt']), (4600, 0))
+    nose.assert_equal(job['last_error'], 'SystemExit(255)')
+
+
+@patch('swb.local.get_backup_durations', return_value=[])
+@patch('swb.local.run_and_record', side_effect=SystemExit(75))
+@patch('time.time', return_value=1000)
+def test_run_backup_job_lock_wait(time, run_and_record, get_backup_durations):
+    """should retry a backup whose dump gave up waiting for a lock"""
+    job = get_test_job()
+    swb.run_backup_job(job, threading.Lock(), stdout=1, stderr=2)
+    nose.assert_equal((job['due'], job['attempt']), (1060, 1))
+
+
+@patch('swb.local.get_backup_durations', return_value=[])
+@patch('swb.local.run_and_record', side_effect=OSError('Aborting.'))
+@patch('time.time', return_value=1000)
+def test_run_backup_job_fail(time, run_and_record, get_backup_durations):
+    """should not retry a backup which failed for good until its next run"""
+    job = get_test_job()
+    swb.run_backup_job(job, threading.Lock(), stdout=1, stderr=2)
+    nose.assert_equal((job['due'], job['attempt']), (4600, 0))
+    nose.assert_false(job['running'])
+
+
+def test_start_status_server():
+    """should serve the state of the daemon's queue as JSON"""
+    jobs = [get_test_job(due=time.time() + 120, running=False)]
+    status_server = swb.start_status_server(jobs, threading.Lock(), 0)
+    try:
+        with urllib.request.urlopen('http://127.0.0.1:{}/'.format(
+                status_server.server_address[1])) as response:
+            queue_state = json.loads(response.read().decode('utf-8'))
+    finally:
+        status_server.shutdown()
+        status_server.server_close()
+    nose.assert_equal(queue_state, [{
+        'site': 'a', 'state': 'waiting', 'due_in': 120,
+        'expected_duration': None, 'attempt': 0, 'last_error': None}])
+
+
+@patch('swb.local.run_backup_job')
+@patch('swb.local.create_backup_job', side_effect=lambda config, now: (
+    get_test_job(site=config, running=False)))
+def test_run_daemon(create_backup_job, run_backup_job):
+    """should start due backups until the daemon is stopped"""
+    stop_event = Mock()
+    stop_event.is_set.side_effect = [False, True]
+    swb.run_daemon(
+        ['a', 'b', 'c'], num_workers=2, stop_event=stop_event,
+        stdout=1, stderr=2)
+    nose.assert_equal(run_backup_job.call_count, 2)
+    nose.assert_equal(run_backup_job.call_args[1], {'stdout': 1, 'stderr': 2})
+    stop_event.wait.assert_called_once_with(swb.daemon_poll_interval)
+
+
+def test_backup_manifest():
+    """should write and read the manifest alongside the local backup"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        backup_path = os.path.join(temp_dir, 'a.sql.bz2')
+        swb.write_backup_manifest(backup_path, {'decompressor': 'xz -d'})
+        nose.assert_true(os.path.exists(backup_path + '.json'))
+        manifest = swb.read_backup_manifest(backup_path)
+    nose.assert_equal(manifest, {'decompressor': 'xz -d'})
+
+
+def test_read_backup_manifest_missing():
+    """should return empty manifest if backup has none"""
+    nose.assert_equal(swb.read_backup_manifest('a/b c/d.sql.bz2'), {})
+
+
+@patch('swb.local.read_backup_manifest', return_value={
+    'decompressor': 'xz -d'})
+def test_get_backup_decompressor_manifest(read_backup_manifest):
+    """should prefer the decompressor recorded in the backup's manifest"""
+    config = configparser.RawConfigParser()
+    config.read('tests/files/config.ini')
+    nose.assert_equal(
+        swb.get_backup_decompressor(config, 'a.sql.bz2'), 'xz -d')
+
+
+@patch('swb.local.read_backup_manifest', return_value={})
+def test_get_backup_decompressor_config(read_backup_manifest):
+    """should fall back to the configured decompressor"""
+    config = configparser.RawConfigParser()
+    config.read('tests/files/config.ini')
+    nose.assert_equal(
+        swb.get_backup_decompressor(config, 'a.sql.bz2'), 'bzip2 -d')
+
+
+@patch('swb.local.read_backup_manifest', return_value={
+    'dictionary_id': 123})
+def test_get_backup_decompressor_dictionary(read_backup_manifest):
+    """should decompress with the dictionary recorded in the manifest"""
+    config = configparser.RawConfigParser()
+    config.read('tests/files/config.ini')
+    config.set('backup', 'decompressor', 'zstd -d')
+    config.set('paths', 'dictionaries', '/a/dicts')
+    nose.assert_equal(
+        swb.get_backup_decompressor(config, 'a.sql.zst'),
+        'zstd -d -D /a/dicts/123.zdict')
+    nose.assert_equal(
+        swb.get_backup_decompressor(config, 'a.sql.zst', remote=True),
+        'zstd -d -D .cache/ssh-wp-backup/dictionaries/123.zdict')
+
+
+def test_add_dictionary_option_zstd_only():
+    """should only add dictionaries to zstd commands"""
+    with nose.assert_raises(OSError):
+        swb.add_dictionary_option('bzip2 -9', 'a.zdict')
+
+
+def write_sample_dump(dump_file, num_rows):
+    """Write a dump with a repetitive structure to the given file"""
+    for row_id in range(num_rows):
+        dump_file.write(
+            "INSERT INTO `wp_options` VALUES ({}, 'option_{}', '{}',"
+            " 'yes');\n".format(
+                row_id, row_id % 500,
+                ('siteurl', 'home', 'blogname')[row_id % 3]).encode('utf-8'))
+
+
+def test_train_dictionary():
+    """should train a dictionary on the latest backups of the given sites"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        config = configparser.RawConfigParser()
+        config.read('tests/files/config.ini')
+        config.set('paths', 'local_backup',
+                   os.path.join(temp_dir, '%Y-%m-%d.sql.gz'))
+        config.set('paths', 'dictionaries', os.path.join(temp_dir, 'dicts'))
+        config.set('backup', 'decompressor', 'gzip -d')
+        for day in (1, 2):
+            dump_path = os.path.join(temp_dir, '2016-01-0{}.sql'.format(day))
+            with open(dump_path, 'wb') as dump_file:
+                write_sample_dump(dump_file, 20000)
+            subprocess.check_call(['gzip', dump_path])
+        dictionary_id = swb.train_dictionary([config])
+        nose.assert_equal(swb.get_dictionary_id(
+            swb.get_dictionary_path(config, dictionary_id)), dictionary_id)
+
+
+def test_get_dictionary_id_invalid():
+    """should reject files which are not zstd dictionaries"""
+    with nose.assert_raises(OSError):
+        swb.get_dictionary_id('tests/files/config.ini')
+
+
+def test_get_link_bandwidth_measured():
+    """should measure link bandwidth from the latest download"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        config = configparser.RawConfigParser()
+        config.read('tests/files/config.ini')
+        config.set('paths', 'history', os.path.join(temp_dir, 'h.sqlite3'))
+        nose.assert_equal(swb.get_link_bandwidth(config), None)
+        swb.record_run(
+            config, action='back-up', started=100, succeeded=True,
+            run_stats={'backup_size': 2048, 'transfer_duration': 2})
+        nose.assert_equal(swb.get_link_bandwidth(config), 1024)
+
+
+def test_get_link_bandwidth_configured():
+    """should use the configured link bandwidth if set"""
+    config = configparser.RawConfigParser()
+    config.read('tests/files/config.ini')
+    config.set('backup', 'link_bandwidth', '4096')
+    nose.assert_equal(swb.get_link_bandwidth(config), 4096)
+
+
+@patch('swb.local.get_link_bandwidth', return_value=1024)
+def test_get_backup_options_auto(get_link_bandwidth):
+    """should pass codec selection options if compressor is auto"""
+    config = configparser.RawConfigParser()
+    config.read('tests/files/config.ini')
+    config.set('backup', 'compressor', 'auto')
+    config.set('backup', 'auto_sample_size', '0.5')
+    config.set('backup', 'auto_objective', 'size')
+    nose.assert_equal(swb.get_backup_options(config), {
+        'sample_size': 524288, 'objective': 'size', 'link_bandwidth': 1024})
+
+
+def test_get_backup_options_encryption():
+    """should pass the encryption recipient if one is configured"""
+    config = configparser.RawConfigParser()
+    config.read('tests/files/config.ini')
+    config.set('backup', 'encryption_recipient', 'age1abc')
+    nose.assert_equal(
+        swb.get_backup_options(config), {'encryption_recipient': 'age1abc'})
+
+
+def test_get_backup_options():
+    """should pass no codec selection options if compressor is explicit"""
+    config = configparser.RawConfigParser()
+    config.read('tests/files/config.ini')
+    nose.assert_equal(swb.get_backup_options(config), {})
+
+
+def test_get_backup_options_host_workers():
+    """should pass the worker budget of the server if one is configured"""
+    config = configparser.RawConfigParser()
+    config.read('tests/files/config.ini')
+    config.set('backup', 'host_workers', '4')
+    nose.assert_equal(
+        swb.get_backup_options(config), {'host_workers': 4})
+
+
+def test_get_backup_options_binlog_tables():
+    """should refuse to record the binlog position of selected tables"""
+    config = configparser.RawConfigParser()
+    config.read('tests/files/config.ini')
+    config.set('backup', 'record_binlog', 'true')
+    config.add_section('table_filters')
+    config.set('table_filters', 'options', "option_name NOT LIKE 'a%'")
+    with nose.assert_raises(OSError):
+        swb.get_backup_options(config)
+
+
+def test_get_backup_options_tables():
+    """should pass the tables to dump and their filters to the remote"""
+    config = configparser.RawConfigParser()
+    config.read('tests/files/config.ini')
+    config.set('backup', 'exclude_tables', 'actionscheduler_logs  *_log')
+    config.set('backup', 'schema_only_tables', 'wc_sessions')
+    config.add_section('table_filters')
+    config.set('table_filters', 'options', "option_name NOT LIKE 'a%'")
+    nose.assert_equal(swb.get_backup_options(config), {
+        'exclude_tables': ['actionscheduler_logs', '*_log'],
+        'schema_only_tables': ['wc_sessions'],
+        'table_filters': {'options': "option_name NOT LIKE 'a%'"}})
+
+
+def test_get_backup_options_table_filters_defaults():
+    """should not take options from the DEFAULT section as table filters"""
+    config = configparser.RawConfigParser()
+    config.read('tests/files/config.ini')
+    config.set('DEFAULT', 'interval', '3600')
+    config.add_section('table_filters')
+    config.set('table_filters', 'options', "option_name NOT LIKE 'a%'")
+    nose.assert_equal(
+        swb.get_backup_options(config)['table_filters'],
+        {'options': "option_name NOT LIKE 'a%'"})
+
+
+def test_get_last_modified_time():
+    """should retrieve correct last modified time of the supplied path"""
+    nose.assert_equal(
+        swb.get_last_modified_time('swb/local.py'),
+        os.stat('swb/local.py').st_mtime)
+
+
+def create_backups(backup_paths):
+    for backup_path in backup_paths:
+        os.makedirs(os.path.dirname(backup_path), exist_ok=True)
+        open(backup_path, 'w').close()
+
+
+def test_compile_path_pattern():
+    """should match paths expanded from the given path pattern"""
+    path_regex, directives = swb.compile_path_pattern('/a/%Y/%-d/b.sql')
+    nose.assert_equal(directives, ['%Y', '%d'])
+    nose.assert_equal(
+        path_regex.search('/a/2016/7/b.sql').groups(), ('2016', '7'))
+    nose.assert_is_none(path_regex.search('/a/2016/7/b.sql.json'))
+
+
+def test_compile_path_pattern_site():
+    """should match the site labels of fleet backups without parsing them"""
+    path_regex, directives = swb.compile_path_pattern('/a/{site}/%Y.sql')
+    nose.assert_equal(directives, [None, '%Y'])
+    nose.assert_equal(
+        path_regex.search('/a/www-b/2016.sql').groups(), ('www-b', '2016'))
+
+
+@patch('swb.local.get_last_modified_time')
+def test_get_backup_time(get_last_modified_time):
+    """should parse backup times from paths rather than stat each backup"""
+    path_regex, directives = swb.compile_path_pattern('/a/%y-%m-%d/%H.sql')
+    path_match = path_regex.search('/a/16-01-02/13.sql')
+    nose.assert_equal(
+        swb.get_backup_time('/a/16-01-02/13.sql', path_match, directives),
+        time.mktime((2016, 1, 2, 13, 0, 0, 0, 0, -1)))
+    get_last_modified_time.assert_not_called()
+
+
+def test_purge_oldest_backups():
+    """should purge oldest backups of every site sharing a directory"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        create_backups([
+            os.path.join(temp_dir, date_dir, site)
+            for date_dir in ('2015/02/03', '2013/04/05', '2016/01/02',
+                             '2012/05/06', '2014/03/04')
+            for site in ('a.sql', 'b.sql')])
+        create_backups([os.path.join(temp_dir, '2012/05/06/a.sql.json')])
+        swb.purge_oldest_backups([
+            {'path_pattern': os.path.join(temp_dir, '%Y/%m/%d/a.sql'),
+             'max_backups': 3},
+            {'path_pattern': os.path.join(temp_dir, '%Y/%m/%d/b.sql'),
+             'max_backups': 4}])
+        nose.assert_equal(sorted(os.listdir(temp_dir)), [
+            '2013', '2014', '2015', '2016'])
+        nose.assert_equal(
+            os.listdir(os.path.join(temp_dir, '2013/04/05')), ['b.sql'])
+        nose.assert_equal(sorted(os.listdir(
+            os.path.join(temp_dir, '2014/03/04'))), ['a.sql', 'b.sql'])
+
+
+def test_purge_oldest_backups_temp_files():
+    """should ignore temporary files, only purging them once stale"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        backup_paths = [
+            os.path.join(temp_dir, '2016/01/0{}/a.sql'.format(day))
+            for day in range(1, 4)]
+        create_backups(backup_paths)
+        stale_temp_path = swb.get_temp_path(backup_paths[0])
+        fresh_temp_path = swb.get_temp_path(
+            os.path.join(temp_dir, '2016/01/04/a.sql'))
+        manifest_temp_path = swb.get_temp_path(
+            swb.get_manifest_path(backup_paths[1]))
+        create_backups([stale_temp_path, fresh_temp_path, manifest_temp_path])
+        stale_time = time.time() - swb.stale_temp_file_age - 60
+        os.utime(stale_temp_path, (stale_time, stale_time))
+        swb.purge_oldest_backups([{
+            'path_pattern': os.path.join(temp_dir, '%Y/%m/%d/a.sql'),
+            'max_backups': 2}])
+        nose.assert_false(os.path.exists(backup_paths[0]))
+        nose.assert_false(os.path.exists(stale_temp_path))
+        nose.assert_true(os.path.exists(backup_paths[1]))
+        nose.assert_true(os.path.exists(fresh_temp_path))
+        nose.assert_true(os.path.exists(manifest_temp_path))
+
+
+def test_purge_oldest_backups_sites():
+    """should keep the given number of backups for each site of a fleet"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        create_backups([
+            os.path.join(temp_dir, site, '2016-01-0{}.sql'.format(day))
+            for site in ('www-a', 'www-b') for day in range(1, 4)])
+        swb.purge_oldest_backups([{
+            'path_pattern': os.path.join(temp_dir, '{site}/%Y-%m-%d.sql'),
+            'max_backups': 2}])
+        for site in ('www-a', 'www-b'):
+            nose.assert_equal(
+                sorted(os.listdir(os.path.join(temp_dir, site))),
+                ['2016-01-02.sql', '2016-01-03.sql'])
+
+
+def test_get_temp_target_path():
+    """should retrieve the path a temporary file is written for"""
+    nose.assert_equal(
+        swb.get_temp_target_path(swb.get_temp_path('/a/b.sql')), '/a/b.sql')
+    nose.assert_is_none(swb.get_temp_target_path('/a/b.sql'))
+
+
+@patch('swb.local.scan_dir', return_value=([], []))
+def test_purge_oldest_backups_shared_scan(scan_dir):
+    """should scan directories shared by several sites only once"""
+    swb.purge_oldest_backups([
+        {'path_pattern': '/a/%Y/a.sql', 'max_backups': 3},
+        {'path_pattern': '/a/%Y/b.sql', 'max_backups': 3},
+        {'path_pattern': '/b/%Y/%m/c.sql', 'max_backups': 3}])
+    nose.assert_equal(sorted(scan_dir.call_args_list), [
+        call('/a', 2), call('/b', 3)])
+
+
+def test_get_retention_policies():
+    """should retrieve the retention policies of every site and replica"""
+    config = configparser.RawConfigParser()
+    config.read('tests/files/config.ini')
+    config.set('backup', 'max_local_backups', '3')
+    config.add_section('replica:nas')
+    config.set('replica:nas', 'path', '/nas/%Y/mysite.sql.bz2')
+    config.set('replica:nas', 'max_backups', '10')
+    nose.assert_equal(swb.get_retention_policies([config]), [
+        {'path_pattern': os.path.expanduser(
+            '~/Backups/%y/%m/%d/mysite.sql.bz2'), 'max_backups': 3},
+        {'path_pattern': '/nas/%Y/mysite.sql.bz2', 'max_backups': 10}])
+
+
+@patch('swb.local.write_backup_manifest')
+@patch('swb.local.purge_remote_backup')
+@patch('swb.local.download_remote_backup', return_value={
+    'backup_size': 2048, 'checksum': 'abc', 'failed_replicas': []})
+@patch('swb.local.create_remote_backup', return_value={'raw_size': 8192})
+@patch('swb.local.create_dir_structure')
+def test_back_up(create_dir_structure, create_remote_backup,
+                 download_remote_backup,
+                 purge_remote_backup, write_backup_manifest):
+    """should run correct backup procedure"""
+    config = configparser.RawConfigParser()
+    config.read('tests/files/config.ini')
+    backup_stats = swb.back_up(config, stdout=1, stderr=2)
+    nose.assert_equal(backup_stats, {
+        'backup_size': 2048, 'raw_size': 8192,
+        'transfer_duration': ANY})
+    expanded_local_backup_path = os.path.expanduser(strftime(
+        '~/Backups/%y/%m/%d/mysite.sql.bz2'))
+    expanded_remote_backup_path = strftime('~/backups/%y/%m/%d/mysite.sql.bz2')
+    create_remote_backup.assert_called_once_with(
+        ssh_user='myname', ssh_hostname='mysite.com', ssh_port='2222',
+        transport='ssh',
+        wordpress_path='~/public_html/mysite',
+        remote_backup_path=expanded_remote_backup_path,
+        backup_compressor='bzip2 -v', backup_options={},
+        basis_checksum=None, read_progress=None, stdout=1, stderr=2)
+    create_dir_structure.assert_called_once_with(
+        local_backup_path=expanded_local_backup_path)
+    download_remote_backup.assert_called_once_with(
+        ssh_user='myname', ssh_hostname='mysite.com', ssh_port='2222',
+        transport='ssh',
+        remote_backup_path=expanded_remote_backup_path,
+        local_backup_path=expanded_local_backup_path,
+        replicas=[], expected_size=None,
+        stdout=1, stderr=2)
+    write_backup_manifest.assert_called_once_with(
+        expanded_local_backup_path, {'raw_size': 8192, 'checksum': 'abc'})
+    purge_remote_backup.assert_called_once_with(
+        ssh_user='myname', ssh_hostname='mysite.com', ssh_port='2222',
+        transport='ssh',
+        remote_backup_path=expanded_remote_backup_path,
+        stdout=1, stderr=2)
+
+
+@patch('swb.local.write_backup_manifest')
+@patch('swb.local.purge_remote_backup')
+@patch('swb.local.download_remote_backup', return_value={
+    'backup_size': 2048, 'checksum': 'abc', 'failed_replicas': []})
+@patch('swb.local.create_remote_backup', return_value={})
+@patch('swb.local.create_dir_structure')
+def test_back_up_replicas(create_dir_structure, create_remote_backup,
+                          download_remote_backup,
+                          purge_remote_backup, write_backup_manifest):
+    """should write backup and its manifest to every replica"""
+    config = configparser.RawConfigParser()
+    config.read('tests/files/config.ini')
+    config.add_section('replica:nas')
+    config.set('replica:nas', 'path', '/nas/%Y/mysite.sql.bz2')
+    config.set('replica:nas', 'max_backups', '10')
+    config.add_section('replica:s3')
+    config.set('replica:s3', 'command', 'mc pipe s3/mysite.sql.bz2')
+    swb.back_up(config)
+    nose.assert_equal(download_remote_backup.call_args[1]['replicas'], [
+        {'name': 'nas', 'path_pattern': '/nas/%Y/mysite.sql.bz2',
+         'path': strftime('/nas/%Y/mysite.sql.bz2'), 'max_backups': 10},
+        {'name': 's3', 'command': 'mc pipe s3/mysite.sql.bz2'}])
+    write_backup_manifest.assert_any_call(
+        strftime('/nas/%Y/mysite.sql.bz2'), {'checksum': 'abc'})
+    nose.assert_equal(write_backup_manifest.call_count, 2)
+
+
+@patch('swb.local.write_backup_manifest')
+@patch('swb.local.purge_remote_backup')
+@patch('swb.local.download_remote_backup', return_value={
+    'backup_size': 2048, 'checksum': 'abc', 'failed_replicas': ['nas']})
+@patch('swb.local.create_remote_backup', return_value={})
+@patch('swb.local.create_dir_structure')
+def test_back_up_replicas_fail(create_dir_structure, create_remote_backup,
+                               download_remote_backup,
+                               purge_remote_backup, write_backup_manifest):
+    """should keep the backup and its manifest if a replica fails"""
+    config = configparser.RawConfigParser()
+    config.read('tests/files/config.ini')
+    config.add_section('replica:nas')
+    config.set('replica:nas', 'path', '/nas/%Y/mysite.sql.bz2')
+    with nose.assert_raises(OSError):
+        swb.back_up(config)
+    write_backup_manifest.assert_called_once_with(
+        os.path.expanduser(strftime('~/Backups/%y/%m/%d/mysite.sql.bz2')),
+        {'checksum': 'abc'})
+    nose.assert_equal(purge_remote_backup.call_count, 1)
+
+
+def pack_frames(frames):
+    """Write the given frames as a fleet backup stream"""
+    return b''.join(
+        frame_type +
+        len(label).to_bytes(2, 'big') + len(payload).to_bytes(4, 'big') +
+        label + payload
+        for frame_type, label, payload in frames)
+
+
+def test_read_frames():
+    """should read the frames of a fleet backup stream"""
+    frames = [(b'D', b'www-a', b'abc'), (b'E', b'www-a', b'{}')]
+    nose.assert_equal(
+        list(swb.read_frames(io.BytesIO(pack_frames(frames)))),
+        [(b'D', 'www-a', b'abc'), (b'E', 'www-a', b'{}')])
+    with nose.assert_raises(OSError):
+        list(swb.read_frames(io.BytesIO(pack_frames(frames)[:-1])))
+
+
+def test_receive_fleet_backups():
+    """should write each site's backup and manifest from a fleet stream"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        fleet_stats = swb.receive_fleet_backups(io.BytesIO(pack_frames([
+            (b'D', b'www-a', b'abc'),
+            (b'D', b'www-b', b'xyz'),
+            (b'D', b'www-a', b'def'),
+            (b'E', b'www-a', b'{"backup_size": 6}'),
+            (b'X', b'www-b', b'Database could not be dumped. Aborting.')
+        ])), local_backup_path=os.path.join(temp_dir, '{site}', 'b.sql'))
+        nose.assert_equal(fleet_stats, {
+            'www-a': {'backup_size': 6,
+                      'checksum': hashlib.sha256(b'abcdef').hexdigest()},
+            'www-b': {'error': 'Database could not be dumped. Aborting.'}})
+        with open(os.path.join(temp_dir, 'www-a', 'b.sql'), 'rb') as backup:
+            nose.assert_equal(backup.read(), b'abcdef')
+        nose.assert_equal(
+            swb.read_backup_manifest(os.path.join(temp_dir, 'www-a', 'b.sql')),
+            fleet_stats['www-a'])
+        nose.assert_equal(os.listdir(os.path.join(temp_dir, 'www-b')), [])
+
+
+def test_receive_fleet_backups_truncated():
+    """should discard the backups cut off by an interrupted fleet stream"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        with nose.assert_raises(OSError):
+            swb.receive_fleet_backups(io.BytesIO(pack_frames([
+                (b'D', b'www-a', b'abc')])[:-1]),
+                local_backup_path=os.path.join(temp_dir, '{site}.sql'))
+        nose.assert_equal(os.listdir(temp_dir), [])
+
+
+@patch('swb.local.receive_fleet_backups', return_value={
+    'www-a': {'backup_size': 2048, 'raw_size': 8192},
+    'www-b': {'backup_size': 1024, 'raw_size': 4096}})
+@patch('swb.local.exec_on_remote', side_effect=lambda *args, **kwargs: (
+    kwargs['read_output'](io.BytesIO())))
+def test_back_up_fleet(exec_on_remote, receive_fleet_backups):
+    """should back up every install under the configured roots"""
+    config = configparser.RawConfigParser()
+    config.read('tests/files/config.ini')
+    config.remove_option('paths', 'wordpress')
+    config.set('paths', 'wordpress_roots', '~/public_html ~/sites')
+    config.set('paths', 'local_backup', '~/Backups/{site}/%y-%m-%d.sql.bz2')
+    config.set('backup', 'fleet_workers', '2')
+    backup_stats = swb.back_up(config, stdout=1, stderr=2)
+    nose.assert_equal(backup_stats, {
+        'backup_size': 3072, 'raw_size': 12288, 'transfer_duration': ANY})
+    exec_on_remote.assert_called_once_with(
+        ssh_user='myname', ssh_hostname='mysite.com', ssh_port='2222',
+        transport='ssh',
+        action='back-up-fleet',
+        action_args=['["~/public_html", "~/sites"]', 'bzip2 -v', '{}', '2'],
+        stdout=subprocess.PIPE, stderr=2, read_progress=None,
+        read_output=ANY)
+    receive_fleet_backups.assert_called_once_with(
+        ANY, local_backup_path=os.path.expanduser(
+            strftime('~/Backups/{site}/%y-%m-%d.sql.bz2')),
+        common_stats={})
+
+
+@patch('swb.local.receive_fleet_backups', return_value={
+    'www-a': {'backup_size': 2048},
+    'www-b': {'error': 'Database could not be dumped. Aborting.'}})
+@patch('swb.local.exec_on_remote', side_effect=lambda *args, **kwargs: (
+    kwargs['read_output'](io.BytesIO())))
+def test_back_up_fleet_fail(exec_on_remote, receive_fleet_backups):
+    """should fail if any site of a fleet could not be backed up"""
+    config = configparser.RawConfigParser()
+    config.read('tests/files/config.ini')
+    config.set('paths', 'wordpress_roots', '~/sites')
+    config.set('paths', 'local_backup', '~/Backups/{site}.sql.bz2')
+    with nose.assert_raises(OSError):
+        swb.back_up_fleet(config)
+
+
+def test_get_delta_basis():
+    """should find the newest backup whose raw dump checksum is recorded"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        backup_paths = [
+            os.path.join(temp_dir, '2016-01-0{}.sql.gz'.format(day))
+            for day in range(1, 4)]
+        create_backups(backup_paths)
+        for day, backup_path in enumerate(backup_paths):
+            os.utime(backup_path, (day, day))
+        swb.write_backup_manifest(backup_paths[1], {'raw_checksum': 'abc'})
+        nose.assert_equal(
+            swb.get_delta_basis(os.path.join(temp_dir, '%Y-%m-%d.sql.gz')),
+            (backup_paths[1], 'abc'))
+        nose.assert_equal(
+            swb.get_delta_basis(os.path.join(temp_dir, '%Y.sql.bz2')),
+            (None, ''))
+
+
+def test_rebuild_delta_backup():
+    """should rebuild a backup from a delta against its basis backup"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        basis_dump = b''.join(
+            'INSERT INTO t VALUES ({});\n'.format(i).encode('utf-8')
+            for i in range(10000))
+        new_dump = basis_dump + b'INSERT INTO t VALUES (-1);\n'
+        basis_dump_path = os.path.join(temp_dir, 'basis.sql')
+        new_dump_path = os.path.join(temp_dir, 'new.sql')
+        delta_path = os.path.join(temp_dir, 'backup.delta')
+        with open(basis_dump_path, 'wb') as basis_dump_file:
+            basis_dump_file.write(basis_dump)
+        with open(new_dump_path, 'wb') as new_dump_file:
+            new_dump_file.write(new_dump)
+        subprocess.check_call([
+            'zstd', '-q', '--long=31',
+            '--patch-from={}'.format(basis_dump_path),
+            new_dump_path, '-o', delta_path])
+        subprocess.check_call(['gzip', basis_dump_path])
+        local_backup_path = os.path.join(temp_dir, 'backup.sql.gz')
+        rebuild_stats = swb.rebuild_delta_backup(
+            delta_path,
+            basis_backup_path=basis_dump_path + '.gz',
+            local_backup_path=local_backup_path,
+            backup_compressor='gzip', backup_decompressor='gzip -d',
+            raw_checksum=hashlib.sha256(new_dump).hexdigest(), stderr=None)
+        nose.assert_equal(
+            subprocess.check_output(['gzip', '-d', '-c', local_backup_path]),
+            new_dump)
+        nose.assert_equal(rebuild_stats, {
+            'backup_size': os.path.getsize(local_backup_path),
+            'checksum': swb.get_file_checksum(local_backup_path)})
+        with nose.assert_raises(OSError):
+            swb.rebuild_delta_backup(
+                delta_path,
+                basis_backup_path=basis_dump_path + '.gz',
+                local_backup_path=local_backup_path,
+                backup_compressor='gzip', backup_decompressor='gzip -d',
+                raw_checksum='abc', stderr=None)
+        nose.assert_equal(sorted(os.listdir(temp_dir)), [
+            'backup.delta', 'backup.sql.gz', 'basis.sql.gz', 'new.sql'])
+
+
+@patch('swb.local.write_backup_manifest')
+@patch('swb.local.purge_remote_backup')
+@patch('swb.local.download_remote_backup', return_value={
+    'backup_size': 2048, 'checksum': 'abc', 'failed_replicas': []})
+@patch('swb.local.create_remote_backup', return_value={})
+@patch('swb.local.install_remote_dictionary')
+@patch('swb.local.create_dir_structure')
+def test_back_up_dictionary(create_dir_structure, install_remote_dictionary,
+                            create_remote_backup, download_remote_backup,
+                            purge_remote_backup, write_backup_manifest):
+    """should compress with the configured dictionary, recording its ID"""
+    config = configparser.RawConfigParser()
+    config.read('tests/files/config.ini')
+    config.set('backup', 'compressor', 'zstd -19')
+    config.set('backup', 'dictionary_id', '123')
+    swb.back_up(config, stdout=1, stderr=2)
+    install_remote_dictionary.assert_called_once_with(config, 123, stderr=2)
+    nose.assert_equal(
+        create_remote_backup.call_args[1]['backup_compressor'],
+        'zstd -19 -D .cache/ssh-wp-backup/dictionaries/123.zdict')
+    nose.assert_equal(
+        write_backup_manifest.call_args[0][1],
+        {'dictionary_id': 123, 'checksum': 'abc'})
+
+
+@patch('swb.local.write_backup_manifest')
+@patch('swb.local.purge_remote_backup')
+@patch('swb.local.copy_to_replicas')
+@patch('swb.local.download_delta_backup', return_value={
+    'backup_size': 4096, 'checksum': 'def', 'transfer_size': 100})
+@patch('swb.local.create_remote_backup', return_value={
+    'raw_size': 8192, 'raw_checksum': 'ghi', 'delta_basis': 'abc',
+    'backup_size': 100})
+@patch('swb.local.get_delta_basis', return_value=('a.sql.bz2', 'abc'))
+@patch('swb.local.create_dir_structure')
+def test_back_up_delta(create_dir_structure, get_delta_basis,
+                       create_remote_backup, download_delta_backup,
+                       copy_to_replicas, purge_remote_backup,
+                       write_backup_manifest):
+    """should rebuild the backup from a delta against the latest backup"""
+    config = configparser.RawConfigParser()
+    config.read('tests/files/config.ini')
+    config.set('backup', 'delta_transfer', 'true')
+    backup_stats = swb.back_up(config, stdout=1, stderr=2)
+    nose.assert_equal(backup_stats, {
+        'backup_size': 4096, 'raw_size': 8192, 'transfer_duration': None})
+    expanded_local_backup_path = os.path.expanduser(strftime(
+        '~/Backups/%y/%m/%d/mysite.sql.bz2'))
+    get_delta_basis.assert_called_once_with(
+        os.path.expanduser('~/Backups/%y/%m/%d/mysite.sql.bz2'))
+    nose.assert_equal(
+        create_remote_backup.call_args[1]['basis_checksum'], 'abc')
+    download_delta_backup.assert_called_once_with(
+        config, create_remote_backup.return_value,
+        remote_backup_path=strftime('~/backups/%y/%m/%d/mysite.sql.bz2'),
+        local_backup_path=expanded_local_backup_path,
+        basis_backup_path='a.sql.bz2', stdout=1, stderr=2)
+    copy_to_replicas.assert_not_called()
+    write_backup_manifest.assert_called_once_with(
+        expanded_local_backup_path, {
+            'raw_size': 8192, 'raw_checksum': 'ghi', 'delta_basis': 'abc',
+            'backup_size': 4096, 'transfer_size': 100, 'checksum': 'def'})
+
+
+def test_back_up_delta_encrypted():
+    """should refuse delta transfers of encrypted backups"""
+    config = configparser.RawConfigParser()
+    config.read('tests/files/config.ini')
+    config.set('backup', 'delta_transfer', 'true')
+    config.set('backup', 'encryption_recipient', 'age1abc')
+    with nose.assert_raises(OSError):
+        swb.back_up(config)
+
+
+@patch('os.path.getsize', return_value=2048)
+@patch('swb.local.get_file_checksum', return_value='abc')
+@patch('swb.local.upload_local_backup')
+@patch('swb.local.restore_remote_backup')
+def test_restore(restore_remote_backup, upload_local_backup,
+                 get_file_checksum, getsize):
+    """should run correct restore procedure"""
+    config = configparser.RawConfigParser()
+    config.read('tests/files/config.ini')
+    swb.restore(
+        config, local_backup_path='a/b/c.tar.bz2',
+        stdout=1, stderr=2)
+    expanded_remote_backup_path = strftime(
+        config.get('paths', 'remote_backup'))
+    get_file_checksum.assert_called_once_with('a/b/c.tar.bz2')
+    upload_local_backup.assert_called_once_with(
+        ssh_user='myname', ssh_hostname='mysite.com', ssh_port='2222',
+        transport='ssh',
+        local_backup_path='a/b/c.tar.bz2',
+        remote_backup_path=expanded_remote_backup_path,
+        stdout=1, stderr=2)
+    restore_remote_backup.assert_called_once_with(
+        ssh_user='myname', ssh_hostname='mysite.com', ssh_port='2222',
+        transport='ssh',
+        wordpress_path='~/public_html/mysite',
+        remote_backup_path=expanded_remote_backup_path,
+        backup_decompressor='bzip2 -d', backup_checksum='abc',
+        staging_db='', backup_blocks='', defer_indexes=False,
+        direct_load=False, stdout=1, stderr=2)
+
+
+@patch('os.path.getsize', return_value=2048)
+@patch('swb.local.get_file_checksum', return_value='abc')
+@patch('swb.local.upload_local_backup')
+@patch('swb.local.restore_remote_backup')
+def test_restore_local_transport(restore_remote_backup, upload_local_backup,
+                                 get_file_checksum, getsize):
+    """should upload and verify the backup with the local transport"""
+    config = configparser.RawConfigParser()
+    config.read('tests/files/config.ini')
+    config.set('ssh', 'transport', 'local')
+    swb.restore(
+        config, local_backup_path='a/b/c.tar.bz2',
+        stdout=1, stderr=2)
+    nose.assert_equal(
+        upload_local_backup.call_args[1]['transport'], 'local')
+    nose.assert_equal(
+        restore_remote_backup.call_args[1]['backup_checksum'], 'abc')
+
+
+@patch('os.path.getsize', return_value=2048)
+@patch('swb.local.get_backup_binlog_chain', return_value=([], None))
+@patch('swb.local.replay_binlogs')
+@patch('swb.local.stream_local_backup')
+@patch('swb.local.get_file_checksum', return_value='abc')
+def test_restore_until(get_file_checksum, stream_local_backup,
+                       replay_binlogs, get_backup_binlog_chain, getsize):
+    """should replay binlog events after restoring if a time is given"""
+    config = configparser.RawConfigParser()
+    config.read('tests/files/config.ini')
+    config.add_section('restore')
+    config.set('restore', 'staging_db', 'mydb_staging')
+    swb.restore(
+        config, local_backup_path='a/b/c.tar.bz2', stream=True,
+        until='2026-10-19 10:30:00', stdout=1, stderr=2)
+    replay_binlogs.assert_called_once_with(
+        config, local_backup_path='a/b/c.tar.bz2',
+        until='2026-10-19 10:30:00', stdout=1, stderr=2)
+
+
+@patch('swb.local.stream_local_backup')
+@patch('swb.local.get_file_checksum', return_value='abc')
+def test_restore_until_uncovered(get_file_checksum, stream_local_backup):
+    """should not restore backups which cannot be rolled forward"""
+    config = configparser.RawConfigParser()
+    config.read('tests/files/config.ini')
+    config.add_section('restore')
+    config.set('restore', 'staging_db', 'mydb_staging')
+    with tempfile.TemporaryDirectory() as temp_dir:
+        config.set('paths', 'local_binlogs', temp_dir)
+        write_binlog_segment(
+            temp_dir, 'binlog.000001', 100, 'binlog.000001', 500)
+        with patch('swb.local.read_backup_manifest', return_value={
+                'binlog_file': 'binlog.000001', 'binlog_position': 700}):
+            with nose.assert_raises(OSError):
+                swb.restore(
+                    config, local_backup_path='a/b/c.tar.bz2', stream=True,
+                    until='2026-10-19 10:30:00', stdout=1, stderr=2)
+    stream_local_backup.assert_not_called()
+
+
+DUMP = (b'-- MySQL dump\nSET NAMES utf8mb4;\n\n'
+        b'-- Table structure for table `wp_options`\n'
+        b'CREATE TABLE `wp_options` (\n  `option_id` int,\n'
+        b'  `option_name` varchar(191)\n);\n'
+        b"INSERT INTO `wp_options` VALUES (1,'siteurl'),(2,'home');\n\n"
+        b'-- Table structure for table `wp_posts`\n'
+        b'CREATE TABLE `wp_posts` (\n  `ID` int,\n  `post_title` text\n);\n'
+        b"INSERT INTO `wp_posts` VALUES (1,'Hello, (world)'),"
+        b"(42,'It\\'s here'),(43,NULL);\n")
+
+
+def create_gzip_backup(temp_dir, manifest):
+    import gzip
+    local_backup_path = os.path.join(temp_dir, 'mysite.sql.gz')
+    with gzip.open(local_backup_path, 'wb') as local_backup:
+        local_backup.write(DUMP)
+    swb.write_backup_manifest(local_backup_path, manifest)
+    return local_backup_path
+
+
+def get_table_offsets():
+    options_start = DUMP.index(b'-- Table structure for table `wp_o')
+    posts_start = DUMP.index(b'-- Table structure for table `wp_p')
+    return {'wp_options': [options_start, posts_start],
+            'wp_posts': [posts_start, len(DUMP)]}
+
+
+def test_extract_table():
+    """should extract the given tables using the recorded table offsets"""
+    config = configparser.RawConfigParser()
+    config.read('tests/files/config.ini')
+    with tempfile.TemporaryDirectory() as temp_dir:
+        local_backup_path = create_gzip_backup(temp_dir, {
+            'decompressor': 'gzip -d', 'table_offsets': get_table_offsets()})
+        output_path = os.path.join(temp_dir, 'wp_posts.sql')
+        swb.extract(
+            config, local_backup_path=local_backup_path,
+            table_names=['wp_posts'], row_filters={},
+            output_path=output_path)
+        with open(output_path, 'rb') as output_file:
+            nose.assert_equal(output_file.read(), (
+                DUMP[:get_table_offsets()['wp_options'][0]] +
+                DUMP[get_table_offsets()['wp_posts'][0]:]))
+
+
+def test_extract_table_unindexed():
+    """should scan backups without table offsets for the given tables"""
+    config = configparser.RawConfigParser()
+    config.read('tests/files/config.ini')
+    with tempfile.TemporaryDirectory() as temp_dir:
+        local_backup_path = create_gzip_backup(
+            temp_dir, {'decompressor': 'gzip -d'})
+        output_path = os.path.join(temp_dir, 'wp_options.sql')
+        swb.extract(
+            config, local_backup_path=local_backup_path,
+            table_names=['wp_options'], row_filters={},
+            output_path=output_path)
+        with open(output_path, 'rb') as output_file:
+            nose.assert_equal(
+                output_file.read(),
+                DUMP[:get_table_offsets()['wp_posts'][0]])
+
+
+def test_extract_rows():
+    """should extract only the rows whose columns have the given values"""
+    config = configparser.RawConfigParser()
+    config.read('tests/files/config.ini')
+    with tempfile.TemporaryDirectory() as temp_dir:
+        local_backup_path = create_gzip_backup(temp_dir, {
+            'decompressor': 'gzip -d', 'table_offsets': get_table_offsets()})
+        output_path = os.path.join(temp_dir, 'post.sql')
+        swb.extract(
+            config, local_backup_path=local_backup_path,
+            table_names=['wp_posts'], row_filters={'ID': '42'},
+            output_path=output_path)
+        with open(output_path, 'rb') as output_file:
+            nose.assert_equal(output_file.read(), (
+                b'-- MySQL dump\nSET NAMES utf8mb4;\n\n'
+                b"INSERT INTO `wp_posts` VALUES (42,'It\\'s here');\n"))
+
+
+def test_extract_table_blocks():
+    """should only decompress the blocks of a block archive that are needed"""
+    import gzip
+    config = configparser.RawConfigParser()
+    config.read('tests/files/config.ini')
+    block_size = 50
+    raw_blocks = [DUMP[index:index + block_size]
+                  for index in range(0, len(DUMP), block_size)]
+    blocks = []
+    offset = 0
+    with tempfile.TemporaryDirectory() as temp_dir:
+        local_backup_path = os.path.join(temp_dir, 'mysite.sql.gz')
+        with open(local_backup_path, 'wb') as local_backup:
+            for index, raw_block in enumerate(raw_blocks):
+                block = gzip.compress(raw_block)
+                local_backup.write(block)
+                blocks.append([
+                    index * block_size, len(raw_block), offset, len(block),
+                    hashlib.sha256(block).hexdigest()])
+                offset += len(block)
+        swb.write_backup_manifest(local_backup_path, {
+            'decompressor': 'gzip -d', 'blocks': blocks,
+            'table_offsets': get_table_offsets()})
+        output_path = os.path.join(temp_dir, 'wp_posts.sql')
+        with patch('subprocess.check_output', wraps=subprocess.check_output):
+            swb.extract(
+                config, local_backup_path=local_backup_path,
+                table_names=['wp_posts'], row_filters={},
+                output_path=output_path)
+            # The blocks containing only wp_options are skipped
+            nose.assert_less(
+                subprocess.check_output.call_count, len(blocks))
+        with open(output_path, 'rb') as output_file:
+            nose.assert_equal(output_file.read(), (
+                DUMP[:get_table_offsets()['wp_options'][0]] +
+                DUMP[get_table_offsets()['wp_posts'][0]:]))
+
+
+def test_parse_insert_rows():
+    """should parse the values of every row inserted by a statement"""
+    nose.assert_equal(
+        swb.parse_insert_rows(b"(1,'a,(b)\\n'),(2,NULL);"), [
+            (b"(1,'a,(b)\\n')", [b'1', b'a,(b)\n']),
+            (b'(2,NULL)', [b'2', None])])
+
+
+def test_get_extract_ranges_missing_table():
+    """should raise error if a table to extract is not in the backup"""
+    with nose.assert_raises(OSError):
+        swb.get_extract_ranges(get_table_offsets(), ['wp_users'])
+
+
+def write_binlog_segment(binlog_dir, binlog_file, binlog_position,
+                         end_file, end_position, events=b''):
+    segment_path = swb.get_binlog_segment_path(
+        binlog_dir, binlog_file, binlog_position)
+    with open(segment_path, 'wb') as segment:
+        segment.write('-- swb-binlog-end: {} {}\n'.format(
+            end_file, end_position).encode('utf-8'))
+        segment.write(events)
+    return segment_path
+
+
+def test_get_binlog_chain():
+    """should chain binlog segments from the given position onwards"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        write_binlog_segment(temp_dir, 'binlog.000001', 4, 'binlog.000001', 90)
+        first = write_binlog_segment(
+            temp_dir, 'binlog.000001', 90, 'binlog.000002', 50)
+        second = write_binlog_segment(
+            temp_dir, 'binlog.000002', 50, 'binlog.000002', 80)
+        nose.assert_equal(
+            swb.get_binlog_chain(temp_dir, 'binlog.000001', 90),
+            [first, second])
+
+
+def test_get_binlog_chain_within_segment():
+    """should chain binlog segments from the one containing the position"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        first = write_binlog_segment(
+            temp_dir, 'binlog.000001', 100, 'binlog.000001', 500)
+        second = write_binlog_segment(
+            temp_dir, 'binlog.000001', 500, 'binlog.000001', 900)
+        nose.assert_equal(
+            swb.get_binlog_chain(temp_dir, 'binlog.000001', 700), [second])
+        nose.assert_equal(
+            swb.get_binlog_chain(temp_dir, 'binlog.000001', 300),
+            [first, second])
+
+
+def test_get_binlog_chain_uncovered():
+    """should raise error if no binlog segment covers the position"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        write_binlog_segment(
+            temp_dir, 'binlog.000001', 100, 'binlog.000001', 500)
+        with nose.assert_raises(OSError):
+            swb.get_binlog_chain(temp_dir, 'binlog.000001', 700)
+        with nose.assert_raises(OSError):
+            swb.get_binlog_chain(temp_dir, 'binlog.000001', 50)
+
+
+def test_get_binlog_chain_gap():
+    """should raise error if a binlog segment is missing"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        write_binlog_segment(
+            temp_dir, 'binlog.000001', 90, 'binlog.000002', 50)
+        write_binlog_segment(
+            temp_dir, 'binlog.000002', 70, 'binlog.000002', 80)
+        with nose.assert_raises(OSError):
+            swb.get_binlog_chain(temp_dir, 'binlog.000001', 90)
+
+
+def get_local_time(utc_time):
+    """Format the given UTC time as the equivalent local time"""
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(
+        calendar.timegm(time.strptime(utc_time, '%Y-%m-%d %H:%M:%S'))))
+
+
+def test_write_binlog_events():
+    """should write binlog events up to the given time"""
+    events = (b'DELIMITER /*!*/;\n'
+              b'# at 90\n#261019 10:15:02 server id 1  end_log_pos 120\n'
+              b'INSERT 1/*!*/;\n'
+              b'# at 120\n#261019 10:45:00 server id 1  end_log_pos 150\n'
+              b'INSERT 2/*!*/;\n')
+    output_file = io.BytesIO()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        segment_path = write_binlog_segment(
+            temp_dir, 'binlog.000001', 90, 'binlog.000001', 150, events)
+        swb.write_binlog_events(
+            [segment_path], output_file,
+            until=get_local_time('2026-10-19 10:30:00'))
+    nose.assert_in(b'INSERT 1', output_file.getvalue())
+    nose.assert_not_in(b'INSERT 2', output_file.getvalue())
+    nose.assert_true(output_file.getvalue().endswith(b'ROLLBACK;\n'))
+
+
+def test_write_binlog_events_start():
+    """should skip binlog events before the given position"""
+    events = (b'DELIMITER /*!*/;\n'
+              b'# at 4\n#261019 10:00:00 server id 1  end_log_pos 120'
+              b' \tStart: binlog v 4\nBINLOG \'fde\'/*!*/;\n'
+              b'# at 120\n#261019 10:15:02 server id 1  end_log_pos 150\n'
+              b'INSERT 1/*!*/;\n'
+              b'# at 150\n#261019 10:16:00 server id 1  end_log_pos 190'
+              b' \tRotate to binlog.000002  pos: 4\n'
+              b'# at 4\n#261019 10:16:00 server id 1  end_log_pos 120'
+              b' \tStart: binlog v 4\nBINLOG \'fde\'/*!*/;\n'
+              b'# at 120\n#261019 10:17:00 server id 1  end_log_pos 150\n'
+              b'INSERT 2/*!*/;\n')
+    output_file = io.BytesIO()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        segment_path = write_binlog_segment(
+            temp_dir, 'binlog.000001', 4, 'binlog.000002', 150, events)
+        swb.write_binlog_events(
+            [segment_path], output_file,
+            until=get_local_time('2026-10-19 10:30:00'),
+            start=('binlog.000001', 150))
+    nose.assert_not_in(b'INSERT 1', output_file.getvalue())
+    nose.assert_in(b'INSERT 2', output_file.getvalue())
+    nose.assert_equal(output_file.getvalue().count(b"BINLOG 'fde'"), 2)
+
+
+@patch('swb.local.exec_on_remote')
+def test_fetch_binlog(exec_on_remote):
+    """should store binlog events since the last segment as a new segment"""
+    config = configparser.RawConfigParser()
+    config.read('tests/files/config.ini')
+    with tempfile.TemporaryDirectory() as temp_dir:
+        config.set('paths', 'local_binlogs', temp_dir)
+        write_binlog_segment(temp_dir, 'binlog.000001', 4, 'binlog.000001', 90)
+        exec_on_remote.side_effect = lambda **kwargs: kwargs['stdout'].write(
+            b'-- swb-binlog-end: binlog.000001 150\n# at 90\n')
+        fetch_stats = swb.fetch_binlog(config)
+        nose.assert_equal(exec_on_remote.call_args[1]['action_args'], [
+            '~/public_html/mysite', 'binlog.000001', '90'])
+        nose.assert_equal(
+            swb.read_binlog_segment_end(swb.get_binlog_segment_path(
+                temp_dir, 'binlog.000001', 90)),
+            ('binlog.000001', 150))
+        nose.assert_equal(fetch_stats['backup_size'], 45)
+
+
+@patch('swb.local.exec_on_remote')
+def test_fetch_binlog_empty(exec_on_remote):
+    """should discard binlog segments without any events"""
+    config = configparser.RawConfigParser()
+    config.read('tests/files/config.ini')
+    with tempfile.TemporaryDirectory() as temp_dir:
+        config.set('paths', 'local_binlogs', temp_dir)
+        write_binlog_segment(temp_dir, 'binlog.000001', 4, 'binlog.000001', 90)
+        exec_on_remote.side_effect = lambda **kwargs: kwargs['stdout'].write(
+            b'-- swb-binlog-end: binlog.000001 90\n')
+        swb.fetch_binlog(config)
+        nose.assert_equal(os.listdir(temp_dir), [
+            'binlog.000001-000000000004.sql'])
+
+
+@patch('os.path.getsize', return_value=2048)
+@patch('swb.local.get_file_checksum', return_value='abc')
+@patch('swb.local.upload_local_backup')
+@patch('swb.local.restore_remote_backup')
+def test_restore_blocks(restore_remote_backup, upload_local_backup,
+                        get_file_checksum, getsize):
+    """should pass the block sizes of block archives to the remote"""
+    config = configparser.RawConfigParser()
+    config.read('tests/files/config.ini')
+    with patch('swb.local.read_backup_manifest', return_value={
+            'blocks': [[0, 100, 0, 40, 'a'], [100, 50, 40, 30, 'b']]}):
+        swb.restore(config, local_backup_path='a/b/c.tar.bz2')
+    nose.assert_equal(
+        restore_remote_backup.call_args[1]['backup_blocks'], '40,30')
+
+
+@patch('os.path.getsize', return_value=2048)
+@patch('swb.local.get_file_checksum', return_value='abc')
+@patch('swb.local.upload_local_backup')
+@patch('swb.local.restore_remote_backup')
+def test_restore_staging_db(restore_remote_backup, upload_local_backup,
+                            get_file_checksum, getsize):
+    """should restore via the staging database if one is configured"""
+    config = configparser.RawConfigParser()
+    config.read('tests/files/config.ini')
+    config.add_section('restore')
+    config.set('restore', 'staging_db', 'mydb_staging')
+    swb.restore(config, local_backup_path='a/b/c.tar.bz2')
+    nose.assert_equal(
+        restore_remote_backup.call_args[1]['staging_db'], 'mydb_staging')
+
+
+@patch('os.path.getsize', return_value=2048)
+@patch('swb.local.get_file_checksum', return_value='abc')
+@patch('swb.local.stream_local_backup')
+@patch('swb.local.upload_local_backup')
+@patch('swb.local.restore_remote_backup')
+def test_restore_stream(restore_remote_backup, upload_local_backup,
+                        stream_local_backup, get_file_checksum, getsize):
+    """should stream backup to remote when restoring in stream mode"""
+    config = configparser.RawConfigParser()
+    config.read('tests/files/config.ini')
+    config.add_section('restore')
+    config.set('restore', 'staging_db', 'mydb_staging')
+    swb.restore(
+        config, local_backup_path='a/b/c.tar.bz2', stream=True,
+        stdout=1, stderr=2)
+    stream_local_backup.assert_called_once_with(
+        ssh_user='myname', ssh_hostname='mysite.com', ssh_port='2222',
+        transport='ssh',
+        wordpress_path='~/public_html/mysite',
+        local_backup_path='a/b/c.tar.bz2',
+        backup_decompressor='bzip2 -d', backup_checksum='abc',
+        staging_db='mydb_staging', encryption_identity=None,
+        backup_blocks='', defer_indexes=False, stdout=1, stderr=2)
+    upload_local_backup.assert_not_called()
+    restore_remote_backup.assert_not_called()
+
+
+@patch('os.path.getsize', return_value=2048)
+@patch('swb.local.get_file_checksum', return_value='abc')
+@patch('swb.local.stream_local_backup')
+def test_restore_stream_no_staging_db(stream_local_backup, get_file_checksum,
+                                      getsize):
+    """should let the remote stage streamed backups if none is configured"""
+    config = configparser.RawConfigParser()
+    config.read('tests/files/config.ini')
+    swb.restore(
+        config, local_backup_path='a/b/c.tar.bz2', stream=True,
+        stdout=1, stderr=2)
+    nose.assert_equal(stream_local_backup.call_args[1]['staging_db'], '')
+
+
+@patch('swb.local.get_file_checksum', return_value='abc')
+@patch('swb.local.stream_local_backup')
+def test_restore_stream_direct_load(stream_local_backup, get_file_checksum):
+    """should refuse to load streamed backups directly into the database"""
+    config = configparser.RawConfigParser()
+    config.read('tests/files/config.ini')
+    config.add_section('restore')
+    config.set('restore', 'direct_load', 'true')
+    with nose.assert_raises(OSError):
+        swb.restore(
+            config, local_backup_path='a/b/c.tar.bz2', stream=True,
+            stdout=1, stderr=2)
+    stream_local_backup.assert_not_called()
+
+
+@patch('os.path.getsize', return_value=2048)
+@patch('swb.local.get_file_checksum', return_value='abc')
+@patch('swb.local.upload_local_backup')
+@patch('swb.local.restore_remote_backup')
+def test_restore_direct_load(restore_remote_backup, upload_local_backup,
+                             get_file_checksum, getsize):
+    """should load uploaded backups directly only if configured to"""
+    config = configparser.RawConfigParser()
+    config.read('tests/files/config.ini')
+    config.add_section('restore')
+    config.set('restore', 'direct_load', 'true')
+    swb.restore(config, local_backup_path='a/b/c.tar.bz2')
+    nose.assert_equal(
+        restore_remote_backup.call_args[1]['direct_load'], True)
+
+
+@patch('os.path.getsize', return_value=2048)
+@patch('swb.local.read_backup_manifest', return_value={
+    'encrypted': True, 'decompressor': 'xz -d'})
+@patch('swb.local.get_file_checksum')
+@patch('swb.local.stream_local_backup')
+@patch('swb.local.upload_local_backup')
+def test_restore_encrypted(upload_local_backup, stream_local_backup,
+                           get_file_checksum, read_backup_manifest, getsize):
+    """should decrypt and stream encrypted backups when restoring"""
+    config = configparser.RawConfigParser()
+    config.read('tests/files/config.ini')
+    config.add_section('restore')
+    config.set('restore', 'encryption_identity', '~/key.txt')
+    config.set('restore', 'staging_db', 'mydb_staging')
+    swb.restore(config, local_backup_path='a/b/c.sql.xz.age')
+    stream_local_backup.assert_called_once_with(
+        ssh_user='myname', ssh_hostname='mysite.com', ssh_port='2222',
+        transport='ssh',
+        wordpress_path='~/public_html/mysite',
+        local_backup_path='a/b/c.sql.xz.age',
+        backup_decompressor='xz -d', backup_checksum='',
+        staging_db='mydb_staging',
+        encryption_identity=os.path.expanduser('~/key.txt'),
+        backup_blocks='', defer_indexes=False, stdout=None, stderr=None)
+    get_file_checksum.assert_not_called()
+    upload_local_backup.assert_not_called()
+
+
+@patch('swb.local.purge_oldest_backups')
+@patch('swb.local.record_run')
+@patch('swb.local.parse_config')
+@patch('swb.local.back_up')
+@patch('sys.argv', [swb.__file__, 'tests/files/config.ini'])
+def test_main_back_up(back_up, parse_config, record_run,
+                      purge_oldest_backups):
+    """should run backup procedure by default when utility is run"""
+    swb.main()
+    back_up.assert_called_once_with(
+        parse_config.return_value, stdout=None, stderr=None, progress=None)
+
+
+@patch('swb.local.purge_oldest_backups')
+@patch('swb.local.record_run')
+@patch('swb.local.parse_config')
+@patch('swb.local.back_up')
+@patch('sys.argv', [swb.__file__, '-q', 'tests/files/config.ini'])
+@patch('builtins.open')
+def test_main_quiet(builtin_open, back_up, parse_config, record_run,
+                    purge_oldest_backups):
+    """should silence stdout/stderr when utility is run in quiet mode"""
+    swb.main()
+    devnull = builtin_open.return_value.__enter__()
+    back_up.assert_called_once_with(
+        parse_config.return_value,
+        stdout=devnull, stderr=devnull, progress=None)
+
+
+@patch('swb.local.record_run')
+@patch('swb.local.restore')
+@patch('swb.local.parse_config')
+@patch('sys.argv', [swb.__file__, 'tests/files/config.ini', '-r', 'a.tar.bz2'])
+@patch('builtins.print')
+@patch('builtins.input', return_value='y')
+def test_main_restore(builtin_input, builtin_print, parse_config, restore,
+                      record_run):
+    """should run restore procedure when -r/--restore is passed to utility"""
+    swb.main()
+    builtin_input.assert_called_once_with(ANY)
+    restore.assert_called_once_with(
+        parse_config.return_value, local_backup_path='a.tar.bz2',
+        stream=False, until=None, stdout=None, stderr=None)
+
+
+@patch('swb.local.record_run')
+@patch('swb.local.restore')
+@patch('swb.local.parse_config')
+@patch('sys.argv', [swb.__file__, 'tests/files/config.ini', '-r', 'a.tar.bz2'])
+@patch('builtins.print')
+@patch('builtins.input', return_value='n')
+def test_main_restore_cancel(builtin_input, builtin_print,
+                             parse_config, restore, record_run):
+    """should cancel restore procedure when user cancels confirmation"""
+    with nose.assert_raises(Exception):
+        swb.main()
+    restore.assert_not_called()
+
+
+@patch('swb.local.record_run')
+@patch('swb.local.restore')
+@patch('swb.local.parse_config')
+@patch('sys.argv', [
+    swb.__file__, 'tests/files/config.ini',
+    '-fr', 'a.tar.bz2'])
+@patch('builtins.print')
+@patch('builtins.input', return_value='y')
+def test_main_restore_force(builtin_input, builtin_print,
+                            parse_config, restore, record_run):
+    """should force restore procedure when -fr is passed to utility"""
+    swb.main()
     builtin_input.assert_not_called()
     restore.assert_called_once_with(
         parse_config.return_value, local_backup_path='a.tar.bz2',
+        stream=False, until=None, stdout=None, stderr=None)
+
+
+@patch('swb.local.record_run')
+@patch('swb.local.restore')
+@patch('swb.local.parse_config')
+@patch('sys.argv', [
+    swb.__file__, 'tests/files/config.ini',
+    '-fsr', 'a.tar.bz2'])
+def test_main_restore_stream(parse_config, restore, record_run):
+    """should stream backup when -s/--stream is passed to utility"""
+    swb.main()
+    restore.assert_called_once_with(
+        parse_config.return_value, local_backup_path='a.tar.bz2',
+        stream=True, until=None, stdout=None, stderr=None)
+
+
+@patch('swb.local.purge_oldest_backups')
+@patch('swb.local.get_retention_policies')
+@patch('swb.local.record_run')
+@patch('swb.local.get_site_name', side_effect=lambda config: config)
+@patch('swb.local.parse_config', side_effect=lambda config_path: config_path)
+@patch('swb.local.back_up')
+@patch('sys.argv', [swb.__file__, 'a.ini', 'b.ini'])
+def test_main_back_up_multiple_fail(back_up, parse_config, get_site_name,
+                                    record_run, get_retention_policies,
+                                    purge_oldest_backups):
+    """should back up the other sites and purge backups if a site fails"""
+    back_up.side_effect = [SystemExit(255), {}]
+    with nose.assert_raises(OSError) as context:
+        swb.main()
+    nose.assert_equal(back_up.call_count, 2)
+    purge_oldest_backups.assert_called_once_with(
+        get_retention_policies.return_value)
+    nose.assert_in('exit status 255', str(context.exception))
+
+
+@patch('swb.local.purge_oldest_backups')
+@patch('swb.local.get_retention_policies')
+@patch('swb.local.record_run')
+@patch('swb.local.parse_config', side_effect=lambda config_path: config_path)
+@patch('swb.local.back_up')
+@patch('sys.argv', [swb.__file__, 'a.ini', 'b.ini'])
+def test_main_back_up_multiple(back_up, parse_config, record_run,
+                               get_retention_policies, purge_oldest_backups):
+    """should back up every site, then purge their oldest backups at once"""
+    swb.main()
+    nose.assert_equal(back_up.call_args_list, [
+        call('a.ini', stdout=None, stderr=None, progress=None),
+        call('b.ini', stdout=None, stderr=None, progress=None)])
+    get_retention_policies.assert_called_once_with(['a.ini', 'b.ini'])
+    purge_oldest_backups.assert_called_once_with(
+        get_retention_policies.return_value)
+
+
+@patch('swb.local.purge_oldest_backups')
+@patch('swb.local.record_run')
+@patch('swb.local.parse_config')
+@patch('swb.local.back_up', side_effect=SystemExit(255))
+@patch('sys.argv', [swb.__file__, 'tests/files/config.ini'])
+def test_main_back_up_fail(back_up, parse_config, record_run,
+                           purge_oldest_backups):
+    """should record failed runs in the run history"""
+    with nose.assert_raises(OSError):
+        swb.main()
+    record_run.assert_called_once_with(
+        parse_config.return_value, action='back-up', started=ANY,
+        succeeded=False, run_stats={})
+
+
+@patch('swb.local.purge_oldest_backups')
+@patch('swb.local.record_run')
+@patch('swb.local.parse_config')
+@patch('swb.local.back_up', return_value={'backup_size': 2048})
+@patch('sys.argv', [swb.__file__, 'tests/files/config.ini'])
+def test_main_back_up_record(back_up, parse_config, record_run,
+                             purge_oldest_backups):
+    """should record successful runs in the run history"""
+    swb.main()
+    record_run.assert_called_once_with(
+        parse_config.return_value, action='back-up', started=ANY,
+        succeeded=True, run_stats={'backup_size': 2048})
+
+
+@patch('swb.local.record_run')
+@patch('swb.local.fetch_binlog', return_value={'backup_size': 512})
+@patch('swb.local.parse_config')
+@patch('sys.argv', [swb.__file__, 'tests/files/config.ini', '--binlog'])
+def test_main_binlog(parse_config, fetch_binlog, record_run):
+    """should fetch binlog events when --binlog is passed to utility"""
+    swb.main()
+    fetch_binlog.assert_called_once_with(
+        parse_config.return_value, stdout=None, stderr=None)
+    record_run.assert_called_once_with(
+        parse_config.return_value, action='binlog', started=ANY,
+        succeeded=True, run_stats={'backup_size': 512})
+
+
+@patch('swb.local.extract')
+@patch('swb.local.parse_config')
+@patch('sys.argv', [
+    swb.__file__, 'tests/files/config.ini', '-x', 'a.sql.gz',
+    '-t', 'wp_posts', '--row', 'ID=42', '-o', 'post.sql'])
+def test_main_extract(parse_config, extract):
+    """should extract tables when -x/--extract is passed to utility"""
+    swb.main()
+    extract.assert_called_once_with(
+        parse_config.return_value, local_backup_path='a.sql.gz',
+        table_names=['wp_posts'], row_filters={'ID': '42'},
+        output_path='post.sql', stderr=None)
+
+
+@patch('builtins.print')
+@patch('swb.local.train_dictionary', return_value=123)
+@patch('swb.local.back_up')
+@patch('swb.local.parse_config', side_effect=lambda config_path: config_path)
+@patch('sys.argv', [swb.__file__, 'a.ini', 'b.ini', '--train-dictionary'])
+def test_main_train_dictionary(parse_config, back_up, train_dictionary,
+                               builtin_print):
+    """should train a dictionary on the backups of every given site"""
+    swb.main()
+    train_dictionary.assert_called_once_with(['a.ini', 'b.ini'], stderr=None)
+    back_up.assert_not_called()
+    nose.assert_in('123', builtin_print.call_args[0][0])
+
+
+@patch('swb.local.purge_oldest_backups')
+@patch('swb.local.record_run')
+@patch('swb.local.parse_config')
+@patch('swb.local.back_up')
+@patch('sys.argv', [
+    swb.__file__, 'tests/files/config.ini', '-q', '--progress', 'json'])
+def test_main_progress(back_up, parse_config, record_run,
+                       purge_oldest_backups):
+    """should report the progress of backups in the given style"""
+    swb.main()
+    nose.assert_equal(back_up.call_args[1]['progress'], 'json')
+
+
+@patch('swb.local.run_daemon')
+@patch('swb.local.back_up')
+@patch('swb.local.parse_config')
+@patch('sys.argv', [
+    swb.__file__, 'tests/files/config.ini', '--daemon', '--workers', '8',
+    '--status-port', '8080'])
+def test_main_daemon(parse_config, back_up, run_daemon):
+    """should run the daemon when --daemon is passed to utility"""
+    swb.main()
+    run_daemon.assert_called_once_with(
+        [parse_config.return_value], num_workers=8, status_port=8080,
         stdout=None, stderr=None)
+    back_up.assert_not_called()
+
+
+@patch('swb.local.report')
+@patch('swb.local.back_up')
+@patch('swb.local.parse_config')
+@patch('sys.argv', [swb.__file__, 'tests/files/config.ini', '--report'])
+def test_main_report(parse_config, back_up, report):
+    """should print run history report when --report is passed to utility"""
+    swb.main()
+    report.assert_called_once_with(parse_config.return_value)
+    back_up.assert_not_called()
@@ -1,11 +1,18 @@
 #!/usr/bin/env python3
 
+import hashlib
+import io
+import json
 import os
 import os.path
 import subprocess
+import sys
+import tempfile
+import threading
+import time
 import nose.tools as nose
 import swb.remote as swb
-from mock import patch
+from mock import ANY, Mock, call, patch
 
 
 WP_PATH = 'tests/files/mysite'
@@ -44,27 +51,515 @@ def test_get_db_info(read_wp_config):
     nose.assert_equal(db_info['host'], 'myhost')
     nose.assert_equal(db_info['charset'], 'utf8')
     nose.assert_equal(db_info['collate'], '')
+    nose.assert_equal(db_info['table_prefix'], 'wp_')
+
+
+@patch('swb.remote.read_wp_config', return_value=(
+    "define('DB_NAME', 'mydb');\n$table_prefix  = 'wp2_';\n"))
+def test_get_db_info_table_prefix(read_wp_config):
+    """should parse the table prefix from wp-config.php"""
+    db_info = swb.get_db_info(WP_PATH)
+    nose.assert_equal(db_info['table_prefix'], 'wp2_')
 
 
 @patch('subprocess.Popen')
 @patch('builtins.open')
 def test_dump_compressed_db(builtin_open, popen):
     """should dump compressed database to designated location on remote"""
-    swb.dump_compressed_db(
+    popen.return_value.returncode = 0
+    popen.return_value.stdout.read.side_effect = [b'abc', b'de', b'']
+    dump_stats = swb.dump_compressed_db(
         db_name='mydb', db_host='myhost',
         db_user='myname', db_password='mypassword',
         backup_compressor='bzip2 -v', backup_path='a/b c/d')
     popen.assert_any_call([
         'mysqldump', 'mydb', '-h', 'myhost', '-u', 'myname', '-pmypassword',
-        '--add-drop-table'], stdout=subprocess.PIPE)
-    builtin_open.assert_called_once_with('a/b c/d', 'w')
+        '--add-drop-table'], stdout=subprocess.PIPE, stderr=ANY)
+    builtin_open.assert_called_once_with('a/b c/d', 'wb')
     popen.assert_any_call(
         ['bzip2', '-v'],
-        stdin=popen.return_value.stdout,
+        stdin=subprocess.PIPE,
         stdout=builtin_open.return_value.__enter__())
+    nose.assert_equal(popen.return_value.stdin.write.call_args_list, [
+        call(b'abc'), call(b'de')])
+    nose.assert_equal(dump_stats, {'raw_size': 5})
     nose.assert_equal(popen.return_value.wait.call_count, 2)
 
 
+@patch('subprocess.Popen')
+@patch('builtins.open')
+def test_dump_compressed_db_table_offsets(builtin_open, popen):
+    """should record the offsets of the tables in the dump"""
+    popen.return_value.returncode = 0
+    popen.return_value.stdout.read.side_effect = [
+        b'-- Dump\n\n-- Table structure for table `wp_posts`\n', b'abc', b'']
+    dump_stats = swb.dump_compressed_db(
+        db_name='mydb', db_host='myhost',
+        db_user='myname', db_password='mypassword',
+        backup_compressor='bzip2 -v', backup_path='a/b c/d')
+    nose.assert_equal(dump_stats['table_offsets'], {'wp_posts': [9, 52]})
+
+
+@patch('subprocess.Popen')
+@patch('builtins.open')
+def test_dump_compressed_db_fail(builtin_open, popen):
+    """should raise error if database could not be dumped"""
+    popen.return_value.returncode = 2
+    popen.return_value.stdout.read.return_value = b''
+    with nose.assert_raises(OSError):
+        swb.dump_compressed_db(
+            db_name='mydb', db_host='myhost',
+            db_user='myname', db_password='mypassword',
+            backup_compressor='bzip2 -v', backup_path='a/b c/d')
+
+
+@patch('subprocess.Popen')
+@patch('builtins.open')
+def test_dump_compressed_db_lock_wait(builtin_open, popen):
+    """should raise TimeoutError if the dump gave up waiting for a lock"""
+    def start_process(args, **kwargs):
+        if args[0] == 'mysqldump':
+            kwargs['stderr'].write(
+                b'mysqldump: Lock wait timeout exceeded;'
+                b' try restarting transaction (1205)\n')
+        return popen.return_value
+    popen.side_effect = start_process
+    popen.return_value.returncode = 2
+    popen.return_value.stdout.read.return_value = b''
+    with nose.assert_raises(TimeoutError):
+        swb.dump_compressed_db(
+            db_name='mydb', db_host='myhost',
+            db_user='myname', db_password='mypassword',
+            backup_compressor='bzip2 -v', backup_path='a/b c/d')
+
+
+@patch('swb.remote.choose_codec', return_value=('xz -6', 'xz -d'))
+@patch('subprocess.Popen')
+@patch('builtins.open')
+def test_dump_compressed_db_auto(builtin_open, popen, choose_codec):
+    """should compress dump with the codec chosen from a sample of it"""
+    popen.return_value.returncode = 0
+    popen.return_value.stdout.read.side_effect = [b'abc', b'de', b'']
+    dump_stats = swb.dump_compressed_db(
+        db_name='mydb', db_host='myhost',
+        db_user='myname', db_password='mypassword',
+        backup_compressor='auto', backup_path='a/b c/d',
+        backup_options={'sample_size': 3, 'link_bandwidth': 1024})
+    choose_codec.assert_called_once_with(
+        b'abc', objective='time', link_bandwidth=1024)
+    popen.assert_any_call(
+        ['xz', '-6'],
+        stdin=subprocess.PIPE,
+        stdout=builtin_open.return_value.__enter__())
+    nose.assert_equal(popen.return_value.stdin.write.call_args_list, [
+        call(b'abc'), call(b'de')])
+    nose.assert_equal(dump_stats, {
+        'compressor': 'xz -6', 'decompressor': 'xz -d', 'raw_size': 5})
+
+
+@patch('subprocess.Popen')
+@patch('builtins.open')
+def test_dump_compressed_db_encrypted(builtin_open, popen):
+    """should encrypt compressed dump if an encryption recipient is given"""
+    popen.return_value.returncode = 0
+    popen.return_value.stdout.read.side_effect = [b'abc', b'']
+    dump_stats = swb.dump_compressed_db(
+        db_name='mydb', db_host='myhost',
+        db_user='myname', db_password='mypassword',
+        backup_compressor='bzip2 -v', backup_path='a/b c/d',
+        backup_options={'encryption_recipient': 'age1abc'})
+    popen.assert_any_call(
+        ['bzip2', '-v'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    popen.assert_any_call(
+        ['age', '-r', 'age1abc'],
+        stdin=popen.return_value.stdout,
+        stdout=builtin_open.return_value.__enter__())
+    nose.assert_equal(dump_stats, {'encrypted': True, 'raw_size': 3})
+    nose.assert_equal(popen.return_value.wait.call_count, 3)
+
+
+@patch('subprocess.Popen')
+@patch('builtins.open')
+def test_dump_compressed_db_encrypt_fail(builtin_open, popen):
+    """should raise error if compressed dump could not be encrypted"""
+    mysqldump = Mock(returncode=0)
+    mysqldump.stdout.read.return_value = b''
+    popen.side_effect = [mysqldump, Mock(returncode=0), Mock(returncode=1)]
+    with nose.assert_raises(OSError):
+        swb.dump_compressed_db(
+            db_name='mydb', db_host='myhost',
+            db_user='myname', db_password='mypassword',
+            backup_compressor='bzip2 -v', backup_path='a/b c/d',
+            backup_options={'encryption_recipient': 'age1abc'})
+
+
+@patch('swb.remote.get_binlog_position_option', return_value='--source-data')
+@patch('subprocess.Popen')
+@patch('builtins.open')
+def test_dump_compressed_db_binlog(builtin_open, popen,
+                                   get_binlog_position_option):
+    """should record the binlog position at which the dump was taken"""
+    popen.return_value.returncode = 0
+    popen.return_value.stdout.read.side_effect = [
+        b"-- CHANGE SOURCE TO SOURCE_LOG_FILE='binlog.000012',"
+        b" SOURCE_LOG_POS=4242;\n", b'']
+    dump_stats = swb.dump_compressed_db(
+        db_name='mydb', db_host='myhost',
+        db_user='myname', db_password='mypassword',
+        backup_compressor='bzip2 -v', backup_path='a/b c/d',
+        backup_options={'binlog': True})
+    popen.assert_any_call([
+        'mysqldump', 'mydb', '-h', 'myhost', '-u', 'myname', '-pmypassword',
+        '--add-drop-table', '--single-transaction', '--source-data=2'],
+        stdout=subprocess.PIPE, stderr=ANY)
+    nose.assert_equal(dump_stats['binlog_file'], 'binlog.000012')
+    nose.assert_equal(dump_stats['binlog_position'], 4242)
+
+
+def test_parse_binlog_position_legacy():
+    """should parse binlog positions recorded by older MySQL versions"""
+    nose.assert_equal(swb.parse_binlog_position(
+        b"-- CHANGE MASTER TO MASTER_LOG_FILE='mysql-bin.000003',"
+        b" MASTER_LOG_POS=154;\n"), ('mysql-bin.000003', 154))
+    nose.assert_is_none(swb.parse_binlog_position(b'-- MySQL dump\n'))
+
+
+@patch('swb.remote.get_table_stats', return_value={
+    'wp_MyPlugin_Log': {'size': 4096, 'rows': 40}})
+def test_get_dump_commands_filter_case(get_table_stats):
+    """should match table filters (whose globs are lowercased) ignoring case"""
+    mysqldump_args = ['mysqldump', 'mydb', '--add-drop-table']
+    dump_commands, table_stats = swb.get_dump_commands(
+        mysqldump_args, {'table_filters': {'myplugin_*': 'id > 10'}},
+        db_name='mydb', db_host='myhost',
+        db_user='myname', db_password='mypassword', table_prefix='wp_')
+    nose.assert_equal(table_stats['filtered_tables'], ['wp_MyPlugin_Log'])
+
+
+@patch('swb.remote.get_table_stats', return_value={
+    'wp_options': {'size': 4096, 'rows': 40},
+    'wp_posts': {'size': 8192, 'rows': 20},
+    'wp_wc_sessions': {'size': 2048, 'rows': 30},
+    'wp_actionscheduler_logs': {'size': 1024, 'rows': 10}})
+def test_get_dump_commands(get_table_stats):
+    """should dump selected tables, with schema only or filtered rows"""
+    mysqldump_args = ['mysqldump', 'mydb', '--add-drop-table']
+    dump_commands, table_stats = swb.get_dump_commands(
+        mysqldump_args + ['--single-transaction'], {
+            'exclude_tables': ['actionscheduler_*'],
+            'schema_only_tables': ['wc_sessions'],
+            'table_filters': {'options': "option_name NOT LIKE '_t%'"}},
+        db_name='mydb', db_host='myhost',
+        db_user='myname', db_password='mypassword', table_prefix='wp_')
+    nose.assert_equal(dump_commands, [
+        mysqldump_args + [
+            '--single-transaction',
+            '--ignore-table=mydb.wp_actionscheduler_logs',
+            '--ignore-table=mydb.wp_wc_sessions',
+            '--ignore-table=mydb.wp_options'],
+        mysqldump_args + ['--no-data', 'wp_wc_sessions'],
+        mysqldump_args + [
+            "--where=option_name NOT LIKE '_t%'", 'wp_options']])
+    nose.assert_equal(table_stats, {
+        'skipped_tables': {
+            'wp_actionscheduler_logs': {'size': 1024, 'rows': 10},
+            'wp_wc_sessions': {'size': 2048, 'rows': 30}},
+        'schema_only_tables': ['wp_wc_sessions'],
+        'filtered_tables': ['wp_options']})
+
+
+@patch('swb.remote.get_table_stats')
+def test_get_dump_commands_all_tables(get_table_stats):
+    """should dump every table with a single command by default"""
+    dump_commands, table_stats = swb.get_dump_commands(
+        ['mysqldump', 'mydb'], {}, db_name='mydb', db_host='myhost',
+        db_user='myname', db_password='mypassword', table_prefix='wp_')
+    nose.assert_equal(dump_commands, [['mysqldump', 'mydb']])
+    nose.assert_equal(table_stats, {})
+    get_table_stats.assert_not_called()
+
+
+@patch('swb.remote.query_db', return_value=[
+    ['wp_posts', '8192', '20'], ['wp_view', 'NULL', 'NULL']])
+def test_get_table_stats(query_db):
+    """should retrieve the size and row count of every table"""
+    nose.assert_equal(swb.get_table_stats(
+        db_name='mydb', db_host='myhost',
+        db_user='myname', db_password='mypassword'), {
+            'wp_posts': {'size': 8192, 'rows': 20},
+            'wp_view': {'size': 0, 'rows': 0}})
+
+
+@patch('swb.remote.report_progress')
+@patch('swb.remote.get_table_stats', return_value={
+    'wp_posts': {'size': 8192, 'rows': 20}})
+@patch('subprocess.Popen')
+@patch('builtins.open')
+def test_dump_compressed_db_progress(builtin_open, popen, get_table_stats,
+                                     report_progress):
+    """should report the progress of the dump if it was requested"""
+    popen.return_value.returncode = 0
+    popen.return_value.stdout.read.side_effect = [
+        b'-- Dump\n\n-- Table structure for table `wp_posts`\n', b'abc', b'']
+    swb.dump_compressed_db(
+        db_name='mydb', db_host='myhost',
+        db_user='myname', db_password='mypassword',
+        backup_compressor='bzip2 -v', backup_path='a/b c/d',
+        backup_options={'progress': True})
+    report_progress.assert_called_with({
+        'stage': 'dump', 'tables_total': 1, 'estimated_bytes': 8192,
+        'dumped_bytes': 52, 'done': True},
+        table_offsets={'wp_posts': [9, 52]},
+        output_file=builtin_open.return_value.__enter__())
+
+
+@patch('swb.remote.get_table_stats', return_value={
+    'wp_a': {'size': 100, 'rows': 1}, 'wp_b': {'size': 200, 'rows': 2},
+    'wp_c': {'size': 400, 'rows': 4}})
+def test_get_dump_progress(get_table_stats):
+    """should count the tables and bytes which are dumped"""
+    nose.assert_equal(swb.get_dump_progress(
+        db_name='mydb', db_host='myhost',
+        db_user='myname', db_password='mypassword',
+        table_stats={
+            'skipped_tables': {'wp_a': {}, 'wp_b': {}},
+            'schema_only_tables': ['wp_b']},
+        label='a'), {
+            'stage': 'dump', 'tables_total': 2, 'estimated_bytes': 400,
+            'dumped_bytes': 0, 'label': 'a'})
+
+
+@patch('sys.stderr', new_callable=io.StringIO)
+def test_report_progress(stderr):
+    """should report the progress of a dump as a line on stderr"""
+    with tempfile.TemporaryFile() as output_file:
+        output_file.write(b'abc')
+        output_file.flush()
+        swb.report_progress(
+            {'stage': 'dump', 'dumped_bytes': 10},
+            table_offsets={'wp_a': [0, 5], 'wp_b': [5, None]},
+            output_file=output_file)
+    nose.assert_true(stderr.getvalue().startswith('swb-progress: '))
+    nose.assert_equal(json.loads(stderr.getvalue()[14:]), {
+        'stage': 'dump', 'dumped_bytes': 10, 'tables_done': 1,
+        'current_table': 'wp_b', 'compressed_bytes': 3})
+
+
+@patch('swb.remote.get_dump_commands', return_value=(
+    [['mysqldump', 'mydb'], ['mysqldump', 'mydb', '--no-data', 'wp_a']],
+    {'schema_only_tables': ['wp_a']}))
+@patch('subprocess.Popen')
+@patch('builtins.open')
+def test_dump_compressed_db_tables(builtin_open, popen, get_dump_commands):
+    """should concatenate the dumps of tables dumped separately"""
+    mysqldump = Mock(returncode=0, stdout=io.BytesIO(b'abc'))
+    table_dump = Mock(returncode=0, stdout=io.BytesIO(b'de'))
+    compressor = Mock(returncode=0)
+    popen.side_effect = [mysqldump, compressor, table_dump]
+    dump_stats = swb.dump_compressed_db(
+        db_name='mydb', db_host='myhost',
+        db_user='myname', db_password='mypassword',
+        backup_compressor='bzip2 -v', backup_path='a/b c/d',
+        backup_options={'schema_only_tables': ['a']})
+    nose.assert_equal(compressor.stdin.write.call_args_list, [
+        call(b'abc'), call(b'de')])
+    nose.assert_equal(dump_stats, {
+        'raw_size': 5, 'schema_only_tables': ['wp_a']})
+
+
+@patch('swb.remote.compress_blocks', return_value=([[0, 3, 0, 2, 'a']], 3))
+@patch('subprocess.Popen')
+@patch('builtins.open')
+def test_dump_compressed_db_blocks(builtin_open, popen, compress_blocks):
+    """should compress dump in independent blocks if a block size is given"""
+    popen.return_value.returncode = 0
+    popen.return_value.stdout.read.side_effect = [b'abc', b'']
+    dump_stats = swb.dump_compressed_db(
+        db_name='mydb', db_host='myhost',
+        db_user='myname', db_password='mypassword',
+        backup_compressor='gzip -6', backup_path='a/b c/d',
+        backup_options={'block_size': 1024})
+    compress_blocks.assert_called_once_with(
+        ANY, builtin_open.return_value.__enter__(),
+        compressor=['gzip', '-6'], block_size=1024,
+        num_workers=os.cpu_count() or 1)
+    nose.assert_equal(dump_stats, {
+        'blocks': [[0, 3, 0, 2, 'a']], 'raw_size': 3})
+
+
+@patch('subprocess.Popen')
+def test_start_pipeline(popen):
+    """should chain the given commands, writing output to the given file"""
+    first, second = Mock(), Mock()
+    popen.side_effect = [first, second]
+    pipeline = swb.start_pipeline([['a'], ['b', 'c']], 3)
+    nose.assert_equal(pipeline, [first, second])
+    nose.assert_equal(popen.call_args_list, [
+        call(['a'], stdin=subprocess.PIPE, stdout=subprocess.PIPE),
+        call(['b', 'c'], stdin=first.stdout, stdout=3)])
+    first.stdout.close.assert_called_once_with()
+
+
+def test_read_sample():
+    """should read up to the given number of bytes from the stream"""
+    input_stream = io.BytesIO(b'abc' * 50000)
+    nose.assert_equal(len(swb.read_sample(input_stream, 100000)), 100000)
+    nose.assert_equal(len(swb.read_sample(input_stream, 100000)), 50000)
+
+
+@patch('shutil.which', side_effect=lambda name: name == 'gzip' or None)
+def test_get_available_codecs(which):
+    """should only consider codecs whose programs are installed"""
+    nose.assert_equal(
+        swb.get_available_codecs(),
+        [('gzip -1', 'gzip -d'), ('gzip -6', 'gzip -d')])
+
+
+@patch('subprocess.check_output', return_value=b'ab')
+def test_benchmark_codec(check_output):
+    """should measure the time and compressed size for the given codec"""
+    elapsed, compressed_size = swb.benchmark_codec('gzip -1', b'abcd')
+    check_output.assert_called_once_with(['gzip', '-1'], input=b'abcd')
+    nose.assert_equal(compressed_size, 2)
+    nose.assert_greater_equal(elapsed, 0)
+
+
+@patch('swb.remote.get_available_codecs', return_value=[
+    ('gzip -1', 'gzip -d'), ('xz -6', 'xz -d')])
+@patch('swb.remote.benchmark_codec', side_effect=lambda compressor, sample: {
+    'gzip -1': (0.1, 3000), 'xz -6': (2.0, 2000)}[compressor])
+def test_choose_codec_time(benchmark_codec, get_available_codecs):
+    """should choose the codec with the least total time on a slow link"""
+    nose.assert_equal(swb.choose_codec(
+        b'abc', objective='time', link_bandwidth=100000),
+        ('gzip -1', 'gzip -d'))
+    nose.assert_equal(swb.choose_codec(
+        b'abc', objective='time', link_bandwidth=100), ('xz -6', 'xz -d'))
+
+
+@patch('swb.remote.get_available_codecs', return_value=[
+    ('gzip -1', 'gzip -d'), ('xz -6', 'xz -d')])
+@patch('swb.remote.benchmark_codec', side_effect=lambda compressor, sample: {
+    'gzip -1': (0.1, 3000), 'xz -6': (2.0, 2000)}[compressor])
+def test_choose_codec_size(benchmark_codec, get_available_codecs):
+    """should choose the codec with the smallest output if asked to"""
+    nose.assert_equal(swb.choose_codec(
+        b'abc', objective='size', link_bandwidth=100000), ('xz -6', 'xz -d'))
+
+
+@patch('swb.remote.get_available_codecs', return_value=[])
+def test_choose_codec_none(get_available_codecs):
+    """should raise error if no candidate codec is installed"""
+    with nose.assert_raises(OSError):
+        swb.choose_codec(b'abc', objective='size', link_bandwidth=None)
+
+
+def test_index_dump_chunks():
+    """should pass through dump chunks, recording where each table is"""
+    dump = (b'-- MySQL dump\n\n-- Table structure for table `wp_options`\n'
+            b'INSERT 1;\n\n-- Table structure for table `wp_posts`\n'
+            b'INSERT 2;\n')
+    table_offsets = {}
+    # Split the dump so that a table comment spans chunks
+    chunks = list(swb.index_dump_chunks(
+        [dump[:20], dump[20:70], dump[70:]], table_offsets=table_offsets))
+    nose.assert_equal(b''.join(chunks), dump)
+    options_start = dump.index(b'-- Table structure for table `wp_o')
+    posts_start = dump.index(b'-- Table structure for table `wp_p')
+    nose.assert_equal(table_offsets, {
+        'wp_options': [options_start, posts_start],
+        'wp_posts': [posts_start, len(dump)]})
+
+
+def test_group_blocks():
+    """should group chunks into blocks of the given size"""
+    nose.assert_equal(
+        list(swb.group_blocks([b'abc', b'defgh', b'ij'], 4)),
+        [b'abcd', b'efgh', b'ij'])
+
+
+def test_compress_blocks():
+    """should compress blocks independently, recording an index of them"""
+    import gzip
+    output_stream = io.BytesIO()
+    blocks, raw_size = swb.compress_blocks(
+        [b'abc' * 1000, b'def' * 1000], output_stream,
+        compressor=['gzip', '-1'], block_size=4000)
+    archive = output_stream.getvalue()
+    nose.assert_equal(raw_size, 6000)
+    nose.assert_equal(
+        [block[:2] for block in blocks], [[0, 4000], [4000, 2000]])
+    nose.assert_equal(blocks[1][2], blocks[0][3])
+    nose.assert_equal(blocks[1][2] + blocks[1][3], len(archive))
+    second_block = archive[blocks[1][2]:]
+    nose.assert_equal(blocks[1][4], hashlib.sha256(second_block).hexdigest())
+    nose.assert_equal(
+        gzip.decompress(second_block), (b'abc' * 1000 + b'def' * 1000)[4000:])
+    # The archive as a whole is an ordinary (multi-member) gzip file
+    nose.assert_equal(gzip.decompress(archive), b'abc' * 1000 + b'def' * 1000)
+
+
+def test_hold_host_slots_no_budget():
+    """should not wait for a slot if the host has no worker budget"""
+    with swb.hold_host_slots(None, max_slots=4) as num_slots:
+        nose.assert_equal(num_slots, 4)
+
+
+def test_hold_host_slots_max():
+    """should hold several free slots if no other dump is waiting"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        with patch('swb.remote.host_slot_dir', temp_dir):
+            with swb.hold_host_slots(4, max_slots=3) as num_slots:
+                nose.assert_equal(num_slots, 3)
+                with swb.hold_host_slots(4, max_slots=3) as other_num_slots:
+                    nose.assert_equal(other_num_slots, 1)
+            nose.assert_equal(os.listdir(os.path.join(temp_dir, 'queue')), [])
+
+
+def test_hold_host_slots_queue():
+    """should serve dumps waiting for a slot in the order they arrived"""
+    served = []
+    releases = {name: threading.Event() for name in ('a', 'b')}
+
+    def dump(name):
+        with swb.hold_host_slots(1):
+            served.append(name)
+            releases[name].wait()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        with patch('swb.remote.host_slot_dir', temp_dir):
+            queue_dir = os.path.join(temp_dir, 'queue')
+            with swb.hold_host_slots(1):
+                dump_threads = []
+                for name in ('a', 'b'):
+                    dump_threads.append(threading.Thread(
+                        target=dump, args=(name,)))
+                    dump_threads[-1].start()
+                    while len(os.listdir(queue_dir)) < len(dump_threads):
+                        time.sleep(0.01)
+                nose.assert_equal(served, [])
+            while not served:
+                time.sleep(0.01)
+            time.sleep(0.2)
+            nose.assert_equal(served, ['a'])
+            releases['a'].set()
+            releases['b'].set()
+            for dump_thread in dump_threads:
+                dump_thread.join()
+    nose.assert_equal(served, ['a', 'b'])
+
+
+def test_get_slot_queue_stale():
+    """should remove queue entries of dumps which died while waiting"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        open(os.path.join(temp_dir, '1'), 'wb').close()
+        entry_path = os.path.join(temp_dir, '2')
+        open(entry_path, 'wb').close()
+        nose.assert_equal(
+            swb.get_slot_queue(temp_dir, entry_path), [entry_path])
+        nose.assert_equal(os.listdir(temp_dir), ['2'])
+
+
 @patch('os.path.getsize', return_value=20480)
 def test_verify_backup_integrity_valid(getsize):
     """should validate a given valid backup file"""
@@ -88,17 +583,20 @@ def test_purge_downloaded_backup(remove):
     remove.assert_called_once_with('a/b c/d')
 
 
+@patch('os.path.getsize', return_value=2048)
 @patch('swb.remote.verify_backup_integrity')
-@patch('swb.remote.dump_compressed_db')
+@patch('swb.remote.dump_compressed_db', return_value={'raw_size': 8192})
 @patch('swb.remote.get_db_info', return_value={
     'name': 'mydb',
     'host': 'myhost',
     'user': 'myname',
-    'password': 'mypassword'
+    'password': 'mypassword',
+    'table_prefix': 'wp_'
 })
 @patch('swb.remote.create_dir_structure')
-def test_back_up_db(create_dir_structure, get_db_info,
-                    dump_compressed_db, verify_backup_integrity):
+@patch('builtins.print')
+def test_back_up_db(builtin_print, create_dir_structure, get_db_info,
+                    dump_compressed_db, verify_backup_integrity, getsize):
     """should perform a WordPress database backup"""
     swb.back_up(
         wordpress_path='path/to/my site',
@@ -110,84 +608,638 @@ def test_back_up_db(create_dir_structure, get_db_info,
         db_name='mydb', db_host='myhost',
         db_user='myname', db_password='mypassword',
         backup_path='path/to/my backup.sql.bz2',
-        backup_compressor='bzip2 -v')
+        backup_compressor='bzip2 -v',
+        backup_options={},
+        table_prefix='wp_')
     verify_backup_integrity.assert_called_once_with(
         'path/to/my backup.sql.bz2')
+    nose.assert_equal(
+        json.loads(builtin_print.call_args[0][0]),
+        {'raw_size': 8192, 'backup_size': 2048})
 
 
-@patch('subprocess.Popen', spec=subprocess.Popen)
-def test_decompress_backup(popen):
-    """should decompress the given backup file using the given decompressor"""
-    swb.decompress_backup(
-        backup_path='path/to/my backup.sql.bz2',
-        backup_decompressor='bzip2 -d')
-    popen.assert_called_once_with(
-        ['bzip2', '-d', 'path/to/my backup.sql.bz2'])
-    popen.return_value.wait.assert_called_once_with()
+def write_raw_dump(backup_path, **kwargs):
+    """Write a fake raw dump to the given path"""
+    with open(backup_path, 'wb') as dump_file:
+        dump_file.write(b''.join(
+            'INSERT INTO t VALUES ({});\n'.format(i).encode('utf-8')
+            for i in range(10000)))
+    return {'raw_size': 8192}
 
 
-@patch('subprocess.Popen', spec=subprocess.Popen)
-@patch('builtins.open')
-def test_replace_db(builtin_open, popen):
-    """should replace the MySQL database when restoring from backup"""
-    swb.replace_db(
+@patch('swb.remote.dump_compressed_db', side_effect=write_raw_dump)
+@patch('swb.remote.get_db_info', return_value={
+    'name': 'mydb',
+    'host': 'myhost',
+    'user': 'myname',
+    'password': 'mypassword',
+    'table_prefix': 'wp_'
+})
+@patch('builtins.print')
+def test_back_up_delta(builtin_print, get_db_info, dump_compressed_db):
+    """should send a delta against the kept dump of the confirmed backup"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        backup_path = os.path.join(temp_dir, 'backup.sql.gz')
+        with patch('swb.remote.dump_cache_dir', temp_dir):
+            dump_dir = swb.get_dump_dir(os.path.expanduser('~/mysite'))
+            swb.back_up_delta('~/mysite', 'gzip', backup_path, '')
+            full_stats = json.loads(builtin_print.call_args[0][0])
+            nose.assert_not_in('delta_basis', full_stats)
+            # The dump of a concurrent run
+            open(os.path.join(dump_dir, '123.sql.part'), 'wb').close()
+            swb.back_up_delta(
+                '~/mysite', 'gzip', backup_path, full_stats['raw_checksum'])
+            delta_stats = json.loads(builtin_print.call_args[0][0])
+            dump_file_names = os.listdir(dump_dir)
+        nose.assert_equal(
+            delta_stats['delta_basis'], full_stats['raw_checksum'])
+        nose.assert_less(delta_stats['backup_size'], 1024)
+        nose.assert_equal(set(dump_file_names), {
+            '123.sql.part', '{}.sql'.format(full_stats['raw_checksum'])})
+
+
+@patch('os.walk', return_value=[
+    ('/home/me/sites', ['a b', 'wp-content'], []),
+    ('/home/me/sites/a b', [], ['index.php', 'wp-config.php'])])
+def test_discover_wordpress_installs(walk):
+    """should find WordPress installs under the given roots"""
+    nose.assert_equal(
+        swb.discover_wordpress_installs(['/home/me/sites']),
+        [('sites-a-b', '/home/me/sites/a b')])
+    nose.assert_equal(walk.return_value[0][1], ['a b'])
+
+
+@patch('os.walk', return_value=[
+    ('/home/me/sites', ['foo', 'foo bar', 'www'], []),
+    ('/home/me/sites/foo', ['bar'], []),
+    ('/home/me/sites/foo/bar', [], ['wp-config.php']),
+    ('/home/me/sites/foo bar', [], ['wp-config.php']),
+    ('/home/me/sites/www', [], ['wp-config.php'])])
+def test_discover_wordpress_installs_duplicate_labels(walk):
+    """should tell apart installs whose paths reduce to the same label"""
+    installs = swb.discover_wordpress_installs(['/home/me/sites'])
+    nose.assert_equal(
+        [path for label, path in installs],
+        ['/home/me/sites/foo/bar', '/home/me/sites/foo bar',
+         '/home/me/sites/www'])
+    nose.assert_equal(installs[2][0], 'sites-www')
+    nose.assert_equal(installs[0][0], swb.get_unique_install_label(
+        'sites-foo-bar', '/home/me/sites/foo/bar'))
+    nose.assert_equal(installs[1][0], swb.get_unique_install_label(
+        'sites-foo-bar', '/home/me/sites/foo bar'))
+    nose.assert_not_equal(installs[0][0], installs[1][0])
+
+
+def test_get_install_label():
+    """should derive a path-safe label from an install's path"""
+    nose.assert_equal(
+        swb.get_install_label('/home/me/www/', '/home/me/www'), 'www')
+    nose.assert_equal(
+        swb.get_install_label('/home/me/www', '/home/me/www/b/c'),
+        'www-b-c')
+
+
+def read_frames(output_stream):
+    """Parse the frames written to the given fleet backup stream"""
+    frames = []
+    output_stream.seek(0)
+    while True:
+        header = output_stream.read(swb.frame_header.size)
+        if not header:
+            return frames
+        frame_type, label_size, payload_size = swb.frame_header.unpack(header)
+        frames.append((frame_type, output_stream.read(label_size),
+                       output_stream.read(payload_size)))
+
+
+def write_dump(backup_file, **kwargs):
+    """Write a fake compressed dump to the given backup file"""
+    backup_file.write(b'x' * 2048)
+    return {'raw_size': 8192}
+
+
+@patch('swb.remote.write_compressed_dump', side_effect=write_dump)
+@patch('swb.remote.get_db_info', return_value={
+    'name': 'mydb',
+    'host': 'myhost',
+    'user': 'myname',
+    'password': 'mypassword',
+    'table_prefix': 'wp_'
+})
+def test_back_up_install(get_db_info, write_compressed_dump):
+    """should stream an install's backup in frames labeled with the site"""
+    output_stream = io.BytesIO()
+    nose.assert_true(swb.back_up_install(
+        'mysite', 'path/to/mysite',
+        backup_compressor='gzip', backup_options={},
+        output_stream=output_stream, output_lock=swb.threading.Lock()))
+    get_db_info.assert_called_once_with('path/to/mysite')
+    frames = read_frames(output_stream)
+    nose.assert_equal(frames[0], (b'D', b'mysite', b'x' * 2048))
+    nose.assert_equal(frames[1][:2], (b'E', b'mysite'))
+    nose.assert_equal(json.loads(frames[1][2].decode('utf-8')),
+                      {'raw_size': 8192, 'backup_size': 2048})
+
+
+@patch('swb.remote.write_compressed_dump',
+       side_effect=OSError('Database could not be dumped. Aborting.'))
+@patch('swb.remote.get_db_info', return_value={
+    'name': 'mydb',
+    'host': 'myhost',
+    'user': 'myname',
+    'password': 'mypassword',
+    'table_prefix': 'wp_'
+})
+def test_back_up_install_fail(get_db_info, write_compressed_dump):
+    """should report the error which aborted an install's backup"""
+    output_stream = io.BytesIO()
+    nose.assert_false(swb.back_up_install(
+        'mysite', 'path/to/mysite',
+        backup_compressor='gzip', backup_options={},
+        output_stream=output_stream, output_lock=swb.threading.Lock()))
+    nose.assert_equal(read_frames(output_stream), [
+        (b'X', b'mysite', b'Database could not be dumped. Aborting.')])
+
+
+@patch('swb.remote.back_up_install')
+@patch('swb.remote.discover_wordpress_installs', return_value=[
+    ('www-a', '/www/a'), ('www-b', '/www/b')])
+@patch('sys.stdout')
+def test_back_up_fleet(stdout, discover_wordpress_installs, back_up_install):
+    """should back up every install found under the given roots"""
+    swb.back_up_fleet('["/www"]', 'gzip', '{"block_size": 1024}', '2')
+    discover_wordpress_installs.assert_called_once_with(['/www'])
+    nose.assert_equal(
+        sorted(back_up_install.call_args_list), [
+            call(label, install_path, backup_compressor='gzip',
+                 backup_options={'block_size': 1024},
+                 output_stream=stdout.buffer, output_lock=ANY)
+            for label, install_path in (('www-a', '/www/a'),
+                                        ('www-b', '/www/b'))])
+    stdout.buffer.flush.assert_called_once_with()
+
+
+def test_get_mysql_args():
+    """should construct arguments for connecting to the given database"""
+    nose.assert_equal(swb.get_mysql_args(
+        db_name='mydb', db_host='myhost',
+        db_user='myname', db_password='mypassword'),
+        ['mysql', 'mydb', '-h', 'myhost', '-u', 'myname', '-pmypassword'])
+
+
+@patch('subprocess.Popen')
+def test_exec_sql(popen):
+    """should execute the given SQL statements on the given database"""
+    popen.return_value.returncode = 0
+    swb.exec_sql(
+        db_name='mydb', db_host='myhost',
+        db_user='myname', db_password='mypassword', sql='SELECT 1')
+    popen.assert_called_once_with([
+        'mysql', 'mydb', '-h', 'myhost', '-u', 'myname', '-pmypassword',
+        '-e', 'SELECT 1'])
+
+
+@patch('subprocess.Popen')
+def test_exec_sql_fail(popen):
+    """should raise error if SQL statements could not be executed"""
+    popen.return_value.returncode = 1
+    with nose.assert_raises(OSError):
+        swb.exec_sql(
+            db_name='mydb', db_host='myhost',
+            db_user='myname', db_password='mypassword', sql='SELECT 1')
+
+
+@patch('subprocess.check_output', return_value=b'wp_options\nwp_posts\n')
+def test_get_table_names(check_output):
+    """should retrieve the names of all tables in the given database"""
+    table_names = swb.get_table_names(
+        db_name='mydb', db_host='myhost',
+        db_user='myname', db_password='mypassword')
+    nose.assert_equal(table_names, ['wp_options', 'wp_posts'])
+
+
+def test_quote_identifier():
+    """should quote the given identifiers, escaping backticks"""
+    nose.assert_equal(
+        swb.quote_identifier('mydb', 'wp_`posts'), '`mydb`.`wp_``posts`')
+
+
+def test_get_file_checksum():
+    """should compute the SHA-256 checksum of the given file"""
+    foo_path = os.path.join(WP_PATH, 'wp-content', 'foo.txt')
+    with open(foo_path, 'rb') as foo_file:
+        expected_checksum = hashlib.sha256(foo_file.read()).hexdigest()
+    nose.assert_equal(swb.get_file_checksum(foo_path), expected_checksum)
+
+
+@patch('swb.remote.get_file_checksum', return_value='abc')
+@patch('os.remove')
+def test_verify_backup_checksum_valid(remove, get_file_checksum):
+    """should validate a backup whose checksum matches"""
+    swb.verify_backup_checksum('a/b c/d', 'abc')
+    remove.assert_not_called()
+
+
+@patch('swb.remote.get_file_checksum', return_value='def')
+@patch('os.remove')
+def test_verify_backup_checksum_invalid(remove, get_file_checksum):
+    """should invalidate a backup whose checksum does not match"""
+    with nose.assert_raises(OSError):
+        swb.verify_backup_checksum('a/b c/d', 'abc')
+    remove.assert_called_once_with('a/b c/d')
+
+
+@patch('subprocess.Popen')
+def test_replace_db(popen):
+    """should pipe the decompressed backup into the MySQL database"""
+    popen.return_value.returncode = 0
+    backup_file = io.BytesIO(b'abc')
+    checksum = swb.replace_db(
         db_name='mydb', db_host='myhost',
         db_user='myname', db_password='mypassword',
-        db_path='path/to/my backup.sql')
-    builtin_open.assert_called_once_with(
-        'path/to/my backup.sql', 'r')
-    popen.assert_called_once_with(
+        backup_file=backup_file, backup_decompressor='bzip2 -d')
+    popen.assert_any_call(
+        ['bzip2', '-d'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    popen.assert_any_call(
         ['mysql', 'mydb', '-h', 'myhost', '-u', 'myname', '-pmypassword'],
-        stdin=builtin_open.return_value.__enter__())
-    popen.return_value.wait.assert_called_once_with()
+        stdin=popen.return_value.stdout)
+    popen.return_value.stdin.write.assert_called_once_with(b'abc')
+    nose.assert_equal(checksum, hashlib.sha256(b'abc').hexdigest())
+    nose.assert_equal(popen.return_value.wait.call_count, 2)
+
+
+@patch('subprocess.Popen')
+def test_replace_db_blocks(popen):
+    """should decompress the blocks of a block archive in parallel"""
+    import gzip
+    blocks = [gzip.compress(b'abc'), gzip.compress(b'def')]
+    mysql = Mock(returncode=0)
+    decompressor = Mock(returncode=0)
+    decompressor.communicate.side_effect = lambda block: (
+        gzip.decompress(block), b'')
+    popen.side_effect = lambda command, **kwargs: (
+        mysql if command[0] == 'mysql' else decompressor)
+    checksum = swb.replace_db(
+        db_name='mydb', db_host='myhost',
+        db_user='myname', db_password='mypassword',
+        backup_file=io.BytesIO(b''.join(blocks)),
+        backup_decompressor='gzip -d',
+        block_sizes=[len(block) for block in blocks])
+    nose.assert_equal(mysql.stdin.write.call_args_list, [
+        call(b'abc'), call(b'def')])
+    nose.assert_equal(
+        checksum, hashlib.sha256(b''.join(blocks)).hexdigest())
+
+
+def test_parse_block_sizes():
+    """should parse the comma-separated sizes of a backup's blocks"""
+    nose.assert_equal(swb.parse_block_sizes('12,34'), [12, 34])
+    nose.assert_equal(swb.parse_block_sizes(''), [])
+
+
+CREATE_TABLE_LINES = [
+    b'CREATE TABLE `wp_postmeta` (',
+    b'  `meta_id` bigint(20) unsigned NOT NULL AUTO_INCREMENT,',
+    b'  `post_id` bigint(20) unsigned NOT NULL DEFAULT \'0\',',
+    b'  `meta_value` longtext,',
+    b'  PRIMARY KEY (`meta_id`),',
+    b'  KEY `post_id` (`post_id`),',
+    b'  FULLTEXT KEY `meta_value` (`meta_value`)',
+    b') ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;'
+]
+
+
+def test_split_secondary_indexes():
+    """should split secondary indexes from CREATE TABLE statements"""
+    create_lines, alter_statements = swb.split_secondary_indexes(
+        CREATE_TABLE_LINES)
+    nose.assert_equal(create_lines, CREATE_TABLE_LINES[:4] + [
+        b'  PRIMARY KEY (`meta_id`)', CREATE_TABLE_LINES[-1]])
+    nose.assert_equal(alter_statements, [
+        b'ALTER TABLE `wp_postmeta` ADD KEY `post_id` (`post_id`);',
+        b'ALTER TABLE `wp_postmeta`'
+        b' ADD FULLTEXT KEY `meta_value` (`meta_value`);'])
+
+
+def test_split_secondary_indexes_auto_increment():
+    """should keep the indexes starting with AUTO_INCREMENT columns"""
+    create_lines = [
+        b'CREATE TABLE `wp_log` (',
+        b'  `site_id` int(11) NOT NULL,',
+        b'  `log_id` int(11) NOT NULL AUTO_INCREMENT,',
+        b'  PRIMARY KEY (`site_id`,`log_id`),',
+        b'  KEY `log_id` (`log_id`),',
+        b'  KEY `site_log` (`site_id`,`log_id`)',
+        b') ENGINE=InnoDB AUTO_INCREMENT=5 DEFAULT CHARSET=utf8mb4;'
+    ]
+    nose.assert_equal(swb.split_secondary_indexes(create_lines), (
+        create_lines[:4] + [b'  KEY `log_id` (`log_id`)', create_lines[-1]],
+        [b'ALTER TABLE `wp_log` ADD KEY `site_log` (`site_id`,`log_id`);']))
+
+
+def test_split_secondary_indexes_foreign_keys():
+    """should keep the indexes of tables with foreign keys"""
+    create_lines = CREATE_TABLE_LINES[:-1] + [
+        b'  CONSTRAINT `fk` FOREIGN KEY (`post_id`) REFERENCES `wp_posts`'
+        b' (`ID`)', CREATE_TABLE_LINES[-1]]
+    nose.assert_equal(
+        swb.split_secondary_indexes(create_lines), (create_lines, []))
+
+
+def test_defer_secondary_indexes():
+    """should add secondary indexes after every row has been loaded"""
+    dump = b'\n'.join([b'DROP TABLE IF EXISTS `wp_postmeta`;'] +
+                      CREATE_TABLE_LINES +
+                      [b'INSERT INTO `wp_postmeta` VALUES (1,2,\'a\');', b''])
+    chunks = [dump[i:i + 7] for i in range(0, len(dump), 7)]
+    rewritten_dump = b''.join(swb.defer_secondary_indexes(chunks))
+    nose.assert_not_in(b'  KEY `post_id`', rewritten_dump)
+    nose.assert_true(rewritten_dump.startswith(
+        b'DROP TABLE IF EXISTS `wp_postmeta`;\n'))
+    nose.assert_true(rewritten_dump.endswith(
+        b'INSERT INTO `wp_postmeta` VALUES (1,2,\'a\');\n\n'
+        b'ALTER TABLE `wp_postmeta` ADD KEY `post_id` (`post_id`);\n'
+        b'ALTER TABLE `wp_postmeta`'
+        b' ADD FULLTEXT KEY `meta_value` (`meta_value`);\n'))
+
+
+def test_replace_db_defer_indexes():
+    """should load the dump with its secondary indexes deferred"""
+    dump = b'\n'.join(CREATE_TABLE_LINES + [b''])
+    with tempfile.TemporaryDirectory() as temp_dir:
+        output_path = os.path.join(temp_dir, 'loaded.sql')
+        with patch('swb.remote.get_mysql_args', return_value=[
+                'sh', '-c', 'cat > "$0"', output_path]):
+            swb.replace_db(
+                db_name='mydb', db_host='myhost',
+                db_user='myname', db_password='mypassword',
+                backup_file=io.BytesIO(dump), backup_decompressor='cat',
+                defer_indexes=True)
+        with open(output_path, 'rb') as output_file:
+            nose.assert_equal(
+                output_file.read(),
+                b''.join(swb.defer_secondary_indexes([dump])))
+
+
+@patch('subprocess.Popen')
+def test_replace_db_decompress_fail(popen):
+    """should raise error if backup cannot be decompressed"""
+    popen.return_value.returncode = 1
+    with nose.assert_raises(OSError):
+        swb.replace_db(
+            db_name='mydb', db_host='myhost',
+            db_user='myname', db_password='mypassword',
+            backup_file=io.BytesIO(b'abc'), backup_decompressor='bzip2 -d')
+
+
+@patch('swb.remote.exec_sql')
+@patch('swb.remote.get_table_names', return_value=['wp_posts'])
+def test_empty_staging_db(get_table_names, exec_sql):
+    """should drop all tables in the staging database"""
+    swb.empty_staging_db(
+        db_host='myhost', db_user='myname', db_password='mypassword',
+        staging_db='mydb_staging')
+    exec_sql.assert_called_once_with(
+        db_name='mydb_staging', db_host='myhost',
+        db_user='myname', db_password='mypassword',
+        sql='DROP TABLE `mydb_staging`.`wp_posts`')
+
+
+@patch('swb.remote.exec_sql')
+@patch('swb.remote.get_table_names', side_effect=[
+    ['wp_options', 'wp_posts'],
+    ['wp_options']
+])
+def test_swap_staging_tables(get_table_names, exec_sql):
+    """should swap staged tables into database with one RENAME statement"""
+    swb.swap_staging_tables(
+        db_name='mydb', db_host='myhost',
+        db_user='myname', db_password='mypassword',
+        staging_db='mydb_staging')
+    nose.assert_equal(exec_sql.call_args_list[0][1]['sql'], (
+        'RENAME TABLE '
+        '`mydb`.`wp_options` TO `mydb_staging`.`swb_old_wp_options`, '
+        '`mydb_staging`.`wp_options` TO `mydb`.`wp_options`, '
+        '`mydb_staging`.`wp_posts` TO `mydb`.`wp_posts`'))
+    nose.assert_equal(
+        exec_sql.call_args_list[1][1]['sql'],
+        'DROP TABLE `mydb_staging`.`swb_old_wp_options`')
+
+
+@patch('swb.remote.exec_sql')
+@patch('swb.remote.get_table_names', return_value=[])
+def test_swap_staging_tables_empty(get_table_names, exec_sql):
+    """should refuse to swap in an empty staging database"""
+    with nose.assert_raises(OSError):
+        swb.swap_staging_tables(
+            db_name='mydb', db_host='myhost',
+            db_user='myname', db_password='mypassword',
+            staging_db='mydb_staging')
+    exec_sql.assert_not_called()
+
+
+DB_INFO = {
+    'name': 'mydb',
+    'host': 'myhost',
+    'user': 'myname',
+    'password': 'mypassword'
+}
+
+
+@patch('swb.remote.swap_staging_tables')
+@patch('swb.remote.empty_staging_db')
+@patch('swb.remote.replace_db', return_value='abc')
+def test_load_backup_staging_db(replace_db, empty_staging_db,
+                                swap_staging_tables):
+    """should load backup into staging database and swap it in"""
+    swb.load_backup(
+        db_info=DB_INFO, backup_file=1, backup_decompressor='bzip2 -d',
+        backup_checksum='abc', staging_db='mydb_staging')
+    empty_staging_db.assert_called_once_with(
+        db_host='myhost', db_user='myname', db_password='mypassword',
+        staging_db='mydb_staging')
+    replace_db.assert_called_once_with(
+        db_name='mydb_staging', db_host='myhost',
+        db_user='myname', db_password='mypassword',
+        backup_file=1, backup_decompressor='bzip2 -d', block_sizes=None,
+        defer_indexes=False)
+    swap_staging_tables.assert_called_once_with(
+        db_name='mydb', db_host='myhost',
+        db_user='myname', db_password='mypassword',
+        staging_db='mydb_staging')
+
+
+@patch('swb.remote.swap_staging_tables')
+@patch('swb.remote.empty_staging_db')
+@patch('swb.remote.replace_db', return_value='def')
+def test_load_backup_checksum_mismatch(replace_db, empty_staging_db,
+                                       swap_staging_tables):
+    """should not swap in staged tables if the checksum does not match"""
+    with nose.assert_raises(OSError):
+        swb.load_backup(
+            db_info=DB_INFO, backup_file=1, backup_decompressor='bzip2 -d',
+            backup_checksum='abc', staging_db='mydb_staging')
+    swap_staging_tables.assert_not_called()
+
+
+@patch('swb.remote.exec_sql')
+@patch('swb.remote.swap_staging_tables')
+@patch('swb.remote.empty_staging_db')
+@patch('swb.remote.replace_db', return_value='abc')
+def test_load_backup_default_staging(replace_db, empty_staging_db,
+                                     swap_staging_tables, exec_sql):
+    """should stage backup in a temporary database if none is given"""
+    swb.load_backup(
+        db_info=DB_INFO, backup_file=1, backup_decompressor='bzip2 -d',
+        backup_checksum='abc', staging_db='')
+    nose.assert_equal(exec_sql.call_args_list, [
+        call(db_name='mydb', db_host='myhost',
+             db_user='myname', db_password='mypassword',
+             sql='CREATE DATABASE IF NOT EXISTS `mydb_swb_staging`'),
+        call(db_name='mydb', db_host='myhost',
+             db_user='myname', db_password='mypassword',
+             sql='DROP DATABASE `mydb_swb_staging`')])
+    nose.assert_equal(
+        replace_db.call_args[1]['db_name'], 'mydb_swb_staging')
+    nose.assert_equal(
+        swap_staging_tables.call_args[1]['staging_db'], 'mydb_swb_staging')
+
+
+@patch('swb.remote.exec_sql')
+@patch('swb.remote.swap_staging_tables')
+@patch('swb.remote.empty_staging_db')
+@patch('swb.remote.replace_db', return_value='def')
+def test_load_backup_default_staging_mismatch(replace_db, empty_staging_db,
+                                              swap_staging_tables, exec_sql):
+    """should leave a corrupted backup in the temporary staging database"""
+    with nose.assert_raises(OSError):
+        swb.load_backup(
+            db_info=DB_INFO, backup_file=1, backup_decompressor='bzip2 -d',
+            backup_checksum='abc', staging_db='')
+    swap_staging_tables.assert_not_called()
+    nose.assert_equal(exec_sql.call_count, 1)
+
+
+@patch('swb.remote.exec_sql')
+@patch('swb.remote.swap_staging_tables')
+@patch('swb.remote.replace_db', return_value='abc')
+def test_load_backup_direct_load(replace_db, swap_staging_tables, exec_sql):
+    """should load backup directly into the database if chosen"""
+    swb.load_backup(
+        db_info=DB_INFO, backup_file=1, backup_decompressor='bzip2 -d',
+        backup_checksum='abc', staging_db='', direct_load=True)
+    nose.assert_equal(replace_db.call_args[1]['db_name'], 'mydb')
+    swap_staging_tables.assert_not_called()
+    exec_sql.assert_not_called()
+
+
+@patch('swb.remote.replace_db')
+def test_load_backup_staging_db_same(replace_db):
+    """should refuse to use the WordPress database as staging database"""
+    with nose.assert_raises(OSError):
+        swb.load_backup(
+            db_info=DB_INFO, backup_file=1, backup_decompressor='bzip2 -d',
+            backup_checksum='', staging_db='mydb')
+    replace_db.assert_not_called()
 
 
 @patch('os.remove')
 def test_purge_restored_backup(remove):
-    """should purge restored backup and database file after restore"""
-    swb.purge_restored_backup(
-        backup_path='path/to/my backup.sql.bz2',
-        db_path='path/to/my backup.sql')
-    remove.assert_any_call('path/to/my backup.sql')
-    remove.assert_any_call('path/to/my backup.sql.bz2')
+    """should purge restored backup after restore"""
+    swb.purge_restored_backup('path/to/my backup.sql.bz2')
+    remove.assert_called_once_with('path/to/my backup.sql.bz2')
 
 
 @patch('os.remove', side_effect=OSError)
 def test_purge_restored_backup_silent_fail(remove):
-    """should silently fail if restored database/backup file does not exist"""
-    swb.purge_restored_backup(
-        backup_path='path/to/my backup.sql.bz2',
-        db_path='path/to/my backup.sql')
-    nose.assert_equal(remove.call_count, 2)
+    """should silently fail if restored backup file does not exist"""
+    swb.purge_restored_backup('path/to/my backup.sql.bz2')
+    nose.assert_equal(remove.call_count, 1)
 
 
+@patch('swb.remote.verify_backup_checksum')
 @patch('swb.remote.verify_backup_integrity')
-@patch('swb.remote.replace_db')
+@patch('swb.remote.load_backup')
 @patch('swb.remote.purge_restored_backup')
-@patch('swb.remote.get_db_info', return_value={
-    'name': 'mydb',
-    'host': 'myhost',
-    'user': 'myname',
-    'password': 'mypassword'
-})
-@patch('swb.remote.decompress_backup')
-def test_restore(decompress_backup, get_db_info, purge_restored_backup,
-                 replace_db, verify_backup_integrity):
+@patch('swb.remote.get_db_info', return_value=DB_INFO)
+@patch('builtins.open')
+def test_restore(builtin_open, get_db_info, purge_restored_backup,
+                 load_backup, verify_backup_integrity,
+                 verify_backup_checksum):
     """should run restore procedure"""
     swb.restore(
         wordpress_path='~/path/to/my site',
         backup_path='~/path/to/my site.sql.bz2',
-        backup_decompressor='bzip2 -d')
-    decompress_backup.assert_called_once_with(
-        backup_path=os.path.expanduser('~/path/to/my site.sql.bz2'),
-        backup_decompressor='bzip2 -d')
-    replace_db.assert_called_once_with(
-        db_name='mydb', db_host='myhost',
-        db_user='myname', db_password='mypassword',
-        db_path=os.path.expanduser('~/path/to/my site.sql'))
-    purge_restored_backup.assert_called_once_with(
-        backup_path=os.path.expanduser('~/path/to/my site.sql.bz2'),
-        db_path=os.path.expanduser('~/path/to/my site.sql'))
+        backup_decompressor='bzip2 -d',
+        backup_checksum='abc',
+        staging_db='mydb_staging')
+    backup_path = os.path.expanduser('~/path/to/my site.sql.bz2')
+    verify_backup_integrity.assert_called_once_with(backup_path)
+    verify_backup_checksum.assert_called_once_with(backup_path, 'abc')
+    builtin_open.assert_called_once_with(backup_path, 'rb')
+    load_backup.assert_called_once_with(
+        db_info=DB_INFO, backup_file=builtin_open.return_value.__enter__(),
+        backup_decompressor='bzip2 -d', backup_checksum='abc',
+        staging_db='mydb_staging', block_sizes=[],
+        defer_indexes=False, direct_load=False)
+    purge_restored_backup.assert_called_once_with(backup_path)
+
+
+@patch('swb.remote.load_backup')
+@patch('swb.remote.get_db_info', return_value=DB_INFO)
+def test_restore_stream(get_db_info, load_backup):
+    """should run streaming restore procedure"""
+    swb.restore_stream(
+        wordpress_path='~/path/to/my site',
+        backup_decompressor='bzip2 -d',
+        backup_checksum='abc',
+        staging_db='mydb_staging')
+    get_db_info.assert_called_once_with(
+        os.path.expanduser('~/path/to/my site'))
+    load_backup.assert_called_once_with(
+        db_info=DB_INFO, backup_file=sys.stdin.buffer,
+        backup_decompressor='bzip2 -d', backup_checksum='abc',
+        staging_db='mydb_staging', block_sizes=[], defer_indexes=False)
+
+
+@patch('swb.remote.load_backup')
+@patch('swb.remote.get_db_info', return_value=DB_INFO)
+def test_restore_stream_direct_load(get_db_info, load_backup):
+    """should refuse to load streamed backups into the WordPress database"""
+    with nose.assert_raises(OSError):
+        swb.restore_stream(
+            wordpress_path='~/path/to/my site',
+            backup_decompressor='bzip2 -d',
+            backup_checksum='abc', direct_load='true')
+    load_backup.assert_not_called()
+
+
+@patch('swb.remote.query_db', side_effect=[
+    [['binlog.000013', '120', '', '']],
+    [['binlog.000011', '500'], ['binlog.000012', '900'],
+     ['binlog.000013', '120']]])
+@patch('subprocess.Popen')
+@patch('swb.remote.get_db_info', return_value=DB_INFO)
+def test_stream_binlog(get_db_info, popen, query_db):
+    """should stream binlog events up to the current position"""
+    popen.return_value.returncode = 0
+    out = io.StringIO()
+    with patch('sys.stdout', out):
+        swb.stream_binlog('~/mysite', 'binlog.000012', '4242')
+    nose.assert_equal(out.getvalue(), '-- swb-binlog-end: binlog.000013 120\n')
+    popen.assert_called_once_with([
+        'mysqlbinlog', '--read-from-remote-server',
+        '-h', 'myhost', '-u', 'myname', '-pmypassword', '--database=mydb',
+        '--start-position=4242', '--stop-position=120',
+        'binlog.000012', 'binlog.000013'], env=dict(os.environ, TZ='UTC'))
+
+
+@patch('swb.remote.query_db', return_value=[])
+@patch('swb.remote.get_db_info', return_value=DB_INFO)
+def test_get_current_binlog_position_disabled(get_db_info, query_db):
+    """should raise error if binary logging is not enabled"""
+    with nose.assert_raises(OSError):
+        swb.get_current_binlog_position(DB_INFO)
 
 
 @patch('swb.remote.back_up')
@@ -200,12 +1252,29 @@ def test_main_back_up(builtin_print, back_up):
 
 
 @patch('swb.remote.restore')
-@patch('sys.argv', [swb.__file__, 'restore', 'a', 'b', 'c', 'd'])
+@patch('sys.argv', [swb.__file__, 'restore', 'a', 'b', 'c', 'd', 'e', 'f',
+                    'g'])
 @patch('builtins.print')
 def test_main_restore(builtin_print, restore):
     """should run restore procedure when remote script is run"""
     swb.main()
-    restore.assert_called_once_with('a', 'b', 'c', 'd')
+    restore.assert_called_once_with('a', 'b', 'c', 'd', 'e', 'f', 'g')
+
+
+@patch('swb.remote.stream_binlog')
+@patch('sys.argv', [swb.__file__, 'binlog', 'a', 'b', 'c'])
+def test_main_binlog(stream_binlog):
+    """should stream binlog events when remote script is run"""
+    swb.main()
+    stream_binlog.assert_called_once_with('a', 'b', 'c')
+
+
+@patch('swb.remote.restore_stream')
+@patch('sys.argv', [swb.__file__, 'restore-stream', 'a', 'b'])
+def test_main_restore_stream(restore_stream):
+    """should run streaming restore procedure when remote script is run"""
+    swb.main()
+    restore_stream.assert_called_once_with('a', 'b')
 
 
 @patch('swb.remote.purge_downloaded_backup')
@@ -215,3 +1284,13 @@ def test_main_purge_downloaded(builtin_print, purge_downloaded_backup):
     """should run purge procedure when remote script is run"""
     swb.main()
     purge_downloaded_backup.assert_called_once_with('a', 'b', 'c', 'd')
+
+
+@patch('sys.exit')
+@patch('swb.remote.back_up', side_effect=TimeoutError('Aborting.'))
+@patch('sys.argv', [swb.__file__, 'back-up', 'a', 'b', 'c'])
+@patch('builtins.print')
+def test_main_lock_wait(builtin_print, back_up, exit):
+    """should exit with a distinct status if a dump timed out on a lock"""
+    swb.main()
+    exit.assert_called_once_with(swb.lock_wait_exit_status)